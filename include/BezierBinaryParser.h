@@ -0,0 +1,16 @@
+#ifndef BEZIERBINARYPARSER_H
+#define BEZIERBINARYPARSER_H
+
+#include <string>
+#include <cstdint>
+#include "BezierPattern.h"
+#include <esp_log.h>
+
+// Version of the binary pattern format (see keyboardclient/pattern_codec.py)
+#define BINARY_PATTERN_FORMAT_VERSION 3
+
+// Older versions are still read. contentHash, if given, receives the pattern's
+// content hash (empty before version 2). Segment indices come with version 3.
+std::pair<std::string, BezierPattern> parseBinaryToBezierPattern(const uint8_t* data, size_t len, std::string* contentHash = nullptr);
+
+#endif // BEZIERBINARYPARSER_H
@@ -18,6 +18,22 @@ struct FloatEvent {
     bool HasCurveControls;
 };
 
+// Event with values already quantized to Vec2.y, as sent in binary patterns
+struct QuantizedEvent {
+    float Time;
+    uint8_t Value;
+    uint8_t CurveControl1Y;
+    uint8_t CurveControl2Y;
+    bool HasCurveControls;
+};
+
+// For each bucket of time, the first segment ending at or after its start,
+// so sampling doesn't have to scan from the first segment
+struct SegmentIndex {
+    float bucketsPerSecond;
+    std::vector<uint16_t> firstSegments;
+};
+
 struct BezierSegment {
     float StartTime;
     float EndTime;
@@ -27,7 +43,9 @@ struct BezierSegment {
 class BezierEnvelope {
 public:
     BezierEnvelope(const std::vector<FloatEvent>& events);
-    float sampleAtTime(float time) const;
+    BezierEnvelope(const std::vector<QuantizedEvent>& events);
+    float sampleAtTime(float time, const SegmentIndex* index = nullptr) const;
+    bool isValidIndex(const SegmentIndex& index) const;
     float duration;
     std::string toString() const;
 
@@ -35,6 +53,7 @@ private:
     std::vector<BezierSegment> bezierSegments;
 
     void loadEvents(const std::vector<FloatEvent>& events);
+    void loadEvents(const std::vector<QuantizedEvent>& events);
 };
 
 #endif // BEZIERENVELOPE_H
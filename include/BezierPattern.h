@@ -9,9 +9,12 @@
 
 class BezierPattern {
 public:
-    BezierPattern(const std::vector<BezierEnvelope>& envelopes);
+    BezierPattern(const std::vector<BezierEnvelope>& envelopes, const std::vector<std::pair<uint8_t, SegmentIndex>>& segmentIndices = {});
     std::vector<uint16_t> getFrameAtTime(double time) const;
     std::vector<BezierEnvelope> envelopes;
+    // (channel, index) for the envelopes sent with one, in channel order. Kept
+    // here rather than in every envelope, as most are too short to need one.
+    std::vector<std::pair<uint8_t, SegmentIndex>> segmentIndices;
     float duration;
     uint8_t numOutputs;
 
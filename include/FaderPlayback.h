@@ -7,6 +7,8 @@
 #include <string>
 #include <map>
 #include <esp_log.h>
+#include <freertos/FreeRTOS.h>
+#include <freertos/semphr.h>
 
 
 class FaderPlayback {
@@ -19,20 +21,27 @@ private:
 
     std::vector<PatternPlayback> activePatterns; // Vector to store currently active patterns
     std::map<std::string, BezierPattern> patterns;
+    std::map<std::string, std::string> patternHashes; // content hashes sent with patterns, for syncing
     std::vector<uint16_t> currentFrame;
     std::vector<uint16_t> currentMultiplier;
+    // held by the frame timer while it makes a frame, and by the websocket
+    // task while it changes patterns, activePatterns or the multiplier.
+    // Recursive, as makeFrame stops finished patterns.
+    StaticSemaphore_t patternsMutexBuffer;
+    SemaphoreHandle_t patternsMutex;
 
     uint8_t driverCount;
     uint8_t* driverAddresses;
     std::vector<Adafruit_PWMServoDriver> drivers;
     const uint8_t MAX_CONCURRENT_PATTERNS = 10;
+    const int64_t MAX_START_DELAY = 1000000; // 1s, so a bad start time can't hold a pattern back for long
 
     float speed = 1;
     uint16_t gain;
     uint16_t lastFrameIndex;
     uint8_t availableOutputs;
     int64_t measStartTime;
-    std::vector<uint16_t> makeFrame(int64_t time);
+    std::vector<uint16_t> makeFrame(int64_t time); // with patternsMutex held
 
     uint64_t quantizeTime = 10000; //10ms
 
@@ -43,7 +52,7 @@ private:
     bool paused = false;
 public:
     enum CommandTypes {
-        COMMAND_ACK = 255,
+        COMMAND_ACK = 255, // replies to ADD_PATTERN, only sent as GET_INFO reports pattern_acks
         COMMAND_START_PATTERN = 1,
         COMMAND_SET_GAIN = 2,
         COMMAND_SET_SPEED = 3,
@@ -53,24 +62,34 @@ public:
         COMMAND_SET_MULTIPLIER = 7,
         COMMAND_STOP_PATTERN = 8,
         COMMAND_STOP_ALL = 9,
-        COMMAND_SET_PAUSED = 10
+        COMMAND_SET_PAUSED = 10,
+        COMMAND_GET_INFO = 11,
+        COMMAND_GET_PATTERNS = 12,
+        COMMAND_REMOVE_PATTERNS = 13,
+        COMMAND_PING = 14
     };
 
     std::vector<uint16_t> defaultFrame;
 
 
     FaderPlayback(uint8_t driverCount, uint8_t* driverAddresses, std::vector<uint16_t> defaultFrame = std::vector<uint16_t>(OUTPUTS_COUNT, 0))
-        : driverCount(driverCount), driverAddresses(driverAddresses), defaultFrame(defaultFrame) {}
+        : driverCount(driverCount), driverAddresses(driverAddresses), defaultFrame(defaultFrame)
+    {
+        // statically allocated, so creating it cannot fail
+        patternsMutex = xSemaphoreCreateRecursiveMutexStatic(&patternsMutexBuffer);
+    }
 
     std::vector<uint8_t> scanI2C();
 
     void setup();
-    void startPattern(std::string patternName, bool loop = false);
+    void startPattern(std::string patternName, bool loop = false, int64_t startTime = -1);
     void stopPattern(std::string patternName);
     void sendFrame();
     void setGain(uint16_t gain);
     void setPatterns(std::map<std::string, BezierPattern> patterns);
-    void addPattern(std::string patternName, BezierPattern pattern);
+    void addPattern(std::string patternName, BezierPattern pattern, std::string contentHash = "");
+    void removePattern(std::string patternName);
+    std::map<std::string, std::string> getPatternHashes();
     void setMultiplier(std::vector<uint16_t> multiplier);
 
     void flashAll(uint8_t times, uint16_t duration);
@@ -9,15 +9,19 @@
 // #include <esp_task_wdt.h>
 #include <numeric>
 
+// Message type of acknowledgements, same as FaderPlayback::COMMAND_ACK
+#define ACK_MESSAGE_TYPE 255
+
 class WebSocketsCommander {
 public:
-    WebSocketsCommander(const char* ssid, const char* password, bool (*onEvent)(JsonDocument& json), BaseType_t core);
+    WebSocketsCommander(const char* ssid, const char* password, bool (*onEvent)(JsonDocument& json, JsonDocument& reply), bool (*onBinary)(const uint8_t* data, size_t len, JsonDocument& reply), BaseType_t core);
     void init();
 
 private:
     const char* ssid;
     const char* password;
-    bool (*onEvent)(JsonDocument& json);
+    bool (*onEvent)(JsonDocument& json, JsonDocument& reply);
+    bool (*onBinary)(const uint8_t* data, size_t len, JsonDocument& reply);
     BaseType_t core;
     AsyncWebServer server;
     AsyncWebSocket ws;
@@ -27,7 +31,9 @@ private:
     static void WiFiEvent(WiFiEvent_t event);
     // static void listenForConnectionsTask(void* pvParameters);
     // void listenForConnections();
-    uint8_t handleWebSocketMessage(AwsFrameInfo *info, uint8_t *data, size_t len);
+    void sendReply(AsyncWebSocketClient *client, JsonDocument &reply);
+    void sendNack(AsyncWebSocketClient *client);
+    uint8_t handleWebSocketMessage(AsyncWebSocketClient *client, AwsFrameInfo *info, uint8_t *data, size_t len);
     void onWebSocketEvent(AsyncWebSocket *server, AsyncWebSocketClient *client, AwsEventType type, void *arg, uint8_t *data, size_t len);
     static WebSocketsCommander* instance; // Singleton instance
 };
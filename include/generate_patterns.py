@@ -1,51 +1,298 @@
+import glob
+import os
+import sys
+import time
+from argparse import ArgumentParser
 from random import randint
+
 import numpy as np
 
-def list_of_arrays_to_cpp_file(arrays, filename):
+# the pattern compiler and codec live with the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "keyboardclient"))
+
+COMPRESSIONS = [None, "rle", "delta-rle"]
+# FADER_PATTERNS_COMPRESSION in the header, the index into COMPRESSIONS
+MAX_RUN = 0x7FFF  # runs are counted in an int16_t like the values
+ITEMS_PER_LINE = 32
+
+# "0" .. "65535", so formatting a table is a list lookup per value rather
+# than a str() of a numpy scalar
+_DECIMALS = [str(value) for value in range(1 << 16)]
+_SIGNED_DECIMALS = [str(value - (1 << 16) if value >= 1 << 15 else value) for value in range(1 << 16)]
+_HEX_BYTES = [f"0x{value:02x}" for value in range(256)]
+
+
+def format_values(values, per_line=ITEMS_PER_LINE, indent="    ", signed=False, braces=False):
+    """
+    The comma separated lines of a C array initializer for a flat array of
+    16 bit values or bytes, each line in braces if braces. Values are
+    formatted through lookup tables in a few joins over the whole array.
+    """
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        strings = list(map(_HEX_BYTES.__getitem__, bytes(values)))
+    else:
+        values = np.asarray(values).ravel()
+        table = _SIGNED_DECIMALS if signed else _DECIMALS
+        strings = list(map(table.__getitem__, values.astype(np.uint16).tolist()))
+    lines = [", ".join(strings[i:i + per_line]) for i in range(0, len(strings), per_line)]
+    if braces:
+        return "".join(f"{indent}{{{line}}},\n" for line in lines)
+    return "".join(f"{indent}{line},\n" for line in lines)
+
+
+def compress_rle(array):
+    """
+    Runs of identical frames, as int16_t: per run, its length and then the
+    frame. Runs are split at MAX_RUN.
+    """
+    return _runs(array.astype(np.int16))
+
+
+def compress_delta_rle(array):
+    """
+    Runs of identical steps between frames, as int16_t: per run, its length
+    and then the step added to the previous frame for each frame of the run,
+    starting from all zeros. A fade is a handful of runs, a hold one.
+    """
+    deltas = np.diff(array.astype(np.int16), axis=0, prepend=np.zeros((1, array.shape[1]), dtype=np.int16))
+    return _runs(deltas)
+
+
+def _runs(rows):
+    if not len(rows):
+        return np.empty(0, dtype=np.int16)
+    starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]).any(axis=1)])
+    lengths = np.diff(np.r_[starts, len(rows)])
+    # split runs longer than MAX_RUN
+    pieces = -(-lengths // MAX_RUN)
+    run_starts = np.repeat(starts, pieces) + (np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)) * MAX_RUN
+    run_lengths = np.minimum(np.diff(np.r_[run_starts, len(rows)]), MAX_RUN)
+    out = np.empty((len(run_starts), rows.shape[1] + 1), dtype=np.int16)
+    out[:, 0] = run_lengths
+    out[:, 1:] = rows[run_starts]
+    return out.ravel()
+
+
+def decompress(data, outputs, compression):
+    """
+    Reference decoder for compress_rle and compress_delta_rle, what
+    faderPatternNextFrame in the header does a frame at a time.
+    """
+    runs = np.asarray(data, dtype=np.int16).reshape(-1, outputs + 1)
+    rows = np.repeat(runs[:, 1:], runs[:, 0], axis=0)
+    if compression == "delta-rle":
+        rows = np.cumsum(rows, axis=0, dtype=np.int16)
+    return rows.astype(np.uint16)
+
+
+# Sequential decoder for compressed tables, emitted into the header.
+DECODER = """\
+// Decode a compressed pattern a frame at a time:
+//   FaderPatternCursor cursor;
+//   faderPatternReset(&cursor, FADER_PATTERNS[i]);
+//   for each of FADER_PATTERN_LENGTHS[i] frames: faderPatternNextFrame(&cursor, frame);
+// frame holds FADER_PATTERN_OUTPUTS_NUM values and must start as the
+// previous frame (all zeros for the first) with delta-rle.
+struct FaderPatternCursor {
+    const int16_t *next;
+    const int16_t *run;
+    int16_t runLeft;
+};
+
+static inline void faderPatternReset(FaderPatternCursor *cursor, const int16_t *pattern) {
+    cursor->next = pattern;
+    cursor->run = nullptr;
+    cursor->runLeft = 0;
+}
+
+static inline void faderPatternNextFrame(FaderPatternCursor *cursor, uint16_t *frame) {
+    if (cursor->runLeft == 0) {
+        cursor->runLeft = cursor->next[0];
+        cursor->run = cursor->next + 1;
+        cursor->next += FADER_PATTERN_OUTPUTS_NUM + 1;
+    }
+    cursor->runLeft--;
+    for (int i = 0; i < FADER_PATTERN_OUTPUTS_NUM; i++) {
+#if FADER_PATTERNS_COMPRESSION == 2
+        frame[i] += cursor->run[i];
+#else
+        frame[i] = cursor->run[i];
+#endif
+    }
+}
+
+"""
+
+
+def list_of_arrays_to_cpp_file(arrays, filename, compression=None, names=None):
+    """
+    Write (frames, outputs) arrays of output values to a header of flash
+    resident tables, FADER_PATTERN_n, uncompressed as [frames][outputs]
+    uint16_t or as an int16_t stream for the decoder in the header.
+    Returns the header's size and the bytes of flash its tables take.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
     num_patterns = len(arrays)
     num_outputs = arrays[0].shape[1]
-    
-    VALUE_TYPE = "uint16_t"
-    with open(filename, 'w') as f:
-        f.write("#ifndef FADER_PATTERNS_H\n")
-        f.write("#define FADER_PATTERNS_H\n\n")
-        f.write("#include <cstdlib>\n\n")
-        f.write("// Define constants\n")
-        f.write(f"#define FADER_PATTERNS_NUM {num_patterns}\n")
-        f.write(f"#define FADER_PATTERN_OUTPUTS_NUM {num_outputs}\n\n")
-        
-        for i, array in enumerate(arrays):
-            f.write(f"static const {VALUE_TYPE} FADER_PATTERN_{i+1}[][FADER_PATTERN_OUTPUTS_NUM] = {{\n")
-            for row in array:
-                row_str = ", ".join(map(str, row))
-                f.write(f"    {{{row_str}}},\n")
-            f.write("};\n\n")
-        
-        f.write("// Create array PATTERNS containing all patterns\n")
-        f.write(f"static const {VALUE_TYPE}* const FADER_PATTERNS[] = {{\n")
-        for i in range(num_patterns):
-            f.write(f"    (const {VALUE_TYPE}* const)FADER_PATTERN_{i+1},\n")
-        f.write("};\n\n")
-
-        f.write("// Create array indicating the length of each pattern\n")
-        f.write(f"static const {VALUE_TYPE} FADER_PATTERN_LENGTHS[FADER_PATTERNS_NUM] = {{\n")
-        f.write(f"    {', '.join([str(len(array)) for array in arrays])},\n")
-        f.write("};\n\n")
-
-        f.write("// Create array FADER_FRAME_ZEROES\n")
-        f.write(f"static const {VALUE_TYPE} FADER_FRAME_ZEROES[FADER_PATTERN_OUTPUTS_NUM] = {{\n")
-        f.write(f"    {', '.join(['0'] * num_outputs)},\n")
-        f.write("};\n\n")
-
-        f.write("#endif // FADER_PATTERNS_H\n")
-# Example usage
-if __name__ == "__main__":
-    # Create a list of numpy arrays with random values
-    # arrays = [
-    #     np.random.randint(0, 4095, size=(randint(3,10), 16))
-    #     for i in range(randint(2, 8))
-    # ]
 
+    value_type = "uint16_t" if compression is None else "int16_t"
+    out = [
+        "#ifndef FADER_PATTERNS_H\n",
+        "#define FADER_PATTERNS_H\n\n",
+        "#include <cstdint>\n",
+        "#include <cstdlib>\n\n",
+        "// Define constants\n",
+        f"#define FADER_PATTERNS_NUM {num_patterns}\n",
+        f"#define FADER_PATTERN_OUTPUTS_NUM {num_outputs}\n",
+        f"#define FADER_PATTERNS_COMPRESSION {COMPRESSIONS.index(compression)} // {compression or 'none'}\n\n",
+    ]
+
+    sizes = []
+    for i, array in enumerate(arrays):
+        if names is not None:
+            out.append(f"// {names[i]}\n")
+        if compression is None:
+            out.append(f"static const {value_type} FADER_PATTERN_{i+1}[][FADER_PATTERN_OUTPUTS_NUM] = {{\n")
+            out.append(format_values(array, per_line=num_outputs, braces=True))
+            sizes.append(array.size)
+        else:
+            data = compress_rle(array) if compression == "rle" else compress_delta_rle(array)
+            out.append(f"static const {value_type} FADER_PATTERN_{i+1}[] = {{\n")
+            out.append(format_values(data, per_line=num_outputs + 1, signed=True))
+            sizes.append(len(data))
+        out.append("};\n\n")
+
+    out.append("// Create array PATTERNS containing all patterns\n")
+    out.append(f"static const {value_type}* const FADER_PATTERNS[] = {{\n")
+    out.extend(f"    (const {value_type}* const)FADER_PATTERN_{i+1},\n" for i in range(num_patterns))
+    out.append("};\n\n")
+
+    out.append("// Create array indicating the length of each pattern, in frames\n")
+    out.append("static const uint32_t FADER_PATTERN_LENGTHS[FADER_PATTERNS_NUM] = {\n")
+    out.append(f"    {', '.join(str(len(array)) for array in arrays)},\n")
+    out.append("};\n\n")
+
+    out.append(f"// and the number of {value_type} values in each table\n")
+    out.append("static const uint32_t FADER_PATTERN_SIZES[FADER_PATTERNS_NUM] = {\n")
+    out.append(f"    {', '.join(map(str, sizes))},\n")
+    out.append("};\n\n")
+
+    out.append("// Create array FADER_FRAME_ZEROES\n")
+    out.append("static const uint16_t FADER_FRAME_ZEROES[FADER_PATTERN_OUTPUTS_NUM] = {\n")
+    out.append(f"    {', '.join(['0'] * num_outputs)},\n")
+    out.append("};\n\n")
+
+    if compression is not None:
+        out.append(DECODER)
+    out.append("#endif // FADER_PATTERNS_H\n")
+
+    text = "".join(out)
+    with open(filename, "w") as f:
+        f.write(text)
+    return len(text), 2 * sum(sizes)
+
+
+def patterns_to_baked_file(patterns, filename):
+    """
+    Write patterns in the binary pattern format (pattern_codec.py), with
+    their content hashes, to a header the firmware loads at boot. The client
+    then finds them already on the controller and skips uploading them.
+    Returns the header's size and the bytes of flash the patterns take.
+    """
+    from pattern_codec import encode_pattern
+    from pattern_sync import pattern_hash
+
+    blobs = [encode_pattern(pattern, content_hash=pattern_hash(pattern)) for pattern in patterns]
+    out = [
+        "#ifndef BAKED_PATTERNS_H\n",
+        "#define BAKED_PATTERNS_H\n\n",
+        "#include <cstddef>\n",
+        "#include <cstdint>\n\n",
+        "// Patterns in the binary pattern format, added by main.cpp at boot\n",
+        f"#define BAKED_PATTERNS_NUM {len(blobs)}\n\n",
+    ]
+    for i, (pattern, blob) in enumerate(zip(patterns, blobs)):
+        out.append(f"// {pattern['name']}\n")
+        out.append(f"static const uint8_t BAKED_PATTERN_{i+1}[] = {{\n")
+        out.append(format_values(blob))
+        out.append("};\n\n")
+
+    out.append("static const uint8_t* const BAKED_PATTERNS[BAKED_PATTERNS_NUM] = {\n")
+    out.extend(f"    BAKED_PATTERN_{i+1},\n" for i in range(len(blobs)))
+    out.append("};\n\n")
+    out.append("static const size_t BAKED_PATTERN_SIZES[BAKED_PATTERNS_NUM] = {\n")
+    out.append(f"    {', '.join(str(len(blob)) for blob in blobs)},\n")
+    out.append("};\n\n")
+    out.append("#endif // BAKED_PATTERNS_H\n")
+
+    text = "".join(out)
+    with open(filename, "w") as f:
+        f.write(text)
+    return len(text), sum(map(len, blobs))
+
+
+def render_patterns(patterns, frame_interval_us=None):
+    # each pattern's output values over one play through, a frame per frame_interval_us
+    from playback import FRAME_INTERVAL_US
+    from renderer import PatternRenderer
+
+    frame_interval = (frame_interval_us or FRAME_INTERVAL_US) / 1000000.0
+    arrays = []
+    for pattern in patterns:
+        renderer = PatternRenderer(pattern)
+        arrays.append(renderer.sample(np.arange(0, max(renderer.duration, frame_interval), frame_interval)))
+    return arrays
+
+
+def load_patterns(filepath, all_channels=False):
+    from als import CHANNEL_ORDER, compile_patterns
+    return compile_patterns(filepath, channel_order=None if all_channels else CHANNEL_ORDER)
+
+
+def report(filepaths, output_dir, all_channels=False):
+    """
+    For each set: how long it takes to compile, render and write each
+    header, how big the header is and how much flash it takes. Sets without
+    the usual channel names get all their channels, marked with a *.
+    """
+    print(
+        f"{'set':<20} {'patterns':>8} {'compile':>8} {'render':>7} "
+        + " ".join(f"{'table ' + (compression or 'none') + ' header/flash':>30}" for compression in COMPRESSIONS)
+        + f" {'baked header/flash':>26}"
+    )
+    for filepath in filepaths:
+        name = os.path.basename(filepath)
+        start = time.perf_counter()
+        try:
+            patterns = load_patterns(filepath, all_channels)
+        except KeyError:
+            name += "*"
+            start = time.perf_counter()
+            patterns = load_patterns(filepath, True)
+        compile_time = time.perf_counter() - start
+        if not patterns:
+            print(f"{name:<20} {0:>8}")
+            continue
+        start = time.perf_counter()
+        arrays = render_patterns(patterns)
+        render_time = time.perf_counter() - start
+
+        columns = []
+        for compression in COMPRESSIONS:
+            start = time.perf_counter()
+            size, flash = list_of_arrays_to_cpp_file(arrays, os.path.join(output_dir, "FaderPatterns.h"), compression)
+            columns.append(f"{size / 1024:>8.0f}KiB {flash / 1024:>7.0f}KiB {(time.perf_counter() - start) * 1000:>6.0f}ms")
+        start = time.perf_counter()
+        size, flash = patterns_to_baked_file(patterns, os.path.join(output_dir, "BakedPatterns.h"))
+        columns.append(f"{size / 1024:>8.1f}KiB {flash / 1024:>5.1f}KiB {(time.perf_counter() - start) * 1000:>4.0f}ms")
+        print(
+            f"{name:<20} {len(patterns):>8} {compile_time * 1000:>6.0f}ms {render_time * 1000:>5.0f}ms "
+            + " ".join(columns)
+        )
+
+
+def example_arrays():
     arrays = []
     for i in range(10):
         pattern_length = randint(20, 100)
@@ -78,7 +325,7 @@ if __name__ == "__main__":
     second_four_fade = np.linspace(4095, 0, 20, dtype=np.uint16)
     second_four_fade = np.array([second_four_fade for i in range(4)]).T.astype(np.uint16)
     second_four_fade = np.concatenate((np.zeros((20, 4), dtype=np.uint16), second_four_fade, np.zeros((20, 8), dtype=np.uint16)), axis=1)
-    arrays.append(second_four_fade)    
+    arrays.append(second_four_fade)
 
     # Create a strobe pattern
     strobe_pattern_on = np.full((30, 16), 4095, dtype=np.uint16)
@@ -87,5 +334,46 @@ if __name__ == "__main__":
 
     # Add the strobe pattern to the list of arrays
     arrays.append(strobe_pattern)
-    # Convert the list of numpy arrays to a C++ file
-    list_of_arrays_to_cpp_file(arrays, "FaderPatterns.h")
+    return arrays
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generate flash resident pattern headers for the firmware")
+    parser.add_argument("--all-channels", action="store_true", help="every macro envelope in the set, for sets with their own channel names")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    baked_parser = subparsers.add_parser("baked", help="a set's patterns in the binary format, loaded by the firmware at boot")
+    baked_parser.add_argument("als")
+    baked_parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "BakedPatterns.h"))
+    tables_parser = subparsers.add_parser("tables", help="a set's patterns rendered to tables of output values")
+    tables_parser.add_argument("als")
+    tables_parser.add_argument("--compression", choices=["none", "rle", "delta-rle"], default="delta-rle")
+    tables_parser.add_argument("--frame-ms", type=float, help="time between frames, the firmware's frame interval by default")
+    tables_parser.add_argument("--output", default="FaderPatterns.h")
+    example_parser = subparsers.add_parser("example", help="tables of test fades and strobes")
+    example_parser.add_argument("--compression", choices=["none", "rle", "delta-rle"], default="none")
+    example_parser.add_argument("--output", default="FaderPatterns.h")
+    report_parser = subparsers.add_parser("report", help="generation time and header sizes for each set")
+    report_parser.add_argument("als", nargs="*", default=sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "keyboardclient", "data", "*.als"))))
+    report_parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        report(args.als, args.output_dir, args.all_channels)
+        exit()
+
+    start = time.perf_counter()
+    if args.command == "example":
+        patterns, arrays = None, example_arrays()
+    else:
+        patterns = load_patterns(args.als, args.all_channels)
+    if args.command == "baked":
+        size, flash = patterns_to_baked_file(patterns, args.output)
+    else:
+        if patterns is not None:
+            arrays = render_patterns(patterns, args.frame_ms * 1000 if args.frame_ms else None)
+        compression = None if args.compression == "none" else args.compression
+        size, flash = list_of_arrays_to_cpp_file(arrays, args.output, compression, names=[p["name"] for p in patterns] if patterns else None)
+    print(
+        f"Wrote {len(patterns or arrays)} patterns to {args.output}, {size / 1024:.1f}KiB "
+        f"({flash / 1024:.1f}KiB of flash), in {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
@@ -4,6 +4,23 @@ import re
 from sys import argv
 from lxml import etree as ET
 import logging
+import numpy as np
+
+CHANNEL_ORDER = [
+    "T1L0","T1L1","T1L2","T1L3",
+    "T2L0","T2L1","T2L2","T2L3",
+
+    "R0","R1","R2","R3",
+    "EO","E1","E2","E3",
+
+    "G0","G1","G2","G3",
+    "B0","B1","B2","B3",
+
+    "W0","W1","W2","W3",
+    "W4","W5","W6","W7"
+]
+EXCLUDED_PATTERNS = ["s1", "long1", "long2", "strobetreeboth"]
+ROUNDING = 2
 
 def load_als(filepath):
     # with gzip.open(filepath, "r") as xml:
@@ -16,6 +33,10 @@ def load_als(filepath):
     return root
 
 def get_tempo(root: ET.Element):
+    # the master track's tempo has a Manual value, scenes have a Tempo Value of their own
+    master = next((x for x in root.iter('Tempo') if x.find('Manual') is not None), None)
+    if master is not None:
+        return float(master.find('Manual').get('Value'))
     tempo = next(x for x in root.findall('.//Tempo') if x.get('Value'))
     return float(tempo.get('Value'))
 
@@ -62,89 +83,362 @@ def extract_macro_mappings(root):
     return macro_mappings
 
 def read_envelopes(root):
-    pointee_envelopes = {}
-    envelopes = list(root.iter("AutomationEnvelope"))
-    pointee_envelopes = {
-        int(envelope.find("EnvelopeTarget").find("PointeeId").get("Value")): [e.attrib for e in envelope.find("Automation").find("Events").findall("*")]
-        for envelope in envelopes
-        if envelope is not None
+    return {
+        int(envelope.find("EnvelopeTarget").find("PointeeId").get("Value")): read_events(envelope.find("Automation").find("Events"))
+        for envelope in root.iter("AutomationEnvelope")
     }
 
-    # convert all values to floats
-    pointee_envelopes = {
-        pointee: [{
-            k: float(v) 
-            for k, v in event.items() 
-            if k in ["Time", "Value", "CurveControl1X", "CurveControl1Y", "CurveControl2X", "CurveControl2Y"]
-            }
-            for event in envelope
-        ]
-        for pointee, envelope in pointee_envelopes.items()
-    }
+# the columns of an envelope array
+EVENT_KEYS = ["Time", "Value", "CurveControl1X", "CurveControl1Y", "CurveControl2X", "CurveControl2Y"]
+TIME, VALUE, CONTROLS = 0, 1, slice(2, 6)
+
+def read_events(events_element):
+    """
+    An envelope's events as an (events, 6) float array of the EVENT_KEYS
+    columns. Events without curve controls have NaN in those columns, and
+    curved events missing one of them have 0.
+    """
+    events = list(events_element.iterchildren())
+    envelope = np.full((len(events), len(EVENT_KEYS)), np.nan)
+    if events:
+        # numpy parses the attribute strings as it fills the columns
+        envelope[:, TIME] = [event.get("Time") for event in events]
+        envelope[:, VALUE] = [event.get("Value") for event in events]
+        curved = [i for i, event in enumerate(events) if event.get("CurveControl1X") is not None]
+        if curved:
+            envelope[curved, CONTROLS] = [[events[i].get(key, 0) for key in EVENT_KEYS[CONTROLS]] for i in curved]
+    return envelope
+
+def ramp_seconds(beats, tempo, slope):
+    """
+    Seconds taken by beats from a tempo changing by slope BPM per beat: the
+    integral of 60 / (tempo + slope * b), which is 60 * beats / tempo when
+    the tempo holds.
+    """
+    beats, tempo, slope = np.broadcast_arrays(beats, tempo, slope)
+    seconds = np.array(60 * beats / tempo)
+    ramped = slope != 0
+    seconds[ramped] = 60 / slope[ramped] * np.log1p(slope[ramped] * beats[ramped] / tempo[ramped])
+    return seconds
+
+class TempoMap:
+    """
+    Song time in beats to seconds, from the master tempo and its automation
+    envelope. Live ramps the tempo linearly in beats between automation
+    events, so the seconds up to each event are summed once, and seconds()
+    converts any number of times with a searchsorted and the closed form
+    over the segment each lands in. Curved ramps are taken as straight.
+    """
+    def __init__(self, tempo, envelope=None):
+        beats, tempos = np.zeros(1), np.array([float(tempo)])
+        if envelope is not None and len(envelope):
+            times, values = envelope[:, TIME], envelope[:, VALUE]
+            # the tempo at the song start is held by an event long before it
+            before = times <= 0
+            start_tempo = values[before][-1] if before.any() else values[0]
+            beats = np.r_[0.0, times[~before]]
+            tempos = np.r_[start_tempo, values[~before]]
+        self.beats = beats
+        self.tempos = tempos
+        # BPM per beat over each segment, 0 after the last event and for steps
+        widths = np.diff(beats)
+        ramps = np.flatnonzero(widths > 0)
+        self.slopes = np.zeros(len(beats))
+        self.slopes[ramps] = (tempos[ramps + 1] - tempos[ramps]) / widths[ramps]
+        self.start_seconds = np.r_[0.0, np.cumsum(ramp_seconds(widths, tempos[:-1], self.slopes[:-1]))]
+
+    @property
+    def constant_tempo(self):
+        # the tempo throughout, or None if it changes
+        return float(self.tempos[0]) if np.all(self.tempos == self.tempos[0]) else None
+
+    def seconds(self, beats):
+        beats = np.asarray(beats, dtype=np.float64)
+        segment = np.maximum(np.searchsorted(self.beats, beats, side="right") - 1, 0)
+        # before beat 0 the starting tempo holds
+        slopes = np.where(beats < 0, 0, self.slopes[segment])
+        return self.start_seconds[segment] + ramp_seconds(beats - self.beats[segment], self.tempos[segment], slopes)
+
+    def envelope_seconds(self, envelope):
+        # a copy of an envelope array with its times in seconds
+        converted = envelope.copy()
+        converted[:, TIME] = self.seconds(envelope[:, TIME])
+        return converted
+
+    def __str__(self):
+        if self.constant_tempo is not None:
+            return f"{self.constant_tempo:g} BPM"
+        return f"{self.tempos.min():g}-{self.tempos.max():g} BPM over {len(self.tempos)} tempo events"
+
+MAX_MACRO_CONTROLS = 16
+# containers that are no longer needed once their end tag has been parsed
+CLEARABLE_TAGS = ["Locator", "AutomationEnvelope", "Devices", "AudioTrack", "MidiTrack", "GroupTrack", "ReturnTrack"]
+STREAM_TAGS = CLEARABLE_TAGS + ["Tempo"] + [
+    f"{prefix}.{i}" for prefix in ["MacroControls", "MacroDisplayNames"] for i in range(MAX_MACRO_CONTROLS)
+]
+
+def macro_mapping(controls_element, display_name_element):
+    if controls_element is None or display_name_element is None:
+        return None
+    display_name = display_name_element.get('Value')
+    automation_target_element = controls_element.find('AutomationTarget')
+    if automation_target_element is None:
+        return None
+    pointee_id = int(automation_target_element.get('Id'))
+    if display_name and pointee_id:
+        return display_name, pointee_id
+    return None
+
+def extract_als(filepath):
+    """
+    Collect the tempo map, locators, macro name -> pointee mappings and
+    automation envelopes from an ALS file in a single streaming pass.
+
+    Returns a TempoMap of the master tempo and its automation, then the same
+    data as find_locators, extract_macro_mappings and read_envelopes without
+    keeping the whole tree: only the tags we need are reported by the
+    parser, and finished containers are cleared as we go.
+    """
+    tempo = None
+    master_tempo = None
+    tempo_pointee = None
+    locators = []
+    pointee_envelopes = {}
+    # MacroControls element -> document position, so mappings keep the order extract_macro_mappings gives
+    macro_positions = {}
+    macro_found = []
+
+    with gzip.open(filepath, "r") as xml:
+        for _, element in ET.iterparse(xml, tag=STREAM_TAGS):
+            tag = element.tag
+            if tag == "AutomationEnvelope":
+                pointee = int(element.find("EnvelopeTarget").find("PointeeId").get("Value"))
+                pointee_envelopes[pointee] = read_events(element.find("Automation").find("Events"))
+            elif tag == "Locator":
+                locator_name = element.find('.//Name').get('Value')
+                locator_time = float(element.find('.//Time').get('Value'))
+                locators.append((locator_name, locator_time))
+            elif tag == "Tempo":
+                manual = element.find("Manual")
+                if master_tempo is None and manual is not None:
+                    # the master track's, as get_tempo finds it
+                    master_tempo = float(manual.get("Value"))
+                    target = element.find("AutomationTarget")
+                    tempo_pointee = int(target.get("Id")) if target is not None else None
+                elif tempo is None and element.get('Value'):
+                    tempo = float(element.get('Value'))
+                continue
+            elif tag.startswith("Macro"):
+                # MacroControls.N and MacroDisplayNames.N are siblings, map them once both have been parsed
+                kind, macro_number = tag.split(".")
+                parent = element.getparent()
+                if kind == "MacroControls":
+                    macro_positions[element] = len(macro_positions)
+                    controls_element = element
+                    display_name_element = parent.find(f"MacroDisplayNames.{macro_number}")
+                else:
+                    controls_element = parent.find(f"MacroControls.{macro_number}")
+                    display_name_element = element
+                mapping = macro_mapping(controls_element, display_name_element)
+                if mapping:
+                    macro_found.append((macro_positions[controls_element], *mapping))
+                continue
+
+            element.clear(keep_tail=True)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+    if master_tempo is not None:
+        tempo_map = TempoMap(master_tempo, pointee_envelopes.get(tempo_pointee))
+    elif tempo is not None:
+        tempo_map = TempoMap(tempo)
+    else:
+        raise ValueError(f"No tempo found in {filepath}")
 
-    return pointee_envelopes
+    macro_mappings = {}
+    for _, display_name, pointee_id in sorted(macro_found):
+        macro_mappings[display_name] = pointee_id
+    return tempo_map, sorted(locators, key=lambda x: x[1]), macro_mappings, pointee_envelopes
 
 def cut_envelope(envelope, start_time, end_time):
-    # logging.debug(f"Cutting envelope {envelope} from {start_time} to {end_time}")
-    cut = [
-        (event | { "Time": event["Time"] - start_time})
-        for event in envelope
-        if event["Time"] >= start_time and event["Time"] <= end_time
-    ]
-    
-    while len(cut) > 1 and cut[-2]["Time"] == cut[-1]["Time"]:
-        cut.pop()
+    cut, _ = cut_envelopes(envelope, [start_time], [end_time])
     return cut
 
-def remove_redundant_points(points):
-    if all([p[1] == 0 for p in points]):
-        return []
+def cut_envelopes(envelope, start_times, end_times):
+    """
+    Cut an envelope array at each start and end time, inclusive, with times
+    from the start. Of several events at a cut's last time, only the first
+    is kept. Returns the cuts one after another in a single array, and the
+    offsets of each in it, so they can be sanitised together. The ranges
+    are found with searchsorted, as envelopes come in time order.
+    """
+    times = envelope[:, TIME]
+    start_times = np.asarray(start_times, dtype=np.float64)
+    if np.all(times[1:] >= times[:-1]):
+        first = np.searchsorted(times, start_times, side="left")
+        last = np.searchsorted(times, end_times, side="right")
+        rows = np.concatenate([np.arange(a, b) for a, b in zip(first, last)] + [np.empty(0, dtype=np.intp)])
+        lengths = last - first
+    else:
+        masks = [(times >= start) & (times <= end) for start, end in zip(start_times, end_times)]
+        rows = np.concatenate([np.flatnonzero(mask) for mask in masks] + [np.empty(0, dtype=np.intp)])
+        lengths = np.array([mask.sum() for mask in masks], dtype=np.intp)
+    offsets = np.r_[0, np.cumsum(lengths)]
+    cuts = envelope[rows]
+    cuts[:, TIME] -= np.repeat(start_times, lengths)
+
+    # where each cut's run of events at its last time starts
+    new_time = np.r_[True, cuts[1:, TIME] != cuts[:-1, TIME]]
+    new_time[offsets[:-1][lengths > 0]] = True
+    run_start = np.maximum.accumulate(np.where(new_time, np.arange(len(cuts)), 0))
+    ends = run_start[np.maximum(offsets[1:] - 1, 0)] + 1
+    keep = np.arange(len(cuts)) < np.repeat(ends, lengths)
+    return select_rows(cuts, offsets, keep)
+
+def select_rows(cuts, offsets, keep):
+    # the rows of cuts to keep, and the offsets of each cut after
+    kept = np.r_[0, np.cumsum(keep)]
+    return cuts[keep], kept[offsets]
+
+def remove_redundant_points(cuts, offsets):
+    """
+    Drop the points of each cut between two of the same value, and all of
+    a cut's points if every value is 0.
+    """
+    values = cuts[:, VALUE]
+    cut_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    same = (cut_index[1:] == cut_index[:-1]) & (values[1:] == values[:-1])
+    # a cut's first and last points have nothing before or after them in it, so stay
+    keep = ~(np.r_[False, same] & np.r_[same, False])
+    nonzero = np.bincount(cut_index, weights=values != 0, minlength=len(offsets) - 1) > 0
+    return select_rows(cuts, offsets, keep & nonzero[cut_index])
+
+def round_like_python(values, digits):
+    """
+    round(value, digits) over an array. np.round agrees with it except where
+    a value lands within float error of a half, which round decides on the
+    exact decimal value, so those few go through round itself.
+    """
+    scale = 10.0 ** digits
+    scaled = values * scale
+    rounded = np.round(scaled) / scale
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_half.any():
+        rounded[near_half] = [round(value, digits) for value in values[near_half].tolist()]
+    return rounded
+
+def sanitise_envelope(envelope, tempo, rounding=ROUNDING):
+    return sanitise_envelopes(envelope, np.array([0, len(envelope)]), tempo, rounding)[0]
+
+def sanitise_envelopes(cuts, offsets, tempo, rounding=ROUNDING):
+    """
+    Cuts from cut_envelopes as lists of [time, value(, c1x, c1y, c2x, c2y)]
+    pattern points: times in seconds, values from 0 to 1, all rounded, and
+    whole numbers as ints. Every cut is scaled and rounded in one pass. A
+    tempo of None takes the cut times as seconds already, see TempoMap.
+    """
+    cuts, offsets = select_rows(cuts, offsets, cuts[:, TIME] >= 0)
+    scaled = np.empty_like(cuts)
+    scaled[:, TIME] = cuts[:, TIME] * 60 / tempo if tempo is not None else cuts[:, TIME]
+    scaled[:, VALUE] = cuts[:, VALUE] / 127.0
+    scaled[:, CONTROLS] = cuts[:, CONTROLS]
+    scaled, offsets = remove_redundant_points(round_like_python(scaled, rounding), offsets)
+
+    values = scaled.astype(object)
+    whole = scaled == np.floor(scaled)
+    values[whole] = scaled[whole].astype(np.int64)
+    curved = ~np.isnan(scaled[:, 2])
+    points = [point if curve else point[:2] for point, curve in zip(values.tolist(), curved.tolist())]
+    return [points[a:b] for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+def output_level(value):
+    # what the firmware outputs for a point: 8-bit Vec2.y scaled to 12 bits
+    return int(min(max(value, 0), 1) * 255) * 4095 / 255
+
+def can_merge(points, start, end, tolerance):
+    start_time, start_value = points[start][:2]
+    end_time, end_value = points[end][:2]
+    if end_time <= start_time:
+        return False
+    if any(len(points[i]) != 2 for i in range(start, end)):
+        return False  # never merge across a Bezier segment
+
+    start_level = output_level(start_value)
+    end_level = output_level(end_value)
+    for i in range(start + 1, end):
+        t = (points[i][0] - start_time) / (end_time - start_time)
+        if abs(start_level * (1 - t) + end_level * t - output_level(points[i][1])) > tolerance:
+            return False
+    return True
+
+def drop_hidden_points(points):
+    """
+    Drop points the firmware never samples. Zero-length segments are skipped,
+    so of several points at the same time only the first and last are seen,
+    only the last at the start of the envelope and only the first at its end.
+    """
+    if not points:
+        return points
+    start_time = points[0][0]
+    end_time = points[-1][0]
+    result = []
+    for i, point in enumerate(points):
+        same_as_previous = i > 0 and points[i - 1][0] == point[0]
+        same_as_next = i + 1 < len(points) and points[i + 1][0] == point[0]
+        if same_as_next and (same_as_previous or point[0] == start_time):
+            continue
+        if same_as_previous and point[0] == end_time and point[0] != start_time:
+            continue
+        result.append(point)
+    return result
 
+def simplify_envelope(points, max_error):
+    """
+    Drop points the firmware never samples, then points inside linear runs
+    as long as every dropped point stays within max_error 12-bit output
+    counts of the line that replaces it.
+    """
+    points = drop_hidden_points(points)
     if len(points) <= 2:
-        return points  # No points to remove if there are 2 or fewer points
-
-    result = [points[0]]  # Keep the first point
-    for i in range(1, len(points) - 1):
-        if points[i][1] != points[i-1][1] or points[i][1] != points[i+1][1]:
-            result.append(points[i])
-
-    result.append(points[-1])  # Keep the last point
+        return points
+
+    result = [points[0]]
+    anchor = 0
+    while anchor < len(points) - 1:
+        end = anchor + 1
+        while end + 1 < len(points) and can_merge(points, anchor, end + 1, max_error):
+            end += 1
+        result.append(points[end])
+        anchor = end
     return result
 
-def sanitise_envelope(envelope, tempo):
-    envelope = [event for event in envelope if event["Time"] >= 0]
-    
-    rounding = 2
-    envelope = [[
-        round(event["Time"] * 60 / tempo, rounding),
-        round(event["Value"] / 127.0, rounding),
-        round(event.get("CurveControl1X", 0), rounding),
-        round(event.get("CurveControl1Y", 0), rounding),
-        round(event.get("CurveControl2X", 0), rounding),
-        round(event.get("CurveControl2Y", 0), rounding)
-    ] if "CurveControl1X" in event else [
-        round(event["Time"] * 60 / tempo, rounding),
-        round(event["Value"] / 127.0, rounding),
-    ] for event in envelope
+def simplify_patterns(patterns, max_error):
+    simplified = [
+        {
+            "name": pattern["name"],
+            "data": [simplify_envelope(envelope, max_error) for envelope in pattern["data"]]
+        }
+        for pattern in patterns
     ]
-
-    envelope = [[int(x) if x.is_integer() else x for x in event] for event in envelope]
-
-    envelope = remove_redundant_points(envelope)
-
-    return envelope
+    for before, after in zip(patterns, simplified):
+        values_before, segments_before = patterns_size_info([before])
+        values_after, segments_after = patterns_size_info([after])
+        logging.info(f"Simplified {before['name']}: {segments_before} -> {segments_after} segments, {values_before} -> {values_after} values")
+    values_before, segments_before = patterns_size_info(patterns)
+    values_after, segments_after = patterns_size_info(simplified)
+    logging.info(f"Simplified with max error {max_error}: {segments_before} -> {segments_after} segments, {values_before} -> {values_after} values")
+    return simplified
 
 def patterns_size_info(patterns):
     segments = [s for p in patterns for o in p["data"] for s in o]
     values = [x for s in segments for x in s]
     return (len(values), len(segments))
 
-def generate_patterns(filepath):
-    root = load_als(filepath)
-    tempo = get_tempo(root)
-    logging.info("Found tempo: %d", tempo)
-    pointee_envelopes = read_envelopes(root)
-    name_pointees = extract_macro_mappings(root)
+def compile_patterns(filepath, channel_order=CHANNEL_ORDER, excluded_patterns=EXCLUDED_PATTERNS, rounding=ROUNDING, max_error=None):
+    tempo_map, locators, name_pointees, pointee_envelopes = extract_als(filepath)
+    logging.info(f"Found tempo: {tempo_map}")
 
     name_envelopes = {
         name: pointee_envelopes[pointee]
@@ -152,53 +446,46 @@ def generate_patterns(filepath):
         if pointee in pointee_envelopes
     }
     logging.info(f"Found {len(name_envelopes)} envelopes: {list(name_envelopes.keys())}")
+    if channel_order is None:
+        # every macro envelope in the set, e.g. for sets with their own channel names
+        channel_order = list(name_envelopes)
 
-    locators = find_locators(root)
     logging.debug(f"Found {len(locators)} locators: {locators}")
 
-    patterns = {}
-    for start_locator, end_locator in zip(locators, locators[1:]):
-        start_name = start_locator[0]
-        start_time = start_locator[1]
-        # end_name = end_locator[0]
-        end_time = end_locator[1]
-        logging.debug(f"Cutting pattern {start_name} from {start_time} to {end_time}")
-        patterns[start_name] = {
-            envelope_name: cut_envelope(envelope, start_time, end_time)
-            for envelope_name, envelope in name_envelopes.items()
-        }
-    # print(patterns["pulselowleft"])
-
-    channel_order = [
-        "T1L0","T1L1","T1L2","T1L3",
-        "T2L0","T2L1","T2L2","T2L3",
-
-        "R0","R1","R2","R3",
-        "EO","E1","E2","E3",
-
-        "G0","G1","G2","G3",
-        "B0","B1","B2","B3",
-
-        "W0","W1","W2","W3",
-        "W4","W5","W6","W7"
-    ]
+    # each pattern runs from its locator to the next, and a later locator
+    # with the same name replaces an earlier one
+    pattern_cuts = {}
+    for i, (name, _) in enumerate(locators[:-1]):
+        pattern_cuts[name] = i
+    start_times = [time for _, time in locators[:-1]]
+    end_times = [time for _, time in locators[1:]]
+    tempo = tempo_map.constant_tempo
+    if tempo is None:
+        # with tempo automation, locators and events go to seconds before cutting
+        start_times, end_times = tempo_map.seconds(start_times), tempo_map.seconds(end_times)
+        name_envelopes = {name: tempo_map.envelope_seconds(envelope) for name, envelope in name_envelopes.items()}
+    channel_points = {
+        channel: sanitise_envelopes(*cut_envelopes(name_envelopes[channel], start_times, end_times), tempo, rounding)
+        for channel in channel_order
+    } if pattern_cuts else {}
 
-    # sorted_envs = 
     to_save = [
         {
             "name" : name,
-            "data": [
-                sanitise_envelope(envelopes[c], tempo)
-                for c in channel_order
-            ]
+            "data": [channel_points[c][i] for c in channel_order]
         }
-        for name, envelopes in patterns.items()
+        for name, i in pattern_cuts.items()
+        if name not in excluded_patterns
     ]
-
-    to_save = [x for x in to_save if x["name"] not in ["s1", "long1", "long2", "strobetreeboth"]]
     # to_save = to_save[:20]
     logging.info(f"Loaded {len(to_save)} patterns")
 
+    if max_error is not None:
+        to_save = simplify_patterns(to_save, max_error)
+    return to_save
+
+def generate_patterns(filepath, max_error=None):
+    to_save = compile_patterns(filepath, max_error=max_error)
     json_out = json.dumps(to_save, indent=2)
     open("patterns.json", "w").write(json_out)
     num_values, num_segments = patterns_size_info(to_save)
@@ -210,8 +497,13 @@ def generate_patterns(filepath):
 
 if __name__ == "__main__":
     if len(argv) < 2:
-        logging.error("Usage: python readals.py <filepath>")
+        logging.error("Usage: python readals.py <filepath> [max_error]")
         exit()
 
     filepath = argv[1]
-    print(generate_patterns(filepath))
+    max_error = float(argv[2]) if len(argv) > 2 else None
+    patterns = generate_patterns(filepath, max_error)
+    # only here, as pattern_cost needs the client modules to model playback
+    from pattern_cost import log_cost_report
+    log_cost_report(patterns)
+    print(patterns)
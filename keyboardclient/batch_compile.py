@@ -0,0 +1,174 @@
+import glob
+import json
+import logging
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from als import CHANNEL_ORDER, EXCLUDED_PATTERNS, ROUNDING, compile_patterns, patterns_size_info
+from pattern_cache import cache_key, file_hash
+
+OUTPUT_DIR = "libraries"
+MANIFEST = "manifest.json"
+
+
+def library_name(filepath):
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+def compile_library(filepath, output_path, params):
+    """
+    Compile one set and write it to output_path as a pattern library, the
+    JSON list of patterns the client loads. Sets without the channels in
+    params get every channel they have, as pattern_cost.py --all-channels
+    would. Runs in a worker process, so returns plain stats.
+    """
+    start = time.perf_counter()
+    all_channels = params["channel_order"] is None
+    try:
+        patterns = compile_patterns(filepath, **params)
+    except KeyError:
+        all_channels = True
+        patterns = compile_patterns(filepath, **(params | {"channel_order": None}))
+    compile_time = time.perf_counter() - start
+
+    from pattern_codec import encode_pattern
+    upload_bytes = 0
+    for pattern in patterns:
+        try:
+            upload_bytes += len(encode_pattern(pattern)) + 1
+        except ValueError:
+            upload_bytes = None  # some pattern can only go as JSON
+            break
+
+    data = json.dumps(patterns, separators=(",", ":"))
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    num_values, num_segments = patterns_size_info(patterns)
+    return {
+        "patterns": len(patterns),
+        "all_channels": all_channels,
+        "points": num_segments,
+        "values": num_values,
+        "json_bytes": len(data),
+        "upload_bytes": upload_bytes,
+        "compile_s": compile_time,
+        "total_s": time.perf_counter() - start,
+    }
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning(f"Ignoring unreadable manifest in {output_dir}: {e}")
+        return {}
+
+
+def write_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def batch_compile(filepaths, output_dir=OUTPUT_DIR, params=None, jobs=None, force=False):
+    """
+    Compile each set to output_dir/<name>.json across a process pool,
+    skipping sets whose content and compile parameters match the last run,
+    as recorded in output_dir/manifest.json. The largest files go first so
+    the pool isn't left waiting on one big set at the end. Returns
+    {name: manifest entry}, each with a status of compiled, unchanged or
+    failed.
+    """
+    params = params or {
+        "channel_order": CHANNEL_ORDER,
+        "excluded_patterns": EXCLUDED_PATTERNS,
+        "rounding": ROUNDING,
+        "max_error": None,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = read_manifest(output_dir)
+    results = {}
+    to_compile = []
+    for filepath in sorted(filepaths, key=os.path.getsize, reverse=True):
+        name = library_name(filepath)
+        if name in results:
+            raise ValueError(f"{filepath} would overwrite the {name} library from {results[name]['source']}")
+        output_path = os.path.join(output_dir, f"{name}.json")
+        key = cache_key(file_hash(filepath), params)
+        previous = manifest.get(name, {})
+        if not force and previous.get("key") == key and previous.get("status") != "failed" and os.path.exists(output_path):
+            results[name] = previous | {"status": "unchanged"}
+        else:
+            results[name] = {"source": os.path.abspath(filepath), "output": output_path, "key": key}
+            to_compile.append((name, filepath, output_path))
+
+    jobs = min(jobs or os.cpu_count() or 1, max(len(to_compile), 1))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(compile_library, filepath, output_path, params): name for name, filepath, output_path in to_compile}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name].update(future.result(), status="compiled")
+            except Exception as e:
+                logging.error(f"Could not compile {results[name]['source']}: {e!r}")
+                results[name].update(status="failed", error=repr(e))
+
+    manifest.update(results)
+    write_manifest(output_dir, manifest)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compile a directory of ALS sets into pattern libraries across a process pool")
+    parser.add_argument("paths", nargs="*", default=["data"], help="set.als files or directories of them")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--jobs", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--force", action="store_true", help="compile every set, even unchanged ones")
+    parser.add_argument("--all-channels", action="store_true", help="every macro envelope in each set, for sets with their own channel names")
+    parser.add_argument("--max-error", type=float, help="simplify envelopes, see als.simplify_envelope")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    filepaths = []
+    for path in args.paths:
+        filepaths += sorted(glob.glob(os.path.join(path, "*.als"))) if os.path.isdir(path) else [path]
+    params = {
+        "channel_order": None if args.all_channels else CHANNEL_ORDER,
+        "excluded_patterns": EXCLUDED_PATTERNS,
+        "rounding": ROUNDING,
+        "max_error": args.max_error,
+    }
+
+    start = time.perf_counter()
+    results = batch_compile(filepaths, args.output_dir, params, args.jobs, args.force)
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(results, indent=2))
+        exit()
+
+    print(f"{'library':<20} {'status':<10} {'patterns':>8} {'points':>8} {'JSON KiB':>9} {'upload KiB':>10} {'compile s':>9}")
+    for name, result in sorted(results.items()):
+        if result["status"] == "failed":
+            print(f"{name:<20} {'failed':<10} {result['error']}")
+            continue
+        upload = f"{result['upload_bytes'] / 1024:.1f}" if result["upload_bytes"] is not None else "JSON only"
+        print(
+            f"{name + ('*' if result['all_channels'] else ''):<20} {result['status']:<10} {result['patterns']:>8} "
+            f"{result['points']:>8} {result['json_bytes'] / 1024:>9.1f} {upload:>10} {result['compile_s']:>9.2f}"
+        )
+    compiled = [result for result in results.values() if result["status"] == "compiled"]
+    print(
+        f"{len(compiled)} compiled, {sum(r['status'] == 'unchanged' for r in results.values())} unchanged, "
+        f"{sum(r['status'] == 'failed' for r in results.values())} failed in {elapsed:.2f}s "
+        f"({sum(r['compile_s'] for r in compiled):.2f}s of compiling) to {args.output_dir}"
+        + (", * = all channels" if any(r.get("all_channels") for r in results.values()) else "")
+    )
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fader_client import FaderClient
+from key_control import KeyboardCommander
+from keyboard_client import ServerManager
+
+KEY_UP, KEY_DOWN = 0, 1  # evdev key event values
+
+
+class NullWebSocket:
+    # an open connection that sends nothing anywhere
+    open = True
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def send(self, message):
+        self.messages += 1
+        self.bytes += len(message)
+
+
+async def time_events(keyboard_commander, client, events):
+    """
+    Push key events through KeyboardCommander.handle_key, the command queue
+    and FaderClient.send_command, returning the nanoseconds taken per event.
+    """
+    queue = client.command_queue
+    start = time.perf_counter_ns()
+    for code, state in events:
+        keyboard_commander.handle_key(code, state)
+        while not queue.empty():
+            await client.send_command(await queue.get())
+    return (time.perf_counter_ns() - start) / len(events)
+
+
+async def run_benchmark(args, known_servers_path):
+    server_manager = ServerManager(known_servers_file=known_servers_path)
+    keyboard_commander = KeyboardCommander(server_manager, args.keymap, multipliers_file=args.multipliers)
+    controller = server_manager.controllers[0]
+    client = FaderClient("127.0.0.1", 0, controller.command_queue, patterns=[])
+    client.websocket = NullWebSocket()
+    controller.client = server_manager.clients[controller.name] = client
+
+    # every mapped key pressed and released in turn, like a player running up the keyboard
+    codes = sorted(keyboard_commander.dispatch)
+    events = [(code, state) for code in codes for state in (KEY_DOWN, KEY_UP)]
+    await time_events(keyboard_commander, client, events)  # warm up
+    per_event = [await time_events(keyboard_commander, client, events) for _ in range(args.rounds)]
+    per_event.sort()
+    return {
+        "keys": len(codes),
+        "events": len(events) * args.rounds,
+        "messages": client.websocket.messages,
+        "median_ns": per_event[len(per_event) // 2],
+        "min_ns": per_event[0],
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Per key event cost from evdev keycode to websocket send, with a websocket that discards messages")
+    parser.add_argument("--rounds", type=int, default=200, help="times to run through every mapped key")
+    parser.add_argument("--keymap", default="data/keymap_final.csv")
+    parser.add_argument("--multipliers", default="data/colors_final.csv")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = asyncio.run(run_benchmark(args, os.path.join(tmp, "known_servers.json")))
+    print(
+        f"{results['events']} events over {results['keys']} keys, {results['messages']} messages: "
+        f"median {results['median_ns'] / 1000:.2f}us per event, best {results['min_ns'] / 1000:.2f}us"
+    )
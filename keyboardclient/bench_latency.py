@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import defaultdict, deque
+
+import numpy as np
+
+from common import SERVERS
+from fader_client import FaderClient
+from key_control import KeyboardCommander
+from keyboard_client import ServerManager
+from pattern_cache import PatternCache
+
+# commands sent while connecting or to keep the clock in sync, not in response to keys
+SETUP_COMMANDS = {
+    FaderClient.COMMAND_SET_PATTERNS, FaderClient.COMMAND_ADD_PATTERN, FaderClient.COMMAND_SET_PAUSED,
+    FaderClient.COMMAND_GET_INFO, FaderClient.COMMAND_GET_PATTERNS, FaderClient.COMMAND_REMOVE_PATTERNS,
+    FaderClient.COMMAND_PING,
+}
+STARTUP_TIMEOUT = 30
+DRAIN_TIMEOUT = 10
+KEY_UP, KEY_DOWN = 0, 1  # evdev key event values
+
+
+class LatencyProbe:
+    """
+    Timestamps each command from the key event that queued it to the end of
+    FaderClient.send_command, by wrapping ServerManager.queue_command and
+    FaderClient.send_command. Commands the queue merges or drops are
+    forgotten, so a merged command is timed from its latest key event.
+    """
+
+    def __init__(self, server_manager, target_name="ewctrl"):
+        self.server_manager = server_manager
+        self.controller = next(controller for controller in server_manager.controllers if controller.name == target_name)
+        self.queue = self.controller.command_queue
+        self.injected_ns = None
+        self.pending = defaultdict(deque)  # id(command) -> injection times, oldest first
+        self.sent = []  # (injected, sent) per command, in send order
+        self.queued = 0
+        self.skipped = 0  # for patterns the controller does not hold, so never sent
+
+        queue_command = server_manager.queue_command
+
+        def timed_queue_command(target_name, command):
+            if target_name == "ewctrl":
+                self.queued += 1
+                if self.controller.adapt(command) is None:
+                    self.skipped += 1
+                else:
+                    self.pending[id(command)].append(self.injected_ns)
+            queue_command(target_name, command)
+
+        def forget(command):
+            self.pending[id(command)].popleft()
+
+        server_manager.queue_command = timed_queue_command
+        self.queue.on_discard = forget
+
+        send_command = FaderClient.send_command
+        probe = self
+
+        async def timed_send_command(client, command):
+            await send_command(client, command)
+            injected = probe.pending[id(command)]
+            if injected:
+                probe.sent.append((injected.popleft(), time.monotonic_ns()))
+
+        FaderClient.send_command = timed_send_command
+
+    def inject(self, keyboard_commander, code, state):
+        self.injected_ns = time.monotonic_ns()
+        keyboard_commander.handle_key(code, state)
+
+    def outstanding(self):
+        return sum(len(times) for times in self.pending.values())
+
+
+def summarize(latencies_ns):
+    if not latencies_ns:
+        return None
+    ms = np.array(latencies_ns, dtype=np.float64) / 1e6
+    return {
+        "count": len(ms),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return True
+        time.sleep(0.05)
+    return False
+
+
+async def run_benchmark(args, record_path, known_servers_path):
+    patterns = PatternCache().load(args.als)
+    server_manager = ServerManager(patterns, known_servers_file=known_servers_path)
+    probe = LatencyProbe(server_manager)
+    keyboard_commander = KeyboardCommander(server_manager, args.keymap, multipliers_file=args.multipliers)
+    keys = sorted(
+        code for code, actions in keyboard_commander.dispatch.items()
+        if any(target == "ewctrl" for commands, _ in actions for target, _ in commands)
+    )
+    manager_task = asyncio.create_task(server_manager.run())
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not ("ewctrl" in server_manager.clients and server_manager.clients["ewctrl"].is_connected()):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Could not connect to the stand-in controller")
+        await asyncio.sleep(0.01)
+
+    # the first command is only sent once patterns are synced
+    probe.inject(keyboard_commander, keys[0], KEY_DOWN)
+    probe.inject(keyboard_commander, keys[0], KEY_UP)
+    while probe.outstanding():
+        if time.monotonic() > deadline:
+            raise RuntimeError("Warm-up commands were never sent")
+        await asyncio.sleep(0.01)
+    warmup_sent = len(probe.sent)
+    probe.sent.clear()
+    probe.queued = probe.skipped = 0
+    probe.queue.merged = probe.queue.dropped = 0
+
+    rng = random.Random(args.seed)
+    start_ns = time.monotonic_ns()
+    for _ in range(args.bursts):
+        burst = rng.sample(keys, min(args.burst_size, len(keys)))
+        for key in burst:
+            probe.inject(keyboard_commander, key, KEY_DOWN)
+        await asyncio.sleep(args.hold)
+        for key in burst:
+            probe.inject(keyboard_commander, key, KEY_UP)
+        await asyncio.sleep(args.interval)
+
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while probe.outstanding() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    end_ns = time.monotonic_ns()
+    await asyncio.sleep(0.2)  # let the stand-in record the last arrivals
+    manager_task.cancel()
+
+    with open(record_path) as f:
+        arrivals = [json.loads(line) for line in f]
+    arrivals = [a["t_ns"] for a in arrivals if a["type"] not in SETUP_COMMANDS][warmup_sent:]
+    key_to_send = [sent - injected for injected, sent in probe.sent]
+    # the connection delivers in order, so the nth arrival is the nth command sent
+    key_to_wire = [arrival - injected for (injected, _), arrival in zip(probe.sent, arrivals)] if len(arrivals) == len(probe.sent) else []
+    if not key_to_wire:
+        logging.warning(f"{len(arrivals)} arrivals recorded for {len(probe.sent)} commands sent, skipping key-to-wire")
+
+    elapsed = (end_ns - start_ns) / 1e9
+    return {
+        "config": {
+            "bursts": args.bursts, "burst_size": args.burst_size, "hold_s": args.hold, "interval_s": args.interval,
+            "seed": args.seed, "keymap": args.keymap, "keys": len(keys),
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "time": time.time()},
+        "commands": {
+            "queued": probe.queued, "skipped": probe.skipped, "sent": len(probe.sent), "merged": probe.queue.merged,
+            "dropped": probe.queue.dropped, "unsent": probe.outstanding(),
+        },
+        "throughput_commands_per_s": len(probe.sent) / elapsed if elapsed else 0.0,
+        "key_to_send": summarize(key_to_send),
+        "key_to_wire": summarize(key_to_wire),
+    }
+
+
+def print_results(results):
+    commands = results["commands"]
+    print(
+        f"{commands['queued']} commands queued: {commands['sent']} sent, {commands['skipped']} for patterns not held, {commands['merged']} merged, "
+        f"{commands['dropped']} dropped by a full queue, {commands['unsent']} never sent"
+    )
+    print(f"throughput {results['throughput_commands_per_s']:.1f} commands/s")
+    for stage in ["key_to_send", "key_to_wire"]:
+        stats = results[stage]
+        if stats:
+            print(f"{stage}: p50 {stats['p50_ms']:.3f}ms, p99 {stats['p99_ms']:.3f}ms, max {stats['max_ms']:.3f}ms")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Key event to websocket latency against the servews.py stand-in controller")
+    parser.add_argument("--bursts", type=int, default=200)
+    parser.add_argument("--burst-size", type=int, default=4, help="keys pressed together in each burst")
+    parser.add_argument("--hold", type=float, default=0.02, help="seconds between a burst's key downs and ups")
+    parser.add_argument("--interval", type=float, default=0.03, help="seconds between bursts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keymap", default="data/keymap_final.csv")
+    parser.add_argument("--multipliers", default="data/colors_final.csv")
+    parser.add_argument("--als", default="data/ew4lx_final2.als")
+    parser.add_argument("--output", default="latency_results.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        record_path = os.path.join(tmp, "arrivals.jsonl")
+        known_servers_path = os.path.join(tmp, "known_servers.json")
+        with open(known_servers_path, "w") as f:
+            json.dump({"ewctrl": "127.0.0.1"}, f)
+        stand_in = subprocess.Popen([sys.executable, "servews.py", "--quiet", f"--record={record_path}"])
+        try:
+            if not wait_for_port(SERVERS["ewctrl"], STARTUP_TIMEOUT):
+                raise RuntimeError("Stand-in controller did not start")
+            results = asyncio.run(run_benchmark(args, record_path, known_servers_path))
+        finally:
+            stand_in.terminate()
+            stand_in.wait()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,214 @@
+import asyncio
+import contextlib
+import glob
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from argparse import ArgumentParser
+
+from als import ROUNDING, compile_patterns, cut_envelopes, extract_als, load_als, sanitise_envelopes
+from fader_client import FaderClient
+from multipliers import load_multipliers
+from pattern_codec import FORMAT_VERSION
+from pattern_sync import pattern_manifest
+
+BASELINE_FILE = "bench_baseline.json"
+# a stage this much slower than its baseline fails the run
+THRESHOLD = 0.25
+REPEATS = 5
+KEY_UP, KEY_DOWN = 0, 1  # evdev key event values
+
+
+def best_time(function, repeats=REPEATS):
+    """
+    Seconds per call of function, the fastest of repeats samples. Each
+    sample makes enough calls to take a fifth of a second, so short stages
+    are timed as steadily as long ones.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeats, number=number)) / number
+
+
+def compile_inputs(filepath):
+    """
+    What compile_patterns cuts and sanitises for every macro envelope in a
+    set, so those stages can be timed alone: the envelopes, the pattern
+    start and end times and the tempo, with times in seconds already when
+    the tempo changes.
+    """
+    tempo_map, locators, name_pointees, pointee_envelopes = extract_als(filepath)
+    envelopes = [pointee_envelopes[pointee] for pointee in name_pointees.values() if pointee in pointee_envelopes]
+    start_times = [time for _, time in locators[:-1]]
+    end_times = [time for _, time in locators[1:]]
+    tempo = tempo_map.constant_tempo
+    if tempo is None:
+        start_times, end_times = tempo_map.seconds(start_times), tempo_map.seconds(end_times)
+        envelopes = [tempo_map.envelope_seconds(envelope) for envelope in envelopes]
+    if not start_times:
+        envelopes = []  # no patterns to cut
+    return envelopes, start_times, end_times, tempo
+
+
+def set_stages(filepaths, repeats):
+    # seconds for each stage over every set
+    inputs = [compile_inputs(filepath) for filepath in filepaths]
+    cuts = [
+        [cut_envelopes(envelope, start_times, end_times) for envelope in envelopes]
+        for envelopes, start_times, end_times, _ in inputs
+    ]
+    patterns = [compile_patterns(filepath, channel_order=None) for filepath in filepaths]
+    # sent as add pattern messages, in the newest format
+    client = FaderClient("127.0.0.1", 0, None, patterns=[])
+    client.binary_patterns, client.pattern_format = True, FORMAT_VERSION
+
+    def serialize():
+        for set_patterns in patterns:
+            client.manifest = pattern_manifest(set_patterns)
+            for pattern in set_patterns:
+                client.pattern_message(pattern)
+
+    return {
+        "als_load": best_time(lambda: [load_als(filepath) for filepath in filepaths], repeats),
+        "extract": best_time(lambda: [extract_als(filepath) for filepath in filepaths], repeats),
+        "cut": best_time(lambda: [
+            cut_envelopes(envelope, start_times, end_times)
+            for envelopes, start_times, end_times, _ in inputs for envelope in envelopes
+        ], repeats),
+        "sanitise": best_time(lambda: [
+            sanitise_envelopes(*cut, tempo, ROUNDING)
+            for set_cuts, (_, _, _, tempo) in zip(cuts, inputs) for cut in set_cuts
+        ], repeats),
+        "serialize": best_time(serialize, repeats),
+    }
+
+
+async def dispatch_time(keyboard_commander, rounds):
+    # seconds per key event from handle_key to websocket send, as bench_keymap.py times it
+    from bench_keymap import NullWebSocket, time_events
+    server_manager = keyboard_commander.server_manager
+    controller = server_manager.controllers[0]
+    client = FaderClient("127.0.0.1", 0, controller.command_queue, patterns=[])
+    client.websocket = NullWebSocket()
+    controller.client = server_manager.clients[controller.name] = client
+    events = [(code, state) for code in sorted(keyboard_commander.dispatch) for state in (KEY_DOWN, KEY_UP)]
+    await time_events(keyboard_commander, client, events)  # warm up
+    return min([await time_events(keyboard_commander, client, events) for _ in range(rounds)]) / 1e9
+
+
+async def client_stages(keymap_file, multipliers_file, repeats, rounds):
+    # evdev is only needed from here on
+    from key_control import KeyboardCommander
+    from keyboard_client import ServerManager
+    with tempfile.TemporaryDirectory() as tmp:
+        server_manager = ServerManager(known_servers_file=os.path.join(tmp, "known_servers.json"))
+        with contextlib.redirect_stdout(io.StringIO()):  # it prints the multipliers
+            keyboard_commander = KeyboardCommander(server_manager, keymap_file, multipliers_file=multipliers_file)
+        return {
+            "load_multipliers": best_time(lambda: load_multipliers(multipliers_file), repeats),
+            "keymap": best_time(lambda: keyboard_commander.compile_keymap(keyboard_commander.load_keymap(keymap_file)), repeats),
+            "dispatch": await dispatch_time(keyboard_commander, rounds),
+        }
+
+
+def run_benchmarks(filepaths, keymap_file, multipliers_file, repeats=REPEATS, rounds=200):
+    """
+    Time each stage of getting a show from ALS sets to the controller, in
+    seconds: loading, extracting, cutting, sanitising and serializing every
+    set's patterns, loading the multipliers and keymap, and dispatching one
+    key event.
+    """
+    stages = set_stages(filepaths, repeats)
+    stages.update(asyncio.run(client_stages(keymap_file, multipliers_file, repeats, rounds)))
+    return {
+        "machine": platform.node(),
+        "python": platform.python_version(),
+        "sets": [os.path.basename(filepath) for filepath in filepaths],
+        "stages": stages,
+    }
+
+
+def read_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logging.warning(f"Ignoring unreadable baseline {path}: {e}")
+        return None
+
+
+def write_baseline(path, results):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Each stage's change from the baseline as a fraction, None for stages
+    the baseline lacks, and the stages slower by more than threshold.
+    """
+    changes = {}
+    for stage, seconds in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        changes[stage] = seconds / before - 1 if before else None
+    regressions = [stage for stage, change in changes.items() if change is not None and change > threshold]
+    return changes, regressions
+
+
+def format_time(seconds):
+    return f"{seconds * 1e3:.2f}ms" if seconds >= 1e-3 else f"{seconds * 1e6:.2f}us"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Time each stage from ALS sets to dispatched key events, failing on regressions from a stored baseline")
+    parser.add_argument("paths", nargs="*", default=["data"], help="set.als files or directories of them")
+    parser.add_argument("--keymap", default="data/keymap_final.csv")
+    parser.add_argument("--multipliers", default="data/colors_final.csv")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="samples per stage, the fastest is kept")
+    parser.add_argument("--rounds", type=int, default=200, help="times to run through every mapped key for dispatch")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="fraction slower than the baseline that fails a stage")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    # common.py has already configured logging at INFO, which would log every compile
+    logging.getLogger().setLevel(logging.WARNING)
+    filepaths = []
+    for path in args.paths:
+        filepaths += sorted(glob.glob(os.path.join(path, "*.als"))) if os.path.isdir(path) else [path]
+    results = run_benchmarks(filepaths, args.keymap, args.multipliers, args.repeats, args.rounds)
+    baseline = read_baseline(args.baseline)
+    changes, regressions = compare(results, baseline, args.threshold) if baseline else ({}, [])
+    if baseline and baseline["sets"] != results["sets"]:
+        logging.warning(f"The baseline in {args.baseline} was timed over other sets: {baseline['sets']}")
+    if baseline and baseline["machine"] != results["machine"]:
+        logging.warning(f"The baseline in {args.baseline} was timed on {baseline['machine']}, not {results['machine']}")
+
+    if args.json:
+        print(json.dumps(results | {"changes": changes, "regressions": regressions}, indent=2))
+    else:
+        print(f"{len(filepaths)} sets, best of {args.repeats}" + (f", against {args.baseline}" if baseline else ""))
+        print(f"{'stage':<18} {'time':>10} {'baseline':>10} {'change':>8}")
+        for stage, seconds in results["stages"].items():
+            before = baseline["stages"].get(stage) if baseline else None
+            change = f"{changes[stage]:+.0%}" if changes.get(stage) is not None else ""
+            flag = "  REGRESSED" if stage in regressions else ""
+            print(f"{stage:<18} {format_time(seconds):>10} {format_time(before) if before else '':>10} {change:>8}{flag}")
+        print("dispatch is per key event, every other stage is over all the sets")
+
+    if args.save_baseline:
+        write_baseline(args.baseline, results)
+        if not args.json:
+            print(f"Baseline written to {args.baseline}")
+    elif regressions:
+        logging.error(f"{len(regressions)} stages more than {args.threshold:.0%} slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
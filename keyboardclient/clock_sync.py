@@ -0,0 +1,66 @@
+from collections import deque
+
+HISTORY = 30  # bursts to fit the drift through, about five minutes at FaderClient.CLOCK_SYNC_INTERVAL
+
+
+class ClockSync:
+    """
+    Maps the local clock (time.monotonic, in seconds) to a controller's
+    esp_timer_get_time (microseconds since it booted) from ping/echo
+    exchanges.
+
+    An exchange sent at local time t0 and answered at t2 with the
+    controller's time t1 puts the offset at t1 - (t0 + t2) / 2, wrong by at
+    most half the round trip, so of each burst of exchanges only the one
+    with the shortest round trip is kept. The clocks also drift apart by
+    tens of microseconds a second, so a line is fitted through the bursts
+    kept over the last few minutes.
+    """
+
+    def __init__(self, history=HISTORY):
+        self.burst = []  # (rtt, local time, offset) for each exchange of the current burst
+        self.estimates = deque(maxlen=history)  # (local time, offset) of the best exchange of each burst
+        self.rtt = None  # round trip of the last burst's best exchange, in seconds
+        self.rate = 0.0  # microseconds the offset changes by per local second
+        self.offset = None  # offset at reference_time, in microseconds
+        self.reference_time = None
+
+    def add_exchange(self, sent, controller_time, received):
+        local_time = (sent + received) / 2
+        self.burst.append((received - sent, local_time, controller_time - local_time * 1e6))
+
+    def end_burst(self):
+        """
+        Fold the exchanges since the last call into the estimate, returning
+        whether there were any.
+        """
+        if not self.burst:
+            return False
+        self.rtt, local_time, offset = min(self.burst)
+        self.burst = []
+        self.estimates.append((local_time, offset))
+        self.fit()
+        return True
+
+    def fit(self):
+        # least squares line through the estimates, around their mean to keep the numbers small
+        count = len(self.estimates)
+        mean_time = sum(local_time for local_time, _ in self.estimates) / count
+        mean_offset = sum(offset for _, offset in self.estimates) / count
+        spread = sum((local_time - mean_time) ** 2 for local_time, _ in self.estimates)
+        if spread > 0:
+            self.rate = sum((local_time - mean_time) * (offset - mean_offset) for local_time, offset in self.estimates) / spread
+        self.reference_time = mean_time
+        self.offset = mean_offset
+
+    def is_synced(self):
+        return self.offset is not None
+
+    def to_controller(self, local_time):
+        """
+        The controller's clock reading at local_time, None before the first
+        burst.
+        """
+        if self.offset is None:
+            return None
+        return round(local_time * 1e6 + self.offset + self.rate * (local_time - self.reference_time))
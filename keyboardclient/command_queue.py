@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import deque
+
+from fader_client import FaderClient
+
+
+class CommandQueue:
+    """
+    Queue of commands for a FaderClient, standing in for asyncio.Queue.
+
+    Stop commands go in their own lane, which is sent first and never drops
+    anything. A stop cancels queued starts of the same pattern, since those
+    would otherwise be sent after it, and STOP_ALL cancels every queued start
+    and stop. Only the latest SET_MULTIPLIER, SET_GAIN and absolute SET_SPEED
+    is kept. Relative speed steps ("+"/"-") are kept as they add up. When the
+    other lane is full, the oldest START_PATTERN makes room, or the oldest
+    command if there are none. A command that could not be sent is put back
+    with requeue.
+
+    merged and dropped count commands discarded for each reason. on_discard,
+    if set, is called with every command discarded without being sent.
+    """
+
+    def __init__(self, maxsize=10):
+        self.maxsize = maxsize
+        self.stops = deque()
+        self.commands = deque()
+        self.merged = 0
+        self.dropped = 0
+        self.on_discard = None
+        self.ready = asyncio.Event()
+
+    def qsize(self):
+        return len(self.stops) + len(self.commands)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        # there is always room, something older makes way
+        return False
+
+    @staticmethod
+    def is_state_command(command):
+        command_type, data = command
+        if command_type == FaderClient.COMMAND_SET_SPEED:
+            return data.get("speed") not in ["+", "-"]
+        return command_type in (FaderClient.COMMAND_SET_MULTIPLIER, FaderClient.COMMAND_SET_GAIN)
+
+    def discard(self, lane, predicate):
+        kept = deque()
+        discarded = 0
+        for command in lane:
+            if predicate(command):
+                discarded += 1
+                if self.on_discard is not None:
+                    self.on_discard(command)
+            else:
+                kept.append(command)
+        lane.clear()
+        lane.extend(kept)
+        return discarded
+
+    def put_nowait(self, command):
+        command_type, data = command
+        if command_type == FaderClient.COMMAND_STOP_ALL:
+            self.merged += self.discard(self.commands, lambda c: c[0] == FaderClient.COMMAND_START_PATTERN)
+            self.merged += self.discard(self.stops, lambda c: True)
+            self.stops.append(command)
+        elif command_type == FaderClient.COMMAND_STOP_PATTERN:
+            name = data.get("name")
+            self.merged += self.discard(self.commands, lambda c: c[0] == FaderClient.COMMAND_START_PATTERN and c[1].get("name") == name)
+            if any(c[0] == FaderClient.COMMAND_STOP_ALL or c[1].get("name") == name for c in self.stops):
+                self.merged += 1  # already being stopped
+                if self.on_discard is not None:
+                    self.on_discard(command)
+            else:
+                self.stops.append(command)
+        else:
+            if self.is_state_command(command):
+                self.merged += self.discard(self.commands, lambda c: c[0] == command_type and self.is_state_command(c))
+            if len(self.commands) >= self.maxsize:
+                oldest = next((c for c in self.commands if c[0] == FaderClient.COMMAND_START_PATTERN), self.commands[0])
+                self.commands.remove(oldest)
+                self.dropped += 1
+                logging.warning(f"Command queue full, dropped {oldest}")
+                if self.on_discard is not None:
+                    self.on_discard(oldest)
+            self.commands.append(command)
+        self.ready.set()
+
+    def requeue(self, command):
+        """
+        Put back a command taken with get that could not be sent, at the front
+        of its lane, unless something queued since supersedes it.
+        """
+        command_type, data = command
+        if command_type == FaderClient.COMMAND_STOP_ALL:
+            superseded = any(c[0] == FaderClient.COMMAND_STOP_ALL for c in self.stops)
+            lane = self.stops
+        elif command_type in (FaderClient.COMMAND_STOP_PATTERN, FaderClient.COMMAND_START_PATTERN):
+            # already being stopped
+            superseded = any(c[0] == FaderClient.COMMAND_STOP_ALL or c[1].get("name") == data.get("name") for c in self.stops)
+            lane = self.stops if command_type == FaderClient.COMMAND_STOP_PATTERN else self.commands
+        else:
+            superseded = self.is_state_command(command) and any(c[0] == command_type and self.is_state_command(c) for c in self.commands)
+            lane = self.commands
+        if superseded:
+            self.merged += 1
+            if self.on_discard is not None:
+                self.on_discard(command)
+            return
+        lane.appendleft(command)
+        self.ready.set()
+
+    async def get(self):
+        while self.empty():
+            self.ready.clear()
+            await self.ready.wait()
+        return self.stops.popleft() if self.stops else self.commands.popleft()
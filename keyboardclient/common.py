@@ -1,4 +1,5 @@
 # Ports for different servers
+import asyncio
 import logging
 
 from websockets import WebSocketClientProtocol
@@ -19,6 +20,47 @@ class Commandable:
     def is_connected(self) -> bool:
         raise NotImplementedError("This method should be overridden by subclasses")
 
+    async def read_commands(self):
+        while True:
+            command = await self.command_queue.get()
+            try:
+                await self.send_command(command)
+            except Exception:
+                # the connection dropped, so send it on the next one rather than lose it
+                if hasattr(self.command_queue, "requeue"):
+                    logging.warning(f"Could not send {command} to {self.host}:{self.port}, queued again")
+                    self.command_queue.requeue(command)
+                else:
+                    logging.warning(f"Could not send {command} to {self.host}:{self.port}, dropped")
+                raise
+
+    async def read_replies(self):
+        # keep reading so pongs are processed and unsolicited replies don't pile up
+        async for message in self.websocket:
+            logging.debug(f"Reply from {self.host}:{self.port}: {message[:100]}")
+
+    def connection_tasks(self):
+        # coroutines to run while connected, until any of them ends
+        return [self.read_commands(), self.read_replies()]
+
+    async def serve_connection(self):
+        # send queued commands until the connection drops
+        websocket = self.websocket
+        tasks = [asyncio.create_task(coroutine) for coroutine in self.connection_tasks()]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    logging.error(f"Connection to {self.host}:{self.port} failed: {task.exception()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.websocket = None
+            logging.info(f"Disconnected from {self.host}:{self.port}")
+            # closing a dead link waits out the close timeout, so let the
+            # caller start looking for the server again meanwhile
+            self.close_task = asyncio.create_task(websocket.close())
+
     @staticmethod
     def parse_keymap(self, raw_command: str) -> tuple:
         raise NotImplementedError("This method should be overridden by subclasses")
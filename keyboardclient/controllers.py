@@ -0,0 +1,112 @@
+import json
+import logging
+
+from als import CHANNEL_ORDER
+from command_queue import CommandQueue
+from common import SERVERS
+from fader_client import FaderClient, FaderCommand
+from pattern_cache import PatternCache
+
+CONTROLLERS_FILE = "controllers.json"
+
+
+class Controller:
+    """
+    One fader controller and the part of the show it plays: the channels
+    wired to it, in its output order, and the patterns it holds. Keymap
+    commands are written for all of CHANNEL_ORDER and every pattern, so
+    adapt rewrites or skips them for this controller.
+    """
+
+    def __init__(self, name, patterns, channels=None, controller_id=None, port=SERVERS["ewctrl"]):
+        self.name = name
+        self.patterns = patterns  # None has FaderClient load patterns.json
+        self.pattern_names = {pattern["name"] for pattern in patterns} if patterns is not None else None
+        self.channels = channels
+        # indices into CHANNEL_ORDER of this controller's outputs, None if it has them all
+        if channels is None or list(channels) == CHANNEL_ORDER:
+            self.channel_indices = None
+        else:
+            self.channel_indices = [CHANNEL_ORDER.index(channel) for channel in channels]
+        self.id = controller_id
+        self.port = port
+        self.command_queue = CommandQueue(maxsize=10)
+        self.client = None
+        self.address = None  # claimed while connecting or connected, so no other controller tries it
+        self.connects = 0
+        self.sent = 0  # commands sent over earlier connections
+        self.adapted = {}  # id(keymap command) -> (command, adapted command)
+
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected()
+
+    def adapt(self, command):
+        """
+        The command to send this controller in place of command, or None if
+        it does not concern it. Adapted keymap commands are kept, so they
+        are only serialized once.
+        """
+        command_type, data = command
+        if command_type in (FaderClient.COMMAND_START_PATTERN, FaderClient.COMMAND_STOP_PATTERN):
+            if self.pattern_names is not None and data.get("name") not in self.pattern_names:
+                return None
+            return command
+        if command_type != FaderClient.COMMAND_SET_MULTIPLIER or self.channel_indices is None:
+            return command
+        cached = self.adapted.get(id(command))
+        if cached is not None and cached[0] is command:
+            return cached[1]
+        adapted = FaderCommand(command_type, [data[index] for index in self.channel_indices])
+        if isinstance(command, FaderCommand):
+            self.adapted[id(command)] = (command, adapted)
+        return adapted
+
+    def health(self):
+        client = self.client if self.is_connected() else None
+        # websockets times its keepalive pings, 0 until the first pong
+        latency = getattr(client.websocket, "latency", 0) if client else 0
+        return {
+            "connected": client is not None,
+            "address": client.host if client else None,
+            "id": client.controller_id if client else None,
+            "connects": self.connects,
+            "latency_ms": latency * 1000 if latency else None,
+            "clock_rtt_ms": client.clock.rtt * 1000 if client and client.clock.rtt is not None else None,
+            "sent": self.sent + (self.client.commands_sent if self.client else 0),
+            "queued": self.command_queue.qsize(),
+            "merged": self.command_queue.merged,
+            "dropped": self.command_queue.dropped,
+        }
+
+
+def load_controllers(filename, als_file):
+    """
+    Read the controllers of a rig from a JSON list of
+    {"name", "id", "channels", "als", "patterns", "port"}, where only the
+    name is required:
+      id        what the controller reports in GET_INFO (its MAC address),
+                needed to tell controllers apart once there are several
+      channels  names from CHANNEL_ORDER, in the controller's output order
+      als       the set to compile its patterns from, als_file by default
+      patterns  names of the patterns to hold, all of them by default
+    Without the file, a single controller plays every channel of als_file.
+    """
+    try:
+        with open(filename) as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        entries = [{"name": "ewctrl"}]
+
+    pattern_cache = PatternCache()
+    controllers = []
+    for entry in entries:
+        channels = entry.get("channels", CHANNEL_ORDER)
+        unknown = [channel for channel in channels if channel not in CHANNEL_ORDER]
+        if unknown:
+            raise ValueError(f"Controller {entry['name']} has unknown channels {unknown}")
+        patterns = pattern_cache.load(entry.get("als", als_file), channel_order=channels)
+        if "patterns" in entry:
+            patterns = [pattern for pattern in patterns if pattern["name"] in entry["patterns"]]
+        controllers.append(Controller(entry["name"], patterns, channels, entry.get("id"), entry.get("port", SERVERS["ewctrl"])))
+        logging.info(f"Controller {entry['name']}: {len(channels)} channels, {len(patterns)} patterns")
+    return controllers
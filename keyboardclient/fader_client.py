@@ -1,15 +1,41 @@
 import asyncio
+import itertools
 import json
 import logging
-import threading
 import time
 
 import websockets
+from clock_sync import ClockSync
 from common import Commandable, KeyMapEntry, CustomWebSocketClientProtocol
+from pattern_codec import FORMAT_VERSION, MIN_INDEXED_SEGMENTS, encode_pattern
+from pattern_sync import diff_manifests, pattern_manifest
+from pattern_upload import UPLOAD_WINDOW, PatternUploader, throughput_summary
+
+
+class FaderCommand(tuple):
+    """
+    A (type, data) command that carries its wire message, serialized once when
+    the keymap is loaded instead of every time the key is pressed.
+    """
+
+    def __new__(cls, command_type, command_data):
+        command = super().__new__(cls, (command_type, command_data))
+        command.message = cls.serialize((command_type, command_data))
+        return command
+
+    @staticmethod
+    def serialize(command):
+        command_type, command_data = command
+        return json.dumps({
+            "type": command_type,
+            "data": command_data
+        }).replace(" ", "")
 
 
 class FaderClient(Commandable):
-    COMMAND_ACK = 0
+    # FaderPlayback::COMMAND_ACK, which the firmware has always numbered 255.
+    # Only firmware reporting "pattern_acks" in GET_INFO sends it.
+    COMMAND_ACK = 255
     COMMAND_START_PATTERN = 1
     COMMAND_SET_GAIN = 2
     COMMAND_SET_SPEED = 3
@@ -20,52 +46,47 @@ class FaderClient(Commandable):
     COMMAND_STOP_PATTERN = 8
     COMMAND_STOP_ALL = 9
     COMMAND_SET_PAUSED = 10
+    COMMAND_GET_INFO = 11
+    COMMAND_GET_PATTERNS = 12
+    COMMAND_REMOVE_PATTERNS = 13
+    COMMAND_PING = 14
 
     RETRY_DELAY = 2
+    INFO_TIMEOUT = 1  # controllers that predate COMMAND_GET_INFO never reply
+    MANIFEST_TIMEOUT = 5
+    UNACKED_PATTERN_DELAY = 1  # time to leave controllers that don't acknowledge patterns
+    CLOCK_SYNC_INTERVAL = 10
+    CLOCK_SYNC_EXCHANGES = 8  # pings per burst
+    CLOCK_SYNC_SPACING = 0.05  # between pings, so one delayed packet doesn't hold up the next
+    PING_TIMEOUT = 1
     
-    def __init__(self, host, port, command_queue):
+    def __init__(self, host, port, command_queue, patterns=None, use_binary_patterns=True, upload_window=UPLOAD_WINDOW, expected_id=None, min_indexed_segments=MIN_INDEXED_SEGMENTS):
         self.host = host
         self.port = port
         self.command_queue = command_queue
         self.websocket = None
-        patterns = json.load(open('patterns.json'))
+        self.use_binary_patterns = use_binary_patterns
+        # segment indices for channels with this many segments, see renderer.segment_index. None sends none.
+        self.min_indexed_segments = min_indexed_segments
+        self.binary_patterns = False
+        self.pattern_format = None  # binary format version to send, the newest both ends know
+        self.pattern_acks = False
+        self.pattern_sync = False
+        self.upload_window = upload_window
+        self.expected_id = expected_id  # only talk to the controller reporting this id
+        self.controller_id = None
+        self.commands_sent = 0
+        self.clock_sync = False
+        self.clock = ClockSync()
+        self.pings = {}  # seq -> future for the controller's reply
+        self.ping_seq = itertools.count()
+        if patterns is None:
+            patterns = json.load(open('patterns.json'))
         self.patterns = sorted(patterns, key=lambda x: len(json.dumps(x)))[::-1]
-
-        self.connection_thread = threading.Thread(target=self.manage_connection, daemon=True)
-        self.connection_thread.start()
-
-    async def ws_recv_ack(self):
-        # receive a single byte, 0 means OK, 1 means error & resend
-        if self.websocket is not None and self.websocket.open:
-            while True:
-                msg = await self.websocket.recv()
-                print("Got msg", msg)
-                if msg == "ACK":
-                    print("Got ack")
-                    return True
-        else:
-            self.websocket = None
-
-    async def ws_send_check(self, message):
-        if self.websocket is not None and self.websocket.open:
-            await self.websocket.send(message)
-            return await self.ws_recv_ack()
-        else:
-            self.websocket = None
-        return False
-
-    async def ws_send_until_success(self, message):
-        while not await self.ws_send_check(message):
-            logging.error("Failed to send command, retrying...")
-            time.sleep(0.05)
+        self.manifest = pattern_manifest(self.patterns)
 
     async def send_command(self, command: tuple):
-        command_type, command_data = command
-        message = json.dumps({
-            "type": command_type,
-            "data": command_data
-        })
-        message = message.replace(" ", "")
+        message = command.message if isinstance(command, FaderCommand) else FaderCommand.serialize(command)
         # try:
         #     pong_waiter = await self.websocket.ping()
         #     logging.info("sent ping...")
@@ -78,26 +99,183 @@ class FaderClient(Commandable):
         if self.websocket is not None and self.websocket.open:
             # await self.ws_send_check(message)
             await self.websocket.send(message)
-            logging.info(f"Sent command to {self.host}:{self.port} - length {len(message)}")
+            self.commands_sent += 1
+            logging.debug(f"Sent command to {self.host}:{self.port} - length {len(message)}")
+
+    def schedule(self, command, local_time):
+        """
+        command with the controller's clock reading at local_time (from
+        time.monotonic) added as "at", so it starts the pattern then rather
+        than when the command arrives. command as is before the clock is
+        synced.
+        """
+        controller_time = self.clock.to_controller(local_time)
+        if controller_time is None:
+            return command
+        command_type, data = command
+        return FaderCommand(command_type, {**data, "at": controller_time})
+
+    def connection_tasks(self):
+        tasks = super().connection_tasks()
+        if self.clock_sync:
+            tasks.append(self.sync_clock())
+        return tasks
+
+    async def read_replies(self):
+        async for message in self.websocket:
+            received = time.monotonic()
+            if self.pings and not isinstance(message, bytes):
+                try:
+                    reply = json.loads(message)
+                    if reply.get("type") == FaderClient.COMMAND_PING:
+                        ping = self.pings.pop(reply["data"]["seq"], None)
+                        if ping is not None and not ping.done():
+                            ping.set_result((reply["data"]["time"], received))
+                        continue
+                except (ValueError, AttributeError, KeyError, TypeError) as e:
+                    # not a ping reply, and not worth dropping the connection over
+                    logging.debug(f"Unreadable reply from {self.host}:{self.port}: {message[:100]} ({e})")
+                    continue
+            logging.debug(f"Reply from {self.host}:{self.port}: {message[:100]}")
+
+    async def ping(self):
+        # one exchange for the clock estimate, None if the controller didn't answer in time
+        seq = next(self.ping_seq)
+        reply = self.pings[seq] = asyncio.get_running_loop().create_future()
+        sent = time.monotonic()
+        try:
+            await self.websocket.send(FaderCommand.serialize((FaderClient.COMMAND_PING, {"seq": seq})))
+            controller_time, received = await asyncio.wait_for(reply, self.PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.pings.pop(seq, None)
+        return sent, controller_time, received
+
+    async def sync_clock(self):
+        # keeps the clock estimate up to date while connected, from the replies read_replies passes on
+        while True:
+            for _ in range(self.CLOCK_SYNC_EXCHANGES):
+                exchange = await self.ping()
+                if exchange is not None:
+                    self.clock.add_exchange(*exchange)
+                await asyncio.sleep(self.CLOCK_SYNC_SPACING)
+            if self.clock.end_burst():
+                logging.debug(
+                    f"Clock of {self.host}:{self.port}: round trip {self.clock.rtt * 1000:.2f}ms, "
+                    f"drift {self.clock.rate:.1f}us/s"
+                )
+            else:
+                logging.warning(f"No ping replies from {self.host}:{self.port}")
+            await asyncio.sleep(self.CLOCK_SYNC_INTERVAL)
+
+    async def request(self, command, timeout):
+        # send a command and wait for the controller's reply of the same type,
+        # skipping anything else it sends meanwhile (e.g. late acknowledgements)
+        await self.send_command(command)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            reply = await asyncio.wait_for(self.websocket.recv(), remaining)
+            if isinstance(reply, bytes):
+                continue
+            reply = json.loads(reply)
+            if reply.get("type") == command[0]:
+                return reply["data"]
+
+    async def negotiate_pattern_format(self):
+        # binary patterns only if the controller says it can decode them, JSON otherwise
+        self.binary_patterns = False
+        self.pattern_format = None
+        self.pattern_acks = False
+        self.pattern_sync = False
+        self.clock_sync = False
+        if self.websocket is None or not self.websocket.open:
+            return
+        try:
+            info = await self.request((FaderClient.COMMAND_GET_INFO, {}), self.INFO_TIMEOUT)
+            self.controller_id = info.get("id")
+            pattern_format = info.get("pattern_format")
+            # version 2 onwards carry the content hashes that syncing needs
+            self.binary_patterns = self.use_binary_patterns and isinstance(pattern_format, int) and pattern_format >= 2
+            self.pattern_format = min(pattern_format, FORMAT_VERSION) if self.binary_patterns else None
+            self.pattern_acks = info.get("pattern_acks", False)
+            self.pattern_sync = info.get("pattern_sync", False)
+            self.clock_sync = info.get("clock_sync", False)
+        except asyncio.TimeoutError:
+            logging.info(f"No info reply from {self.host}:{self.port}")
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.warning(f"Invalid info reply from {self.host}:{self.port}: {e}")
+        logging.info(f"Sending {f'binary (version {self.pattern_format})' if self.binary_patterns else 'JSON'} patterns to {self.host}:{self.port}")
+
+    def pattern_message(self, pattern):
+        content_hash = self.manifest[pattern["name"]]
+        if self.binary_patterns:
+            try:
+                return bytes([FaderClient.COMMAND_ADD_PATTERN]) + encode_pattern(
+                    pattern, content_hash=content_hash, version=self.pattern_format, min_indexed_segments=self.min_indexed_segments
+                )
+            except ValueError as e:
+                logging.warning(f"Sending pattern {pattern['name']} as JSON: {e}")
+        return json.dumps({"type": FaderClient.COMMAND_ADD_PATTERN, "data": {**pattern, "hash": content_hash}}).replace(" ", "")
+
+    async def upload_patterns(self, patterns):
+        messages = [(pattern["name"], self.pattern_message(pattern)) for pattern in patterns]
+        if self.pattern_acks:
+            stats = await PatternUploader(self.websocket, self.upload_window).upload(messages)
+        else:
+            # no acknowledgements to wait for, so give the controller time to parse each one
+            start = time.perf_counter()
+            for name, message in messages:
+                await self.websocket.send(message)
+                await asyncio.sleep(self.UNACKED_PATTERN_DELAY)
+            stats = {
+                "patterns": len(messages), "bytes": sum(len(message) for _, message in messages),
+                "retries": 0, "timeouts": 0, "failed": [], "elapsed": time.perf_counter() - start,
+            }
+        logging.info(f"Sent patterns to {self.host}:{self.port}: {throughput_summary(stats)}")
+        return stats
+
+    async def sync_patterns(self):
+        # send only new and changed patterns, so untouched ones keep playing
+        try:
+            remote = (await self.request((FaderClient.COMMAND_GET_PATTERNS, {}), self.MANIFEST_TIMEOUT))["patterns"]
+        except (asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"No pattern manifest from {self.host}:{self.port}, sending everything: {e}")
+            return False
+        to_send, to_remove = diff_manifests(self.manifest, remote)
+        logging.info(
+            f"Syncing patterns to {self.host}:{self.port}: {len(self.manifest) - len(to_send)} unchanged, "
+            f"{len(to_send)} to send, {len(to_remove)} to remove"
+        )
+        if to_remove:
+            # removing first frees the controller's memory for the new ones
+            await self.send_command((FaderClient.COMMAND_REMOVE_PATTERNS, {"names": to_remove}))
+        if to_send:
+            to_send = set(to_send)
+            await self.upload_patterns([pattern for pattern in self.patterns if pattern["name"] in to_send])
+        return True
 
     async def send_patterns(self):
         if self.websocket is not None and self.websocket.open:
+            if self.pattern_sync and await self.sync_patterns():
+                # a full upload cut short by a dropped connection leaves the
+                # controller paused, and resuming twice does nothing
+                await self.send_command((FaderClient.COMMAND_SET_PAUSED, {"paused": False}))
+                return
             logging.info(f"sending {len(self.patterns)} patterns to {self.host}:{self.port}")
             # pause output
             await self.send_command((FaderClient.COMMAND_SET_PAUSED, {"paused": True}))
+            try:
+                # clear patterns
+                await self.send_command((FaderClient.COMMAND_SET_PATTERNS, {}))
 
-            # clear patterns
-            await self.send_command((FaderClient.COMMAND_SET_PATTERNS, {}))
-
-            for pattern in self.patterns:
-                await self.send_command((FaderClient.COMMAND_ADD_PATTERN, pattern))
-                # await self.ws_recv_ack()
-                time.sleep(1)
-                logging.info(f"Sent a pattern to {self.host}:{self.port}")
-            logging.info(f"Sent patterns to {self.host}:{self.port}")
-
-            # resume output
-            await self.send_command((FaderClient.COMMAND_SET_PAUSED, {"paused": False}))
+                await self.upload_patterns(self.patterns)
+            finally:
+                # resume output, whatever made it through
+                await self.send_command((FaderClient.COMMAND_SET_PAUSED, {"paused": False}))
 
     async def connect_to_server(self):
         ws_url = f"ws://{self.host}:{self.port}/ws"
@@ -105,6 +283,12 @@ class FaderClient(Commandable):
         try:
             self.websocket = await websockets.connect(ws_url, max_size=None, ping_interval=2, ping_timeout=2, create_protocol=CustomWebSocketClientProtocol)
             logging.info(f"Connected to WebSocket server at {self.host}:{self.port}")
+            await self.negotiate_pattern_format()
+            if self.expected_id is not None and self.controller_id != self.expected_id:
+                logging.info(f"{self.host}:{self.port} is controller {self.controller_id}, not {self.expected_id}")
+                await self.websocket.close()
+                self.websocket = None
+                return
             await self.send_patterns()
             # while True:
             #     command = self.command_queue.get()  # Use blocking get() from queue
@@ -113,24 +297,16 @@ class FaderClient(Commandable):
             logging.error(f"Error connecting to WebSocket server: {e}")
             self.websocket = None
 
-    async def read_commands(self):
-        try:
-            while True:
-                command = self.command_queue.get()  # Use blocking get() from queue
-                await self.send_command(command)
-        except Exception as e:
-            logging.error(f"Error connecting to WebSocket server: {e}")
-            self.websocket = None
-
-    def manage_connection(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.connect_to_server())
-        loop.run_until_complete(self.read_commands())
-        # while True:
-        #     if not self.websocket or not self.websocket.open:
-        #         loop.run_until_complete(self.connect_to_server())
-        #     time.sleep(1)  # Retry connection after a short delay
+    async def run(self):
+        """
+        Connect, bring the controller's patterns up to date, then send queued
+        commands until the connection drops. Returns whether it connected.
+        """
+        await self.connect_to_server()
+        if not self.is_connected():
+            return False
+        await self.serve_connection()
+        return True
 
     def is_connected(self) -> bool:
         return self.websocket is not None and self.websocket.open
@@ -142,20 +318,20 @@ class FaderClient(Commandable):
             raise ValueError(f"Invalid command format: {raw_command}")
         command_type, command_data = parts
         if command_type == "once":
-            return KeyMapEntry("ewctrl", (FaderClient.COMMAND_START_PATTERN, {"name": command_data, "loop": False}))
+            return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_START_PATTERN, {"name": command_data, "loop": False}))
         elif command_type == "hold":
-            return KeyMapEntry("ewctrl", (FaderClient.COMMAND_START_PATTERN, {"name": command_data, "loop": True}), (8, {"name": command_data}))
+            return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_START_PATTERN, {"name": command_data, "loop": True}), FaderCommand(FaderClient.COMMAND_STOP_PATTERN, {"name": command_data}))
         elif command_type == "multiplier_raw":
-            return KeyMapEntry("ewctrl", (FaderClient.COMMAND_SET_MULTIPLIER, json.loads(command_data)))
+            return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_SET_MULTIPLIER, json.loads(command_data)))
         elif command_type == "multiplier":
-            return KeyMapEntry("ewctrl", (FaderClient.COMMAND_SET_MULTIPLIER, multipliers[command_data]))
+            return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_SET_MULTIPLIER, multipliers[command_data]))
         elif command_type == "speed":
             if command_data in ["-", "+"]:
-                return KeyMapEntry("ewctrl", (FaderClient.COMMAND_SET_SPEED, {"speed": command_data}))
+                return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_SET_SPEED, {"speed": command_data}))
             try:
-                return KeyMapEntry("ewctrl", (FaderClient.COMMAND_SET_SPEED, {"speed": float(command_data)}))
+                return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_SET_SPEED, {"speed": float(command_data)}))
             except ValueError:
                 raise ValueError(f"Invalid speed value: {command_data}")
         elif command_type == "blackout":
-            return KeyMapEntry("ewctrl", (FaderClient.COMMAND_STOP_ALL, {}))
+            return KeyMapEntry("ewctrl", FaderCommand(FaderClient.COMMAND_STOP_ALL, {}))
         raise ValueError(f"Invalid command type: {command_type}")
\ No newline at end of file
@@ -1,35 +1,30 @@
+import asyncio
 import csv
 import errno
 import json
 import logging
-import select
-import threading
-import time
 
 import pyudev
-from evdev import InputDevice, categorize, ecodes, list_devices
+from evdev import InputDevice, ecodes, list_devices
 from fader_client import FaderClient
 from multipliers import load_multipliers
 from wled_client import WLEDClient
 
 
 class KeyboardCommander:
-    DEBOUNCE_TIME = 0.3  # Time in seconds to debounce udev events
+    DEBOUNCE_TIME = 0.3  # Time in seconds to debounce udev events for a device node
 
-    def __init__(self, server_manager, keymap_file, multipliers_file=None):
+    def __init__(self, server_manager, keymap_file, multipliers_file=None, recorder=None):
         self.multipliers = load_multipliers(multipliers_file) if multipliers_file else {}
         print("MULT", self.multipliers)
         self.keymap = self.load_keymap(keymap_file)
+        self.dispatch = self.compile_keymap(self.keymap)
         self.server_manager = server_manager
-        self.devices = {}
-        self.context = pyudev.Context()
-        self.monitor = pyudev.Monitor.from_netlink(self.context)
-        self.monitor.filter_by('input')
-        self.observer = pyudev.MonitorObserver(self.monitor, self.handle_udev_event, name='monitor-observer')
-        self.observer.start()
-        self.debounce_timer = None
-        self.debounce_lock = threading.Lock()
-        self.update_keyboards()
+        self.recorder = recorder  # a ShowRecorder to log every command dispatched to
+        self.devices = {}  # path -> InputDevice
+        self.device_tasks = {}  # path -> task reading the device
+        self.monitor = None
+        self.pending_adds = {}  # path -> timer adding it once its udev events settle
 
     # def load_multipliers(self, filename):
     #     multipliers = {}
@@ -60,117 +55,142 @@ class KeyboardCommander:
                     keymap[key].append(WLEDClient.parse_keymap(row["wled"]))
         return keymap
 
-    def find_keyboards(self):
-        devices = [InputDevice(path) for path in list_devices()]
-        # print("DEVS", devices)
-        keyboards = []
-        for device in devices:
+    def compile_keymap(self, keymap):
+        """
+        Turn the keymap into a table from evdev keycode to, for key up and key
+        down, the (target, command) pairs to queue and a line to log, so that
+        handling a key event is a single lookup.
+        """
+        dispatch = {}
+        for key, mappings in keymap.items():
+            if not key:
+                continue  # a row with no key, e.g. a spacer in the sheet
+            code = ecodes.ecodes.get(key.upper())
+            if code is None:
+                logging.warning(f"Unknown key {key} in keymap, ignoring it")
+                continue
+            actions = []
+            for state, direction in enumerate(["up", "down"]):
+                commands = []
+                for mapping in mappings:
+                    command = [mapping.on_up, mapping.on_down][state]
+                    if command is not None:
+                        commands.append((mapping.target, command))
+                description = ", ".join(f"{key} {direction} → queued command {command} for {target}" for target, command in commands)
+                actions.append((tuple(commands), description))
+            dispatch[code] = tuple(actions)
+        return dispatch
+
+    def open_keyboard(self, path):
+        # the InputDevice at path if it's a keyboard, otherwise None with nothing left open
+        try:
+            device = InputDevice(path)
+        except OSError as e:
+            logging.debug(f"Could not open {path}: {e}")
+            return None
+        try:
             logging.debug(f"Device found: {device.path}, Name: {device.name}")
             capabilities = device.capabilities().get(ecodes.EV_KEY, [])
             if capabilities and self.is_keyboard(capabilities):
-                logging.debug(f"Keyboard found: {device.path}")
-                keyboards.append(device)
-        return keyboards
+                return device
+        except OSError as e:
+            logging.debug(f"Could not read {path}: {e}")
+        device.close()
+        return None
 
     def is_keyboard(self, capabilities):
         # Define key capabilities typical of keyboards to filter out mouse events
         keyboard_keys = {ecodes.KEY_A, ecodes.KEY_B, ecodes.KEY_C, ecodes.KEY_D, ecodes.KEY_E, ecodes.KEY_F, ecodes.KEY_G}
         return any(key in capabilities for key in keyboard_keys)
 
+    def add_device(self, path):
+        self.pending_adds.pop(path, None)
+        if path in self.devices:
+            return
+        device = self.open_keyboard(path)
+        if device is None:
+            return
+        self.devices[path] = device
+        self.device_tasks[path] = asyncio.create_task(self.read_device(device))
+        logging.info(f"Connected device: {device.name} ({path})")
+
     def update_keyboards(self):
-        keyboards = self.find_keyboards()
-        connected_devices = []
-        for device in keyboards:
-            if device.fd not in self.devices:
-                self.devices[device.fd] = device
-                connected_devices.append(device.name)
-        # Remove disconnected devices
-        existing_fds = [device.fd for device in keyboards]
-        for fd in list(self.devices.keys()):
-            if fd not in existing_fds:
-                logging.info(f"Removing device: {self.devices[fd].path}")
-                del self.devices[fd]
-
-        # Log the currently connected devices
-        if connected_devices:
-            logging.info(f"Connected devices: {', '.join(connected_devices)}")
+        # a full scan, at startup; after that udev events add and remove devices one at a time
+        paths = set(list_devices())
+        for path in sorted(paths):
+            self.add_device(path)
+        for path in list(self.devices.keys()):
+            if path not in paths:
+                logging.info(f"Removing device: {path}")
+                self.remove_device(path)
+
+    def remove_device(self, path):
+        task = self.device_tasks.pop(path, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        device = self.devices.pop(path, None)
+        if device is not None:
+            device.close()
+
+    def read_udev_events(self):
+        # called by the event loop when the netlink socket is readable
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                return
+            self.handle_udev_event(device.action, device)
 
     def handle_udev_event(self, action, device):
-        logging.info(f"Udev event detected: {action}, {device}")
-        with self.debounce_lock:
-            if self.debounce_timer is not None:
-                self.debounce_timer.cancel()
-            self.debounce_timer = threading.Timer(self.DEBOUNCE_TIME, self.update_keyboards)
-            self.debounce_timer.start()
+        # only the event's own device node is touched, so a plug or unplug
+        # costs the same however many devices there are
+        path = device.device_node
+        if path is None or not path.startswith("/dev/input/event"):
+            return  # the parent input device, or a mouse or joystick node
+        logging.info(f"Udev event detected: {action}, {path}")
+        pending = self.pending_adds.pop(path, None)
+        if pending is not None:
+            pending.cancel()
+        if action == "remove":
+            self.remove_device(path)
+        elif action == "add":
+            # a node added again was unplugged, even if its remove went missing
+            self.remove_device(path)
+            self.pending_adds[path] = asyncio.get_running_loop().call_later(self.DEBOUNCE_TIME, self.add_device, path)
+
+    def handle_key(self, code, state):
+        # runs for every key event, so everything it needs is worked out by compile_keymap
+        actions = self.dispatch.get(code)
+        if actions is None or state > 1:  # unmapped, or a key hold
+            return
+        commands, description = actions[state]
+        for target, command in commands:
+            self.server_manager.queue_command(target, command)
+            if self.recorder is not None:
+                self.recorder.record(target, command)
+        if commands:
+            logging.debug(description)
 
     def handle_key_event(self, key_event):
-            # logging.debug(f"Key event: {key_event}")
-            if not hasattr(key_event, 'keycode'):
-                return
-            key = key_event.keycode
-            if isinstance(key, list):
-                key = key[0]  # Handle cases where keycode is a list
-            key = key.lower()
-            logging.debug(f'{key} {["up", "down", "hold"][key_event.keystate]} detected')
-
-            if key_event.keystate not in [key_event.key_down, key_event.key_up]:
-                return
-
-            if key not in self.keymap:
-                return
-
-            mappings = self.keymap[key]
-            for mapping in mappings:
-                command = [mapping.on_up, mapping.on_down][key_event.keystate]
-                if command is None:
-                    continue
-                self.server_manager.queue_command(mapping.target, command)
-                logging.info(f'{key} {["up", "down"][key_event.keystate]} → queued command {command} for {mapping.target}')
-
-            # targets = self.keymap[key]
-            # for target in targets:
-            #     # if target['target'] == "ewctrl":
-            #     #     print(target["command"])
-            #     #     play_type, command = target['command'].split("|")
-            #     #     if play_type == "once" and key_event.keystate == key_event.key_down:
-            #     #         self.server_manager.queue_command(target['target'], f"play|{target['command']}")
-            #     #         logging.info(f"{key} down → queued command play|{target['command']} for {target['target']}")
-            #     #     elif play_type == "hold":
-            #     #         commands = {
-            #     #             key_event.key_down: f"start|{command}",
-            #     #             key_event.key_up: f"stop|{command}"
-            #     #         }
-            #     #         if key_event.keystate in commands:
-            #     #             self.server_manager.queue_command(target['target'], commands[key_event.keystate])
-            #     #             logging.info(f"{key} down → queued command {commands[key_event.keystate]} for {target['target']}")
-
-            #     #     else:
-            #     #         logging.error(f"Invalid play type: {play_type}")
-
-            #     # elif target['target'] == "wled":
-            #     if key_event.keystate in [key_event.key_down, key_event.key_up] :
-            #         self.server_manager.queue_command(target['target'], (key_event.keystate, target['command']))
-            #         logging.info(f"{key} down → queued command {(key_event.keystate, target['command'])} for {target['target']}")
-
-
-    def start(self):
+        # for categorized events, e.g. evdev.KeyEvent
+        self.handle_key(key_event.scancode, key_event.keystate)
+
+    async def read_device(self, device):
+        try:
+            async for event in device.async_read_loop():
+                if event.type == ecodes.EV_KEY:
+                    self.handle_key(event.code, event.value)
+        except OSError as e:
+            if e.errno != errno.ENODEV:
+                raise
+            logging.warning(f"Device {device.path} removed.")
+            if self.devices.get(device.path) is device:  # not since replaced by another at the same path
+                self.remove_device(device.path)
+
+    async def start(self):
         logging.info("Starting to read events from the keyboards...")
-        
-        while True:
-            if not self.devices:
-                time.sleep(1)
-                continue
-            r, w, x = select.select(self.devices.keys(), [], [])
-            for fd in r:
-                device = self.devices.get(fd)
-                if not device:
-                    continue
-                try:
-                    for event in device.read():
-                        if event.type == ecodes.EV_KEY:
-                            key_event = categorize(event)
-                            self.handle_key_event(key_event)
-                except OSError as e:
-                    if e.errno == errno.ENODEV:
-                        logging.warning(f"Device {device.path} removed.")
-                        del self.devices[fd]
+        self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        self.monitor.filter_by('input')
+        self.monitor.start()
+        asyncio.get_running_loop().add_reader(self.monitor.fileno(), self.read_udev_events)
+        self.update_keyboards()
+        await asyncio.Future()  # devices are read by their own tasks from here on
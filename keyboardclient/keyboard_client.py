@@ -1,85 +1,267 @@
+import asyncio
+import json
 import logging
-import queue
-import socket
-import subprocess
-import threading
+import os
 import time
+from argparse import ArgumentParser
 
-from als import generate_patterns
 from common import SERVERS
+from controllers import CONTROLLERS_FILE, Controller, load_controllers
 from fader_client import FaderClient
 from key_control import KeyboardCommander
+from show_log import ShowRecorder
 from wled_client import WLEDClient
 
 
+KNOWN_SERVERS_FILE = "known_servers.json"
+# seconds ahead to schedule pattern starts, long enough for commands to reach
+# every controller so they start together. None starts patterns on arrival.
+START_LEAD = None
+# every command sent during a show is appended here, see show_log.py. None
+# records nothing, and --show-log turns recording on for a run.
+SHOW_LOG_FILE = None
+
+
 class ServerManager:
-    def __init__(self):
+    """
+    Finds and keeps connections to the servers in SERVERS. Commands for
+    "ewctrl" go to every fader controller in controllers, by default a
+    single one holding patterns.
+    """
+    PROBE_TIMEOUT = 0.5  # a controller on the LAN answers well within this
+    MAX_CONCURRENT_PROBES = 64
+    HEALTH_INTERVAL = 10
+
+    def __init__(self, patterns=None, known_servers_file=KNOWN_SERVERS_FILE, controllers=None, start_lead=START_LEAD):
+        self.start_lead = start_lead
+        self.controllers = controllers if controllers is not None else [Controller("ewctrl", patterns)]
         self.clients = {}
-        self.command_queues = {}
-        for name, port in SERVERS.items():
-            self.command_queues[name] = queue.Queue(maxsize=10)
-            threading.Thread(target=self.manage_port_connection, args=(name,), daemon=True).start()
+        self.command_queues = {name: asyncio.Queue(maxsize=10) for name in SERVERS if name != "ewctrl"}
+        self.command_queues.update({controller.name: controller.command_queue for controller in self.controllers})
+        self.known_servers_file = known_servers_file
+        self.known_servers = self.load_known_servers()
+
+    async def run(self):
+        # one task per server or controller, each holding at most one connection
+        await asyncio.gather(
+            *(self.manage_controller(controller) for controller in self.controllers),
+            *(self.manage_port_connection(name) for name in SERVERS if name != "ewctrl"),
+            self.report_health(),
+        )
 
-    def get_lan_devices(self):
-        result = subprocess.run(['arp', '-an'], capture_output=True, text=True)
+    def load_known_servers(self):
+        # last address each server was found at, so a restart tries it first
+        try:
+            with open(self.known_servers_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable {self.known_servers_file}: {e}")
+            return {}
+
+    def save_known_server(self, name: str, ip: str):
+        if self.known_servers.get(name) == ip:
+            return
+        self.known_servers[name] = ip
+        tmp_path = f"{self.known_servers_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.known_servers, f)
+        os.replace(tmp_path, self.known_servers_file)
+
+    async def get_lan_devices(self):
+        process = await asyncio.create_subprocess_exec('arp', '-an', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await process.communicate()
         devices = []
-        for line in result.stdout.splitlines():
+        for line in stdout.decode().splitlines():
             if line.startswith('?'):
                 parts = line.split()
                 if len(parts) >= 2:
                     devices.append(parts[1].strip('()'))
         return devices
 
-    def is_port_open(self, ip: str, port: int):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.settimeout(1)
-            result = sock.connect_ex((ip, port))
-            return result == 0
-
-    def find_server(self, port: int):
-        devices = self.get_lan_devices()
-        logging.debug(f"Devices on LAN: {devices}")
-        for device in devices:
-            if self.is_port_open(device, port):
-                logging.info(f"Server found at {device}:{port}")
-                return device
-        logging.debug(f"Server not found on the LAN for port {port}.")
-        return None
-
-    def manage_port_connection(self, name: str):
+    async def is_port_open(self, ip: str, port: int):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.PROBE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def probe_all(self, devices, port: int):
+        # probe every candidate at once, returning the first that answers
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_PROBES)
+
+        async def probe(device):
+            async with semaphore:
+                return device if await self.is_port_open(device, port) else None
+
+        tasks = [asyncio.create_task(probe(device)) for device in devices]
+        try:
+            for result in asyncio.as_completed(tasks):
+                device = await result
+                if device is not None:
+                    return device
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def find_open_hosts(self, devices, port: int):
+        # every candidate listening on port
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_PROBES)
+
+        async def probe(device):
+            async with semaphore:
+                return await self.is_port_open(device, port)
+
+        results = await asyncio.gather(*(probe(device) for device in devices))
+        return [device for device, is_open in zip(devices, results) if is_open]
+
+    def claimed_addresses(self, controller):
+        return {(other.address, other.port) for other in self.controllers if other is not controller and other.address}
+
+    async def find_controller(self, controller):
+        """
+        Addresses that may be controller, best guess first: where it was last
+        seen, else the first host listening on its port, or every such host
+        if it has an id to tell it apart by. Addresses other controllers hold
+        are skipped.
+        """
+        claimed = self.claimed_addresses(controller)
+        last_known = self.known_servers.get(controller.name)
+        if last_known and (last_known, controller.port) not in claimed and await self.is_port_open(last_known, controller.port):
+            return [last_known]
+        devices = [
+            device for device in await self.get_lan_devices()
+            if device != last_known and (device, controller.port) not in claimed
+        ]
+        if controller.id is None:
+            server_ip = await self.probe_all(devices, controller.port)
+            return [server_ip] if server_ip else []
+        return await self.find_open_hosts(devices, controller.port)
+
+    async def manage_controller(self, controller):
+        while True:
+            start = time.perf_counter()
+            for address in await self.find_controller(controller):
+                if (address, controller.port) in self.claimed_addresses(controller):
+                    continue  # another controller got there first
+                controller.address = address
+                client = FaderClient(address, controller.port, controller.command_queue, controller.patterns, expected_id=controller.id)
+                controller.client = self.clients[controller.name] = client
+                await client.connect_to_server()
+                if not client.is_connected():
+                    controller.address = None
+                    continue
+                logging.info(f"Controller {controller.name} found at {address}:{controller.port} in {(time.perf_counter() - start) * 1000:.0f}ms")
+                self.save_known_server(controller.name, address)
+                controller.connects += 1
+                # returns as soon as the connection drops, closing it in the background,
+                # so the next search overlaps the teardown
+                await client.serve_connection()
+                controller.sent += client.commands_sent
+                client.commands_sent = 0
+                controller.address = None
+                break
+            else:
+                logging.debug(f"Controller {controller.name} not found on the LAN. Retrying...")
+                await asyncio.sleep(1)
+
+    async def report_health(self):
         while True:
-            if name not in self.clients or not self.clients[name].is_connected():
-                server_ip = self.find_server(SERVERS[name])
-                if server_ip:
-                    if name == "wled":
-                        self.clients[name] = WLEDClient(server_ip, SERVERS[name], self.command_queues[name])
-                    else:
-                        self.clients[name] = FaderClient(server_ip, SERVERS[name], self.command_queues[name])
-                    self.clients[name].connection_thread.join()
-                else:
-                    logging.debug(f"Could not find the server on the LAN for port {SERVERS[name]}. Retrying...")
-            time.sleep(1)  # Retry connecting
+            await asyncio.sleep(self.HEALTH_INTERVAL)
+            for controller in self.controllers:
+                health = controller.health()
+                if not health["connected"]:
+                    logging.warning(f"Controller {controller.name} disconnected, {health['connects']} connections so far")
+                    continue
+                latency = f"{health['latency_ms']:.1f}ms" if health["latency_ms"] is not None else "unknown"
+                clock = f"clock round trip {health['clock_rtt_ms']:.2f}ms" if health["clock_rtt_ms"] is not None else "clock not synced"
+                logging.info(
+                    f"Controller {controller.name} at {health['address']}: latency {latency}, {clock}, {health['sent']} sent, "
+                    f"{health['queued']} queued, {health['merged']} merged, {health['dropped']} dropped"
+                )
 
-    def queue_command(self, target_name: str, command: tuple):
-        if target_name in self.clients and self.clients[target_name].is_connected():
-            if not self.command_queues[target_name].full():
-                try:
-                    self.command_queues[target_name].put(command, block=False)
-                except queue.Full:
-                    logging.warning(f"Command queue for server {target_name} is full. Dropping command.")
+    async def find_server(self, name: str):
+        port = SERVERS[name]
+        start = time.perf_counter()
+        server_ip = None
+        last_known = self.known_servers.get(name)
+        if last_known and await self.is_port_open(last_known, port):
+            server_ip = last_known
+        else:
+            devices = [device for device in await self.get_lan_devices() if device != last_known]
+            logging.debug(f"Devices on LAN: {devices}")
+            server_ip = await self.probe_all(devices, port)
+        if server_ip is None:
+            logging.debug(f"Server not found on the LAN for port {port}.")
+            return None
+        logging.info(f"Server found at {server_ip}:{port} in {(time.perf_counter() - start) * 1000:.0f}ms")
+        self.save_known_server(name, server_ip)
+        return server_ip
+
+    async def manage_port_connection(self, name: str):
+        while True:
+            server_ip = await self.find_server(name)
+            if server_ip:
+                # kept across reconnects, with its presets and HTTP session, unless the server moved
+                client = self.clients.get(name)
+                if client is None or client.host != server_ip:
+                    if client is not None:
+                        client.close()
+                    client = self.clients[name] = WLEDClient(server_ip, SERVERS[name], self.command_queues[name])
+                # returns as soon as the connection drops, closing it in the background,
+                # so the next search overlaps the teardown
+                if await client.run():
+                    continue
             else:
+                logging.debug(f"Could not find the server on the LAN for port {SERVERS[name]}. Retrying...")
+            await asyncio.sleep(1)  # Retry connecting
+
+    def queue_command(self, target_name: str, command: tuple):
+        if target_name == "ewctrl":
+            self.broadcast(command)
+        elif target_name in self.clients and self.clients[target_name].is_connected():
+            try:
+                self.command_queues[target_name].put_nowait(command)
+            except asyncio.QueueFull:
                 logging.warning(f"Command queue for server {target_name} is full. Dropping command.")
         else:
             logging.warning(f"No active connection to server {target_name}. Command discarded.")
 
-def main():
-    generate_patterns("data/ew4lx_final2.als")
-    # generate_patterns("data/pridelx_3.als")
-    # generate_patterns("/boot/ewctrl/lx.als")
-    server_manager = ServerManager()
-    keyboard_commander = KeyboardCommander(server_manager, 'data/keymap_final.csv', multipliers_file='data/colors_final.csv')
+    def broadcast(self, command: tuple):
+        # each controller has its own queue and connection, so a slow one only holds up itself
+        start_at = None
+        if self.start_lead is not None and command[0] == FaderClient.COMMAND_START_PATTERN:
+            start_at = time.monotonic() + self.start_lead
+        for controller in self.controllers:
+            if not controller.is_connected():
+                logging.warning(f"No active connection to controller {controller.name}. Command discarded.")
+                continue
+            adapted = controller.adapt(command)
+            if adapted is None:
+                continue
+            if start_at is not None:
+                adapted = controller.client.schedule(adapted, start_at)
+            controller.command_queue.put_nowait(adapted)
+
+async def main(show_log_file=SHOW_LOG_FILE):
+    controllers = load_controllers(CONTROLLERS_FILE, "data/ew4lx_final2.als")
+    # controllers = load_controllers(CONTROLLERS_FILE, "data/pridelx_3.als")
+    # controllers = load_controllers(CONTROLLERS_FILE, "/boot/ewctrl/lx.als")
+    server_manager = ServerManager(controllers=controllers)
+    recorder = ShowRecorder(show_log_file) if show_log_file else None
+    keyboard_commander = KeyboardCommander(server_manager, 'data/keymap_final.csv', multipliers_file='data/colors_final.csv', recorder=recorder)
     # keyboard_commander = KeyboardCommander('/boot/ewctrl/patterns_map.csv', server_manager)
-    keyboard_commander.start()
+    try:
+        await asyncio.gather(server_manager.run(), keyboard_commander.start())
+    finally:
+        if recorder is not None:
+            recorder.close()
 
 if __name__ == "__main__":
-    main()
+    parser = ArgumentParser(description="Send key presses to the fader controllers and WLED")
+    parser.add_argument("--show-log", default=SHOW_LOG_FILE, metavar="FILE", help="append every command sent to FILE, see show_log.py")
+    args = parser.parse_args()
+    asyncio.run(main(args.show_log))
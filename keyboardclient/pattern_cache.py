@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from argparse import ArgumentParser
+
+from als import CHANNEL_ORDER, EXCLUDED_PATTERNS, ROUNDING, compile_patterns
+
+CACHE_DIR = "cache"
+# bump when the compiler output changes, so old entries stop matching
+CACHE_VERSION = 2
+MAX_ENTRIES = 16
+
+
+def file_hash(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(source_hash, params):
+    key_data = json.dumps({"version": CACHE_VERSION, "source_hash": source_hash, "params": params}, sort_keys=True)
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+class PatternCache:
+    """
+    Compiled patterns stored on disk, keyed by the ALS file's content hash and
+    the compile parameters. Entries are evicted when their source file changes
+    or disappears, and the least recently used go once there are more than
+    max_entries.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, filepath, channel_order=CHANNEL_ORDER, excluded_patterns=EXCLUDED_PATTERNS, rounding=ROUNDING, max_error=None):
+        start = time.perf_counter()
+        source_hash = file_hash(filepath)
+        params = {
+            "channel_order": list(channel_order) if channel_order is not None else None,
+            "excluded_patterns": sorted(excluded_patterns),
+            "rounding": rounding,
+            "max_error": max_error,
+        }
+        key = cache_key(source_hash, params)
+        path = self.entry_path(key)
+
+        try:
+            with open(path) as f:
+                patterns = json.load(f)["patterns"]
+            os.utime(path)  # mark as recently used
+            logging.info(f"Loaded {len(patterns)} patterns for {filepath} from cache in {(time.perf_counter() - start) * 1000:.1f}ms")
+            return patterns
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring corrupt cache entry {path}: {e}")
+
+        patterns = compile_patterns(filepath, channel_order, excluded_patterns, rounding, max_error)
+        self.store(key, {
+            "source": os.path.abspath(filepath),
+            "source_hash": source_hash,
+            "params": params,
+            "created": time.time(),
+            "patterns": patterns,
+        })
+        logging.info(f"Compiled {len(patterns)} patterns for {filepath} in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return patterns
+
+    def store(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.entry_path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        self.prune()
+
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Unreadable cache entry {path}: {e}")
+                entry = {}
+            entry["key"] = filename[:-len(".json")]
+            entry["path"] = path
+            entry["used"] = os.path.getmtime(path)
+            entry["size"] = os.path.getsize(path)
+            entries.append(entry)
+        return sorted(entries, key=lambda e: e["used"], reverse=True)
+
+    def is_stale(self, entry, source_hashes=None):
+        source_hashes = {} if source_hashes is None else source_hashes
+        source = entry.get("source")
+        if "patterns" not in entry or not source or not os.path.exists(source):
+            return True
+        if source not in source_hashes:
+            source_hashes[source] = file_hash(source)
+        return cache_key(source_hashes[source], entry.get("params")) != entry["key"]
+
+    def remove(self, entry):
+        logging.info(f"Evicting cache entry {entry['key'][:12]} for {entry.get('source')}")
+        os.remove(entry["path"])
+
+    def prune(self):
+        source_hashes = {}
+        kept = []
+        for entry in self.entries():
+            if self.is_stale(entry, source_hashes):
+                self.remove(entry)
+            else:
+                kept.append(entry)
+        for entry in kept[self.max_entries:]:
+            self.remove(entry)
+        return kept[:self.max_entries]
+
+    def purge(self):
+        entries = self.entries()
+        for entry in entries:
+            self.remove(entry)
+        return len(entries)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Inspect or purge the compiled pattern cache")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list cache entries, most recently used first")
+    subparsers.add_parser("prune", help="evict entries whose ALS file changed or is gone")
+    subparsers.add_parser("purge", help="remove every entry")
+    args = parser.parse_args()
+
+    cache = PatternCache(args.cache_dir)
+    if args.command == "list":
+        for entry in cache.entries():
+            print(" ".join([
+                entry["key"][:12],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["used"])),
+                f"{entry['size'] / 1024:.1f}KiB",
+                f"{len(entry.get('patterns', []))} patterns",
+                "stale" if cache.is_stale(entry) else "fresh",
+                str(entry.get("source")),
+            ]))
+    elif args.command == "prune":
+        print(f"{len(cache.prune())} entries kept")
+    elif args.command == "purge":
+        print(f"{cache.purge()} entries removed")
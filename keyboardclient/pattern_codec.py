@@ -0,0 +1,282 @@
+import glob
+import json
+import logging
+import struct
+import time
+from sys import argv
+
+import numpy as np
+
+from renderer import MIN_INDEXED_SEGMENTS, TICKS_PER_SECOND, PatternRenderer, envelope_segments, index_mismatches, quantize_y, segment_index
+
+# Binary pattern format, sent as a websocket binary frame after a one byte
+# command type (FaderClient.COMMAND_ADD_PATTERN):
+#
+#   u8   format version (FORMAT_VERSION)
+#   u16  time ticks per second, little endian
+#   u8   name length, then the UTF-8 name
+#   u8   content hash length, then the hash (version 2 onwards)
+#   u8   channel count
+#   per channel:
+#     varint  point count
+#     per point:
+#       varint  (time ticks since the previous point << 1) | has curve
+#       u8      value, as the firmware's 8-bit Vec2.y
+#       u8 u8   curve control 1 and 2 y, quantized like Vec2.y, if has curve
+#     version 3 onwards, the channel's segment index (renderer.segment_index):
+#     varint  ticks per bucket, 0 for no index
+#     varint  bucket count, if indexed
+#     per bucket:
+#       varint  first segment to look at for times in it, minus the previous bucket's
+#
+# Values and control points are quantized exactly as BezierEnvelope::loadEvents
+# would quantize the JSON events, so the controller builds identical segments.
+# The content hash is opaque to the controller, which reports it back when
+# asked which patterns it holds (see pattern_sync.py).
+FORMAT_VERSION = 3
+HEADER = struct.Struct("<BH")
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def quantize_envelope(events):
+    """
+    Quantize [time, value(, c1x, c1y, c2x, c2y)] events to
+    (time, y, control1 y, control2 y, has curve) as the firmware would.
+    Control points depend on the next event's value, so the last event
+    never has a curve.
+    """
+    events = [event for event in events if len(event) >= 2]
+    if not events:
+        return []
+    values = np.array([event[1] for event in events], dtype=np.float32)
+    controls = np.array([event[2:6] if len(event) == 6 else (0, 0, 0, 0) for event in events], dtype=np.float32)
+    has_curve = [len(event) == 6 for event in events[:-1]] + [False]
+    delta = np.append(values[1:], values[-1]) - values
+    y = quantize_y(np.stack([values, values + delta * controls[:, 1], values + delta * controls[:, 3]], axis=1))
+    return [
+        (event[0], int(y[i, 0]), int(y[i, 1]) if has_curve[i] else 0, int(y[i, 2]) if has_curve[i] else 0, has_curve[i])
+        for i, event in enumerate(events)
+    ]
+
+
+def encode_pattern(pattern, ticks_per_second=TICKS_PER_SECOND, content_hash="", version=FORMAT_VERSION, min_indexed_segments=MIN_INDEXED_SEGMENTS):
+    """
+    Encode a {"name", "data"} pattern in the binary format, version 2 for
+    controllers without segment indices. From version 3, channels with at
+    least min_indexed_segments segments are indexed, none if it is None.
+    Raises ValueError when it cannot be represented exactly, in which case
+    send JSON instead.
+    """
+    name = pattern["name"].encode()
+    content_hash = content_hash.encode()
+    if len(name) > 255 or len(content_hash) > 255 or len(pattern["data"]) > 255:
+        raise ValueError(f"Pattern {pattern['name']} has too long a name or hash or too many channels")
+
+    if not 2 <= version <= FORMAT_VERSION:
+        raise ValueError(f"Cannot encode pattern format version {version}")
+    out = bytearray(HEADER.pack(version, ticks_per_second))
+    out.append(len(name))
+    out += name
+    out.append(len(content_hash))
+    out += content_hash
+    out.append(len(pattern["data"]))
+    for events in pattern["data"]:
+        points = quantize_envelope(events)
+        write_varint(out, len(points))
+        previous_ticks = 0
+        for point_time, value, control1, control2, has_curve in points:
+            ticks = round(point_time * ticks_per_second)
+            if ticks / ticks_per_second != point_time:
+                raise ValueError(f"Time {point_time} in {pattern['name']} is not a multiple of 1/{ticks_per_second}s")
+            if ticks < previous_ticks:
+                raise ValueError(f"Times in {pattern['name']} go backwards at {point_time}")
+            write_varint(out, (ticks - previous_ticks) << 1 | has_curve)
+            out.append(value)
+            if has_curve:
+                out.append(control1)
+                out.append(control2)
+            previous_ticks = ticks
+        if version >= 3:
+            # indexed exactly as the firmware will have the segments
+            starts, ends = decoded_envelope_segments(points)[:2]
+            bucket_ticks, first_segments = segment_index(starts, ends, ticks_per_second, min_indexed_segments)
+            write_varint(out, bucket_ticks)
+            if bucket_ticks:
+                write_varint(out, len(first_segments))
+                for delta in np.diff(first_segments, prepend=0):
+                    write_varint(out, int(delta))
+    return bytes(out)
+
+
+def decode_pattern(data):
+    """
+    Reference decoder, mirroring parseBinaryToBezierPattern. Returns
+    {"name", "hash", "data", "index"} with each channel a list of quantized
+    (time, y, control1 y, control2 y, has curve) points, and for each
+    channel its (ticks per bucket, first segments) index, (0, []) if none.
+    """
+    if len(data) < HEADER.size + 1:
+        raise ValueError("Truncated pattern header")
+    version, ticks_per_second = HEADER.unpack_from(data, 0)
+    if not 1 <= version <= FORMAT_VERSION:
+        raise ValueError(f"Unsupported pattern format version {version}")
+    offset = HEADER.size
+    name_length = data[offset]
+    offset += 1
+    name = bytes(data[offset:offset + name_length]).decode()
+    offset += name_length
+    content_hash = ""
+    if version >= 2 and offset < len(data):
+        hash_length = data[offset]
+        offset += 1
+        content_hash = bytes(data[offset:offset + hash_length]).decode()
+        offset += hash_length
+    if offset >= len(data):
+        raise ValueError("Truncated pattern header")
+    channel_count = data[offset]
+    offset += 1
+
+    channels = []
+    index = []
+    for _ in range(channel_count):
+        point_count, offset = read_varint(data, offset)
+        points = []
+        ticks = 0
+        for _ in range(point_count):
+            packed, offset = read_varint(data, offset)
+            has_curve = bool(packed & 1)
+            ticks += packed >> 1
+            size = 3 if has_curve else 1
+            if offset + size > len(data):
+                raise ValueError("Truncated pattern data")
+            value = data[offset]
+            control1, control2 = (data[offset + 1], data[offset + 2]) if has_curve else (0, 0)
+            offset += size
+            points.append((ticks / ticks_per_second, value, control1, control2, has_curve))
+        channels.append(points)
+        bucket_ticks, first_segments = 0, []
+        if version >= 3:
+            bucket_ticks, offset = read_varint(data, offset)
+            if bucket_ticks:
+                bucket_count, offset = read_varint(data, offset)
+                segment_count = len(decoded_envelope_segments(points)[0])
+                first = 0
+                for _ in range(bucket_count):
+                    delta, offset = read_varint(data, offset)
+                    first += delta
+                    first_segments.append(first)
+                if first > segment_count:
+                    raise ValueError(f"Segment index past the last of {segment_count} segments")
+        index.append((bucket_ticks, first_segments))
+    if offset != len(data):
+        raise ValueError(f"{len(data) - offset} trailing bytes after pattern data")
+    return {"name": name, "hash": content_hash, "data": channels, "index": index}
+
+
+def decoded_envelope_segments(points):
+    """
+    The segments the firmware builds from decoded points, in the same form
+    as renderer.envelope_segments builds them from JSON events.
+    """
+    duration = float(np.float32(points[-1][0])) if points else 0.0
+    times = np.array([p[0] for p in points], dtype=np.float32)
+    y = np.array([[p[1], p[2], p[3], 0] for p in points], dtype=np.uint8).reshape(-1, 4)
+    if len(points) < 2:
+        return np.empty(0, np.float32), np.empty(0, np.float32), np.empty((0, 4), np.uint8), np.empty(0, bool), duration
+    y[:-1, 3] = y[1:, 0]
+    is_bezier = np.array([p[4] for p in points[:-1]])
+    # linear segments only use the start and end points
+    y[:-1][~is_bezier, 1:3] = 0
+    keep = times[:-1] != times[1:]
+    return times[:-1][keep], times[1:][keep], y[:-1][keep], is_bezier[keep], duration
+
+
+def same_index(renderer, index):
+    # whether a decoded index is the one the renderer samples with
+    return len(renderer.index) == len(index) and all(
+        bucket_ticks == expected_ticks and list(first_segments) == expected_first.tolist()
+        for (expected_ticks, expected_first), (bucket_ticks, first_segments) in zip(renderer.index, index)
+    )
+
+
+def same_segments(json_events, points):
+    expected = envelope_segments(json_events)
+    actual = decoded_envelope_segments(points)
+    expected_y = expected[2].copy()
+    expected_y[~expected[3], 1:3] = 0
+    return (
+        np.array_equal(expected[0], actual[0]) and np.array_equal(expected[1], actual[1])
+        and np.array_equal(expected_y, actual[2]) and np.array_equal(expected[3], actual[3])
+        and expected[4] == actual[4]
+    )
+
+
+if __name__ == "__main__":
+    # every set in data by default
+    filepaths = argv[1:] or sorted(glob.glob("data/*.als"))
+    if not filepaths:
+        logging.error("Usage: python pattern_codec.py <patterns.json|set.als>...")
+        exit()
+
+    from als import compile_patterns
+    failed = False
+    for filepath in filepaths:
+        if filepath.endswith(".als"):
+            patterns = compile_patterns(filepath, channel_order=None)
+        else:
+            patterns = json.load(open(filepath))
+        json_bytes = sum(len(json.dumps(p).replace(" ", "")) for p in patterns)
+
+        start = time.perf_counter()
+        encoded = [encode_pattern(p) for p in patterns]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [decode_pattern(e) for e in encoded]
+        decode_time = time.perf_counter() - start
+
+        mismatches = [
+            p["name"] for p, d in zip(patterns, decoded)
+            if p["name"] != d["name"] or len(p["data"]) != len(d["data"])
+            or not all(same_segments(events, points) for events, points in zip(p["data"], d["data"]))
+            or not same_index(PatternRenderer(p), d["index"])
+        ]
+        # with no index, every channel is scanned from its first segment
+        unindexed = [decode_pattern(encode_pattern(p, min_indexed_segments=None))["index"] for p in patterns]
+        mismatches += [p["name"] for p, index in zip(patterns, unindexed) if any(bucket_ticks for bucket_ticks, _ in index)]
+        # indexed sampling against a plain scan, with every channel that has segments indexed
+        start = time.perf_counter()
+        checked = [index_mismatches(PatternRenderer(p, min_indexed_segments=1)) for p in patterns]
+        check_time = time.perf_counter() - start
+        mismatches += [p["name"] for p, (differing, _) in zip(patterns, checked) if differing]
+        failed = failed or bool(mismatches)
+        binary_bytes = sum(len(e) + 1 for e in encoded)
+        index_bytes = binary_bytes - sum(len(encode_pattern(p, version=2)) + 1 for p in patterns)
+        print(
+            f"{filepath}: {len(patterns)} patterns, JSON {json_bytes} bytes, binary {binary_bytes} bytes "
+            f"({index_bytes} of them segment indices) "
+            f"({json_bytes / max(binary_bytes, 1):.1f}x smaller), encode {encode_time * 1000:.1f}ms, "
+            f"decode {decode_time * 1000:.1f}ms, {sum(samples for _, samples in checked)} indexed samples checked in "
+            f"{check_time * 1000:.0f}ms, {'round trip OK' if not mismatches else f'MISMATCHED: {mismatches}'}"
+        )
+    if failed:
+        exit(1)
@@ -0,0 +1,214 @@
+import json
+import logging
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+from pattern_codec import encode_pattern
+from pattern_sync import HASH_SIZE
+from playback import FRAME_INTERVAL_US, OUTPUTS_COUNT
+from renderer import PatternRenderer
+
+# sizeof on the ESP32 (32 bit): Vec2 8, CurveSegment 40, BezierSegment 48,
+# BezierEnvelope 16 (duration and a std::vector), a (channel, SegmentIndex)
+# 20, std::string 24 (with 15 characters inline), BezierPattern 32
+SEGMENT_BYTES = 48
+ENVELOPE_BYTES = 16
+SEGMENT_INDEX_BYTES = 20
+INDEX_ENTRY_BYTES = 2
+STRING_BYTES = 24
+STRING_INLINE = 15
+PATTERN_BYTES = 32
+MAP_NODE_BYTES = 16  # red-black tree links and colour, before the key and value
+HEAP_BLOCK_BYTES = 8  # rough multi_heap overhead per allocation
+
+# Rough costs of the work the frame timer does on a 240MHz ESP32 with the
+# Wire default 100kHz I2C clock, in microseconds. Calibrate them against
+# the FPS the controller logs with --costs.
+COSTS = {
+    "frame_us": 20.0,  # makeFrame's own vectors and the gain and multiplier pass
+    "pattern_us": 10.0,  # the map lookup and double fmod for each playing pattern
+    "sample_us": 2.0,  # valueAt and the double clamp, per channel
+    "scan_us": 0.06,  # one comparison in sampleAtTime's search from the indexed segment
+    "set_pwm_us": 560.0,  # a PCA9685 setPWM, 6 bytes on the bus, per changed output
+}
+
+BUDGET = {
+    "heap_bytes": 160 * 1024,  # what's left for patterns next to WiFi and the websocket server
+    "frame_us": FRAME_INTERVAL_US,
+    "concurrent_patterns": 4,
+}
+
+
+def string_bytes(length):
+    # longer strings than fit inline get their own allocation
+    return STRING_BYTES + (length + 1 + HEAP_BLOCK_BYTES if length > STRING_INLINE else 0)
+
+
+def pattern_cost(pattern, costs=COSTS):
+    """
+    What a {"name", "data"} pattern costs the firmware: the heap it holds
+    once added, the segments sampleAtTime scans and the outputs that change
+    per frame at speed 1, and the microseconds one frame of it takes to
+    compute in the worst frame, before writing outputs.
+    """
+    renderer = PatternRenderer(pattern)
+    counts = np.diff(renderer.offsets)
+    channels = renderer.num_outputs
+    index_entries = [len(first_segments) for _, first_segments in renderer.index if len(first_segments)]
+    memory = (
+        MAP_NODE_BYTES + HEAP_BLOCK_BYTES + string_bytes(len(pattern["name"])) + PATTERN_BYTES  # patterns entry
+        + MAP_NODE_BYTES + HEAP_BLOCK_BYTES + string_bytes(len(pattern["name"])) + string_bytes(2 * HASH_SIZE)  # patternHashes entry
+        + channels * ENVELOPE_BYTES + HEAP_BLOCK_BYTES
+        + int(counts.sum()) * SEGMENT_BYTES + int((counts > 0).sum()) * HEAP_BLOCK_BYTES
+        + (HEAP_BLOCK_BYTES if index_entries else 0)
+        + len(index_entries) * (SEGMENT_INDEX_BYTES + HEAP_BLOCK_BYTES) + sum(index_entries) * INDEX_ENTRY_BYTES
+    )
+
+    times = np.arange(0, renderer.duration, FRAME_INTERVAL_US / 1000000.0)
+    scanned = renderer.segments_scanned(times) if len(times) else np.zeros(1, dtype=np.int64)
+    frames = renderer.sample(times)
+    # from the outputs of the default frame, all zeros
+    changed = (np.diff(frames, axis=0, prepend=0) != 0).sum(axis=1) if len(frames) else np.zeros(1, dtype=np.int64)
+
+    frame_us = (
+        costs["pattern_us"]
+        + channels * costs["sample_us"]
+        + int(scanned.max()) * costs["scan_us"]
+    )
+    try:
+        upload_bytes = message_bytes = len(encode_pattern(pattern))
+    except ValueError:
+        # can only go as JSON, so that is the message held while adding it
+        upload_bytes, message_bytes = None, len(json.dumps(pattern, separators=(",", ":")))
+    return {
+        "name": pattern["name"],
+        "channels": channels,
+        "segments": renderer.num_segments,
+        "max_envelope_segments": int(counts.max(initial=0)),
+        "memory_bytes": memory,
+        "upload_bytes": upload_bytes,
+        # held while adding it: the message, its parsed copy and the copy the map keeps
+        "add_bytes": memory + message_bytes,
+        "mean_segments_scanned": float(scanned.mean()),
+        "max_segments_scanned": int(scanned.max()),
+        "mean_changed_outputs": float(changed.mean()),
+        "max_changed_outputs": int(changed.max()),
+        "frame_us": frame_us,
+    }
+
+
+def set_cost(pattern_costs, concurrent_patterns, costs=COSTS, outputs=OUTPUTS_COUNT):
+    """
+    Totals for a set: the heap it holds, the peak while the largest pattern
+    is being added (its upload, its parsed copy and the copy the map keeps),
+    and the worst frame with the concurrent_patterns most expensive patterns
+    playing, counting the I2C writes for every output they change.
+    """
+    def cost_us(cost):
+        return cost["frame_us"] + cost["max_changed_outputs"] * costs["set_pwm_us"]
+    worst = sorted(pattern_costs, key=cost_us, reverse=True)[:concurrent_patterns]
+    changed = min(outputs, sum(cost["max_changed_outputs"] for cost in worst))
+    compute_us = costs["frame_us"] + sum(cost["frame_us"] for cost in worst)
+    memory = sum(cost["memory_bytes"] for cost in pattern_costs)
+    largest = max(pattern_costs, key=lambda cost: cost["add_bytes"], default=None)
+    return {
+        "patterns": len(pattern_costs),
+        "segments": sum(cost["segments"] for cost in pattern_costs),
+        "memory_bytes": memory,
+        "peak_memory_bytes": memory + (largest["add_bytes"] if largest else 0),
+        "concurrent_patterns": len(worst),
+        "worst_patterns": [cost["name"] for cost in worst],
+        "max_segments_scanned": sum(cost["max_segments_scanned"] for cost in worst),
+        "compute_us": compute_us,
+        "write_us": changed * costs["set_pwm_us"],
+        "frame_us": compute_us + changed * costs["set_pwm_us"],
+    }
+
+
+def check_budget(totals, budget=BUDGET):
+    # a message for each way the set goes over budget
+    problems = []
+    if totals["peak_memory_bytes"] > budget["heap_bytes"]:
+        problems.append(f"needs {totals['peak_memory_bytes'] / 1024:.1f}KiB of heap while adding patterns, over the {budget['heap_bytes'] / 1024:.1f}KiB budget")
+    if totals["frame_us"] > budget["frame_us"]:
+        problems.append(
+            f"a frame with {', '.join(totals['worst_patterns'])} playing takes about {totals['frame_us'] / 1000:.1f}ms "
+            f"({totals['write_us'] / 1000:.1f}ms of it writing outputs), over the {budget['frame_us'] / 1000:.1f}ms budget"
+        )
+    return problems
+
+
+def cost_report(patterns, budget=BUDGET, costs=COSTS):
+    pattern_costs = [pattern_cost(pattern, costs) for pattern in patterns]
+    totals = set_cost(pattern_costs, budget["concurrent_patterns"], costs)
+    return pattern_costs, totals, check_budget(totals, budget)
+
+
+def log_cost_report(patterns, budget=BUDGET, costs=COSTS):
+    """
+    Log the set's totals and a warning for each way it goes over budget,
+    returning the problems.
+    """
+    pattern_costs, totals, problems = cost_report(patterns, budget, costs)
+    logging.info(
+        f"Patterns need {totals['memory_bytes'] / 1024:.1f}KiB of heap ({totals['peak_memory_bytes'] / 1024:.1f}KiB peak), "
+        f"worst frame with {totals['concurrent_patterns']} playing about {totals['frame_us'] / 1000:.1f}ms"
+    )
+    for problem in problems:
+        logging.warning(f"Over budget: {problem}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Estimate what each pattern of a set costs the controller, and check the set against a budget")
+    parser.add_argument("filepath", help="set.als or patterns.json")
+    parser.add_argument("--all-channels", action="store_true", help="every macro envelope in the set, for sets with their own channel names")
+    parser.add_argument("--max-error", type=float, help="simplify envelopes first, see als.simplify_envelope")
+    parser.add_argument("--concurrent", type=int, default=BUDGET["concurrent_patterns"], help="patterns playing at once in the worst frame")
+    parser.add_argument("--heap-kb", type=float, default=BUDGET["heap_bytes"] / 1024)
+    parser.add_argument("--frame-ms", type=float, default=BUDGET["frame_us"] / 1000)
+    parser.add_argument("--costs", help="JSON file overriding entries of COSTS")
+    parser.add_argument("--fail", action="store_true", help="exit with an error when over budget, rather than warn")
+    parser.add_argument("--sort", default="frame_us", help="column to sort patterns by")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    costs = dict(COSTS)
+    if args.costs:
+        with open(args.costs) as f:
+            costs.update(json.load(f))
+    budget = {"heap_bytes": args.heap_kb * 1024, "frame_us": args.frame_ms * 1000, "concurrent_patterns": args.concurrent}
+    if args.filepath.endswith(".als"):
+        from als import CHANNEL_ORDER
+        from pattern_cache import PatternCache
+        patterns = PatternCache().load(args.filepath, channel_order=None if args.all_channels else CHANNEL_ORDER, max_error=args.max_error)
+    else:
+        patterns = json.load(open(args.filepath))
+
+    pattern_costs, totals, problems = cost_report(patterns, budget, costs)
+    pattern_costs.sort(key=lambda cost: cost[args.sort], reverse=True)
+    if args.json:
+        print(json.dumps({"patterns": pattern_costs, "totals": totals, "problems": problems}, indent=2))
+    else:
+        print(f"{'pattern':<24} {'segments':>8} {'heap KiB':>8} {'scanned/frame':>14} {'changed/frame':>14} {'frame ms':>8}")
+        for cost in pattern_costs:
+            print(
+                f"{cost['name']:<24} {cost['segments']:>8} {cost['memory_bytes'] / 1024:>8.1f} "
+                f"{cost['mean_segments_scanned']:>7.0f} / {cost['max_segments_scanned']:<4} "
+                f"{cost['mean_changed_outputs']:>7.1f} / {cost['max_changed_outputs']:<4} {cost['frame_us'] / 1000:>8.2f}"
+            )
+        print(
+            f"{totals['patterns']} patterns, {totals['segments']} segments: {totals['memory_bytes'] / 1024:.1f}KiB of heap, "
+            f"{totals['peak_memory_bytes'] / 1024:.1f}KiB while adding the largest"
+        )
+        print(
+            f"Worst frame with {totals['concurrent_patterns']} playing ({', '.join(totals['worst_patterns'])}): "
+            f"{totals['max_segments_scanned']} segments scanned, {totals['compute_us'] / 1000:.2f}ms computing "
+            f"+ {totals['write_us'] / 1000:.2f}ms writing outputs = {totals['frame_us'] / 1000:.2f}ms"
+        )
+    for problem in problems:
+        logging.warning(f"Over budget: {problem}")
+    if problems and args.fail:
+        sys.exit(1)
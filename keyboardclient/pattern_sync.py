@@ -0,0 +1,27 @@
+import hashlib
+import json
+
+HASH_SIZE = 8  # bytes of digest, sent to the controller as hex
+
+
+def pattern_hash(pattern):
+    """
+    Content hash of a pattern's envelopes. The name is the manifest key, so
+    renaming a pattern reads as removing one and adding another.
+    """
+    data = json.dumps(pattern["data"], separators=(",", ":"))
+    return hashlib.blake2b(data.encode(), digest_size=HASH_SIZE).hexdigest()
+
+
+def pattern_manifest(patterns):
+    return {pattern["name"]: pattern_hash(pattern) for pattern in patterns}
+
+
+def diff_manifests(local, remote):
+    """
+    Compare the client's manifest with the one the controller reports,
+    returning the names to send (new or changed) and to remove.
+    """
+    to_send = [name for name, content_hash in local.items() if remote.get(name) != content_hash]
+    to_remove = [name for name in remote if name not in local]
+    return to_send, to_remove
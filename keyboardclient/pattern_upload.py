@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+
+UPLOAD_WINDOW = 4
+ACK_TIMEOUT = 5  # large JSON patterns take the controller a while to parse
+MAX_ATTEMPTS = 3
+# below this much free heap on the controller, only keep one pattern in flight
+LOW_HEAP_BYTES = 64 * 1024
+COMMAND_ACK = 255  # FaderClient.COMMAND_ACK
+
+
+class PatternUploader:
+    """
+    Sends pattern messages over a websocket keeping up to window of them
+    unacknowledged at once. The controller acknowledges each pattern by name
+    ({"type": 255, "data": {"name", "ok", "free_heap"}}) once it has parsed
+    it, and rejects messages it could not read without a name. Rejected
+    patterns are resent, and everything in flight is resent if no
+    acknowledgement arrives within ack_timeout.
+
+    Back-pressure comes from two places: websocket.send waits while the
+    connection's write buffer is full, and the window drops to one pattern
+    while the controller reports less than low_heap free bytes.
+    """
+
+    def __init__(self, websocket, window=UPLOAD_WINDOW, ack_timeout=ACK_TIMEOUT, max_attempts=MAX_ATTEMPTS, low_heap=LOW_HEAP_BYTES):
+        self.websocket = websocket
+        self.window = max(1, window)
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.low_heap = low_heap
+
+    async def upload(self, messages):
+        """
+        Upload (name, message) pairs, returning a dict of statistics including
+        the names of patterns that failed every attempt.
+        """
+        pending = deque(messages)
+        in_flight = OrderedDict()  # name -> message, oldest first
+        attempts = {}
+        window = self.window
+        stats = {"patterns": 0, "bytes": 0, "retries": 0, "timeouts": 0, "failed": []}
+        start = time.perf_counter()
+
+        def retry(name, message):
+            if attempts[name] >= self.max_attempts:
+                logging.error(f"Giving up on pattern {name} after {attempts[name]} attempts")
+                stats["failed"].append(name)
+            else:
+                stats["retries"] += 1
+                pending.appendleft((name, message))
+
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                name, message = pending.popleft()
+                if name in in_flight:
+                    # an earlier copy is still unacknowledged, wait for it
+                    pending.appendleft((name, message))
+                    break
+                await self.websocket.send(message)
+                attempts[name] = attempts.get(name, 0) + 1
+                in_flight[name] = message
+
+            try:
+                reply = await asyncio.wait_for(self.websocket.recv(), self.ack_timeout)
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                logging.warning(f"No acknowledgement in {self.ack_timeout}s, resending {len(in_flight)} patterns")
+                for name, message in reversed(in_flight.items()):
+                    retry(name, message)
+                in_flight.clear()
+                continue
+
+            ack = self.parse_ack(reply)
+            if ack is None:
+                continue
+            name = ack.get("name")
+            if name not in in_flight:
+                if name or not in_flight:
+                    continue  # a late acknowledgement for a pattern already resent
+                name = next(iter(in_flight))  # the controller handles messages in order
+            message = in_flight.pop(name)
+
+            if "free_heap" in ack:
+                window = 1 if ack["free_heap"] < self.low_heap else self.window
+            if ack.get("ok"):
+                stats["patterns"] += 1
+                stats["bytes"] += len(message)
+            else:
+                logging.warning(f"Controller rejected pattern {name}")
+                retry(name, message)
+
+        stats["elapsed"] = time.perf_counter() - start
+        return stats
+
+    @staticmethod
+    def parse_ack(reply):
+        if isinstance(reply, bytes):
+            return None
+        try:
+            message = json.loads(reply)
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or message.get("type") != COMMAND_ACK:
+            return None
+        data = message.get("data")
+        return data if isinstance(data, dict) else None
+
+
+def throughput_summary(stats):
+    elapsed = max(stats["elapsed"], 1e-9)
+    return (
+        f"{stats['patterns']} patterns, {stats['bytes'] / 1024:.1f}KiB in {elapsed:.2f}s "
+        f"({stats['patterns'] / elapsed:.1f} patterns/s, {stats['bytes'] / 1024 / elapsed:.1f}KiB/s), "
+        f"{stats['retries']} retries, {stats['timeouts']} timeouts, {len(stats['failed'])} failed"
+    )
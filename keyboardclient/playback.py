@@ -0,0 +1,285 @@
+import json
+import logging
+import math
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from fader_client import FaderClient
+from renderer import MAX_OUTPUT, PatternRenderer
+
+# the firmware's constants, see FaderPlayback.h and main.cpp
+OUTPUTS_COUNT = 32
+FRAME_INTERVAL_US = 20000
+MAX_CONCURRENT_PATTERNS = 10
+QUANTIZE_TIME_US = 10000
+MAX_START_DELAY_US = 1000000
+
+
+class PatternPlayback:
+    def __init__(self, name, start_time, loop):
+        self.name = name
+        self.start_time = start_time
+        self.loop = loop
+
+
+class FaderPlayback:
+    """
+    Python model of the firmware's FaderPlayback, for working out what a
+    controller outputs without one. Commands are applied at a time in
+    microseconds on the controller's clock, like esp_timer_get_time, and
+    make_frames computes the frames for a run of times between commands all
+    at once.
+
+    As in makeFrame, active patterns are summed, clamped to 4095, then
+    scaled by gain and the multiplier with >> 12. A pattern's position is
+    the time since it started times the current speed, wrapped for looping
+    patterns, while one-shots stop once past their duration. A pattern
+    starting within 10ms of one already playing takes that one's start
+    time. The default frame, sent while nothing plays, is all zeros as in
+    main.cpp.
+    """
+
+    def __init__(self, patterns, outputs=OUTPUTS_COUNT):
+        self.renderers = {pattern["name"]: PatternRenderer(pattern) for pattern in patterns}
+        self.outputs = outputs
+        self.active = []
+        self.speed = 1.0
+        self.gain = MAX_OUTPUT  # set by setup() in main.cpp
+        self.multiplier = np.full(outputs, MAX_OUTPUT, dtype=np.uint32)
+        self.paused = False
+        self.current_frame = np.zeros(outputs, dtype=np.uint16)
+
+    def start_pattern(self, name, loop, now, start_time=-1):
+        if len(self.active) > MAX_CONCURRENT_PATTERNS:
+            logging.debug(f"Max concurrent patterns reached, not adding {name}")
+            return
+        if name not in self.renderers:
+            logging.debug(f"Invalid pattern name {name}")
+            return
+        scheduled = start_time >= 0
+        if scheduled:
+            now = min(start_time, now + MAX_START_DELAY_US)
+        playing = next((playback for playback in self.active if playback.name == name), None)
+        if playing is not None:
+            playing.start_time = now
+            return
+        if not scheduled:
+            for playback in self.active:
+                # scheduled starts still to come are not ones to snap to
+                if playback.start_time <= now and now - playback.start_time < QUANTIZE_TIME_US:
+                    now = playback.start_time
+        self.active.append(PatternPlayback(name, now, loop))
+
+    def stop_pattern(self, name):
+        self.active = [playback for playback in self.active if playback.name != name]
+
+    def stop_all(self):
+        self.active = []
+
+    def set_gain(self, gain):
+        self.gain = min(int(gain), MAX_OUTPUT)
+
+    def set_speed(self, speed):
+        self.speed = float(np.float32(speed))  # a float on the controller
+
+    def set_multiplier(self, multiplier):
+        multiplier = list(multiplier)[:self.outputs]
+        self.multiplier = np.array(multiplier + [MAX_OUTPUT] * (self.outputs - len(multiplier)), dtype=np.uint32)
+
+    def set_paused(self, paused):
+        self.paused = bool(paused)
+
+    def handle_command(self, command, now):
+        """
+        Apply a (type, data) command, as FaderClient sends it, arriving at
+        now. Commands that don't affect the output are ignored.
+        """
+        command_type, data = command
+        if command_type == FaderClient.COMMAND_START_PATTERN:
+            self.set_paused(False)
+            self.start_pattern(data["name"], data.get("loop", False), now, data.get("at", -1))
+        elif command_type == FaderClient.COMMAND_STOP_PATTERN:
+            self.stop_pattern(data["name"])
+        elif command_type == FaderClient.COMMAND_STOP_ALL:
+            self.stop_all()
+        elif command_type == FaderClient.COMMAND_SET_GAIN:
+            self.set_gain(data)
+        elif command_type == FaderClient.COMMAND_SET_SPEED:
+            if data["speed"] == "+":
+                self.set_speed(self.speed * 1.05)
+            elif data["speed"] == "-":
+                self.set_speed(self.speed * 0.95)
+            else:
+                self.set_speed(data["speed"])
+        elif command_type == FaderClient.COMMAND_SET_MULTIPLIER:
+            self.set_multiplier(data)
+        elif command_type == FaderClient.COMMAND_SET_PAUSED:
+            self.set_paused(data["paused"])
+
+    def make_frames(self, times):
+        """
+        The frames makeFrame would compute at each of times (microseconds,
+        ascending) with no commands in between, as uint16 of shape
+        (len(times), outputs). One-shots that end are stopped, like makeFrame
+        does.
+        """
+        times = np.asarray(times, dtype=np.int64)
+        combined = np.zeros((len(times), self.outputs), dtype=np.uint32)
+        finished = []
+        for playback in self.active:
+            renderer = self.renderers[playback.name]
+            started = times >= playback.start_time
+            delta = (times - playback.start_time) / 1000000.0 * self.speed
+            playing = started
+            if not playback.loop:
+                over = started & (delta > renderer.duration)
+                if over.any():
+                    finished.append(playback)
+                    playing = started & (np.arange(len(times)) < np.argmax(over))
+            if renderer.duration <= 0 or not playing.any():
+                continue
+            frames = renderer.sample(np.fmod(delta[playing], renderer.duration))
+            width = min(renderer.num_outputs, self.outputs)
+            combined[playing, :width] += frames[:, :width]
+        for playback in finished:
+            self.stop_pattern(playback.name)
+
+        np.minimum(combined, MAX_OUTPUT, out=combined)
+        combined = (combined * self.gain) >> 12
+        combined = (combined * self.multiplier) >> 12
+        return combined.astype(np.uint16)
+
+    def replay(self, commands, end_time, start_time=0, frame_interval=FRAME_INTERVAL_US):
+        """
+        Replay (time, command) pairs, returning the times of the frame timer
+        from start_time to end_time and the frame sent at each. A command
+        arriving at the same time as a frame is applied first. Frames hold
+        while paused, as sendFrame sends nothing then.
+        """
+        times = np.arange(start_time, end_time, frame_interval, dtype=np.int64)
+        frames = np.empty((len(times), self.outputs), dtype=np.uint16)
+        position = 0
+        for command_time, command in sorted(commands, key=lambda entry: entry[0]) + [(math.inf, None)]:
+            end = int(np.searchsorted(times, command_time, side="left"))
+            if end > position:
+                if self.paused:
+                    frames[position:end] = self.current_frame
+                else:
+                    frames[position:end] = self.make_frames(times[position:end])
+                    self.current_frame = frames[end - 1]
+                position = end
+            if command is not None:
+                self.handle_command(command, command_time)
+        return times, frames
+
+
+def read_commands(filename):
+    # JSON lines of {"time": microseconds, "type", "data"}
+    with open(filename) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return [(entry["time"], (entry["type"], entry["data"])) for entry in entries]
+
+
+def benchmark(patterns, max_patterns, frames, outputs=OUTPUTS_COUNT):
+    """
+    Frames per second the simulator computes with 1 to max_patterns looping
+    patterns playing, and the segments sampleAtTime scans per frame on the
+    controller, the work that limits its frame rate.
+    """
+    playback = FaderPlayback(patterns, outputs)
+    # the patterns with the most segments, the worst case for the controller
+    renderers = sorted(playback.renderers.values(), key=lambda renderer: renderer.num_segments, reverse=True)
+    renderers = [renderer for renderer in renderers if renderer.duration > 0][:max_patterns]
+    times = np.arange(frames, dtype=np.int64) * FRAME_INTERVAL_US
+    results = []
+    for count in range(1, len(renderers) + 1):
+        playback.stop_all()
+        for index, renderer in enumerate(renderers[:count]):
+            # far enough apart not to be quantized together
+            playback.start_pattern(renderer.name, True, index * 2 * QUANTIZE_TIME_US)
+        start = time.perf_counter()
+        playback.make_frames(times)
+        elapsed = time.perf_counter() - start
+
+        scanned = np.zeros(frames, dtype=np.int64)
+        for entry in playback.active:
+            renderer = playback.renderers[entry.name]
+            started = times >= entry.start_time
+            delta = (times[started] - entry.start_time) / 1000000.0 * playback.speed
+            scanned[started] += renderer.segments_scanned(np.fmod(delta, renderer.duration))
+        results.append({
+            "patterns": count,
+            "fps": frames / elapsed,
+            "mean_segments_scanned": float(scanned.mean()),
+            "max_segments_scanned": int(scanned.max()),
+        })
+    return results
+
+
+def check_quantize():
+    """
+    Where unscheduled starts land next to patterns already started or
+    scheduled, as startPattern quantizes them. Returns the cases that
+    don't, as (case, start time, expected start time).
+    """
+    patterns = [{"name": name, "data": [[[0, 0], [1, 1]]]} for name in ["a", "b"]]
+    cases = [
+        # (case, when a's start arrives, a's scheduled start or -1, when b's unscheduled start arrives, b's expected start)
+        ("just after a start", 1000000, -1, 1005000, 1000000),
+        ("a quantize interval after a start", 1000000, -1, 1000000 + QUANTIZE_TIME_US, 1000000 + QUANTIZE_TIME_US),
+        ("before a scheduled start still to come", 900000, 1500000, 1495000, 1495000),
+        ("just after a scheduled start", 900000, 1500000, 1505000, 1500000),
+    ]
+    failures = []
+    for case, a_now, a_at, b_now, expected in cases:
+        playback = FaderPlayback(patterns)
+        playback.start_pattern("a", True, a_now, a_at)
+        playback.start_pattern("b", True, b_now)
+        b_start = next(entry.start_time for entry in playback.active if entry.name == "b")
+        if b_start != expected:
+            failures.append((case, b_start, expected))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Simulate the controller's FaderPlayback")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="replay timed commands into an array of frames")
+    replay_parser.add_argument("commands", help='JSON lines of {"time": microseconds, "type", "data"}')
+    replay_parser.add_argument("output", help=".npy file for the frames, shape (frames, outputs)")
+    replay_parser.add_argument("--als", default="data/ew4lx_final2.als")
+    replay_parser.add_argument("--tail", type=float, default=1.0, help="seconds to keep going after the last command")
+    bench_parser = subparsers.add_parser("bench", help="frames per second with more and more patterns playing")
+    bench_parser.add_argument("--als", default="data/ew4lx_final2.als")
+    bench_parser.add_argument("--max-patterns", type=int, default=MAX_CONCURRENT_PATTERNS + 1)
+    bench_parser.add_argument("--frames", type=int, default=3000, help="frames to compute at each count")
+    subparsers.add_parser("check", help="check the model quantizes starts as the firmware does")
+    args = parser.parse_args()
+
+    if args.command == "check":
+        failures = check_quantize()
+        for case, start_time, expected in failures:
+            print(f"Start {case}: at {start_time}us, expected {expected}us")
+        print("Quantize check " + ("failed" if failures else "OK"))
+        exit(1 if failures else 0)
+
+    from pattern_cache import PatternCache
+    patterns = PatternCache().load(args.als)
+
+    if args.command == "replay":
+        commands = read_commands(args.commands)
+        end_time = max((command_time for command_time, _ in commands), default=0) + int(args.tail * 1000000)
+        start = time.perf_counter()
+        times, frames = FaderPlayback(patterns).replay(commands, end_time)
+        elapsed = time.perf_counter() - start
+        np.save(args.output, frames)
+        print(f"Replayed {len(commands)} commands into {len(frames)} frames in {elapsed * 1000:.1f}ms, written to {args.output}")
+    elif args.command == "bench":
+        print(f"{'patterns':>8} {'sim fps':>10} {'segments scanned per frame (mean/max)':>40}")
+        for result in benchmark(patterns, args.max_patterns, args.frames):
+            print(
+                f"{result['patterns']:>8} {result['fps']:>10.0f} "
+                f"{result['mean_segments_scanned']:>30.0f} / {result['max_segments_scanned']}"
+            )
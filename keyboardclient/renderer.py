@@ -0,0 +1,263 @@
+import json
+import logging
+import time
+from sys import argv
+
+import numpy as np
+
+DEFAULT_SAMPLE_RATE = 50  # the firmware frame timer runs every 20ms
+MAX_OUTPUT = 4095
+TICKS_PER_SECOND = 1000  # time resolution of binary patterns, see pattern_codec.py
+BUCKETS_PER_SEGMENT = 1
+MIN_INDEXED_SEGMENTS = 8  # scanning fewer is about as quick as looking them up
+MAX_INDEX_ENTRIES = 0xFFFF  # the firmware keeps segment indices as uint16
+
+
+def quantize_y(y):
+    # Vec2(float x, float y) stores y as static_cast<uint8_t>(y * 255)
+    return np.clip(y * np.float32(255), 0, 255).astype(np.uint8)
+
+
+def envelope_segments(events):
+    """
+    Build the segments BezierEnvelope::loadEvents would for a list of
+    [time, value(, c1x, c1y, c2x, c2y)] events, as arrays of start times,
+    end times, quantized y control points (n, 4) and a Bezier/linear flag.
+    """
+    events = [event for event in events if len(event) >= 2]
+    duration = float(np.float32(events[-1][0])) if events else 0.0
+    if len(events) < 2:
+        return np.empty(0, np.float32), np.empty(0, np.float32), np.empty((0, 4), np.uint8), np.empty(0, bool), duration
+
+    times = np.array([event[0] for event in events], dtype=np.float32)
+    values = np.array([event[1] for event in events], dtype=np.float32)
+    controls = np.array([event[2:6] if len(event) == 6 else (0, 0, 0, 0) for event in events], dtype=np.float32)
+    is_bezier = np.array([len(event) == 6 for event in events])
+
+    start_values, end_values = values[:-1], values[1:]
+    delta = end_values - start_values
+    y = np.stack([
+        start_values,
+        start_values + delta * controls[:-1, 1],
+        start_values + delta * controls[:-1, 3],
+        end_values,
+    ], axis=1)
+
+    # zero-length segments are skipped
+    keep = times[:-1] != times[1:]
+    return times[:-1][keep], times[1:][keep], quantize_y(y[keep]), is_bezier[:-1][keep], duration
+
+
+def segment_index(starts, ends, ticks_per_second=TICKS_PER_SECOND, min_segments=MIN_INDEXED_SEGMENTS):
+    """
+    Index of an envelope's segments by time, so sampleAtTime can start
+    looking where the time could be instead of at the first segment. Time
+    is cut into buckets of bucket_ticks, about one per segment, and
+    first_segments holds for each bucket the first segment that ends at or
+    after its start. Envelopes with fewer than min_segments get none, and
+    None indexes nothing. Returns (bucket_ticks, first_segments), with
+    bucket_ticks 0 when there is nothing to index.
+    """
+    if min_segments is None or len(ends) < min_segments or len(ends) > MAX_INDEX_ENTRIES:
+        return 0, np.empty(0, np.uint16)
+    duration_ticks = int(np.ceil(float(ends[-1]) * ticks_per_second))
+    bucket_ticks = max(1, -(-duration_ticks // (len(ends) * BUCKETS_PER_SEGMENT)), -(-(duration_ticks + 1) // MAX_INDEX_ENTRIES))
+    bucket_count = duration_ticks // bucket_ticks + 1
+    # half a tick early, so a time the controller's float maths puts in a
+    # bucket a hair before its start never skips the segment it's in. That
+    # holds while float32 times are good to half a tick, for over an hour.
+    bucket_starts = (np.arange(bucket_count) * bucket_ticks - 0.5) / ticks_per_second
+    first_segments = np.searchsorted(ends.astype(np.float64), bucket_starts, side="left")
+    return bucket_ticks, first_segments.astype(np.uint16)
+
+
+def index_buckets(times, bucket_ticks, bucket_count, ticks_per_second=TICKS_PER_SECOND):
+    # the bucket sampleAtTime looks up for each time, with the same float32 maths
+    buckets_per_second = np.float32(ticks_per_second) / np.float32(bucket_ticks)
+    buckets = np.floor(times.astype(np.float32) * buckets_per_second).astype(np.int64)
+    return np.clip(buckets, 0, bucket_count - 1)
+
+
+class PatternRenderer:
+    """
+    Vectorized equivalent of the firmware's BezierPattern::getFrameAtTime,
+    sampling every channel of a pattern at many times in one call. Channels
+    are indexed as encode_pattern would with the same min_indexed_segments.
+    """
+
+    def __init__(self, pattern, min_indexed_segments=MIN_INDEXED_SEGMENTS):
+        self.name = pattern.get("name") if isinstance(pattern, dict) else None
+        data = pattern["data"] if isinstance(pattern, dict) else pattern
+        self.num_outputs = len(data)
+
+        segments = [envelope_segments(events) for events in data]
+        self.duration = max((s[4] for s in segments), default=0.0)
+        counts = np.array([len(s[0]) for s in segments], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.starts = np.concatenate([s[0] for s in segments]) if segments else np.empty(0, np.float32)
+        self.ends = np.concatenate([s[1] for s in segments]) if segments else np.empty(0, np.float32)
+        self.y = (np.concatenate([s[2] for s in segments]) if segments else np.empty((0, 4), np.uint8)).astype(np.float32) / np.float32(255)
+        self.is_bezier = np.concatenate([s[3] for s in segments]) if segments else np.empty(0, bool)
+        self.channels = np.repeat(np.arange(self.num_outputs), counts)
+        self.index = [
+            segment_index(self.starts[start:end], self.ends[start:end], min_segments=min_indexed_segments)
+            for start, end in zip(self.offsets[:-1], self.offsets[1:])
+        ]
+
+    @property
+    def num_segments(self):
+        return len(self.starts)
+
+    def times(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        return np.arange(0, self.duration, 1 / sample_rate)
+
+    def locate(self, times):
+        """
+        For float32 times, the segment each channel samples at each time, of
+        shape (len(times), num_outputs), whether the time is inside it, and
+        the segment the search for it started from.
+        """
+        # like sampleAtTime: from the segment the index gives, go on to the
+        # first that ends at or after the time
+        first = np.empty((len(times), self.num_outputs), dtype=np.int64)
+        for channel, (bucket_ticks, first_segments) in enumerate(self.index):
+            if bucket_ticks:
+                buckets = index_buckets(times, bucket_ticks, len(first_segments))
+                first[:, channel] = self.offsets[channel] + first_segments[buckets]
+            else:
+                first[:, channel] = self.offsets[channel]
+        channel_end = np.broadcast_to(self.offsets[np.newaxis, 1:], first.shape).ravel()
+        sample_times = np.broadcast_to(times[:, np.newaxis], first.shape).ravel()
+        ends = np.append(self.ends, np.float32(np.inf))  # so an index past the last segment can be looked up
+        index = first.ravel().copy()
+        behind = np.nonzero((index < channel_end) & (ends[index] < sample_times))[0]
+        while len(behind):
+            index[behind] += 1
+            behind = behind[(index[behind] < channel_end[behind]) & (ends[index[behind]] < sample_times[behind])]
+        index = index.reshape(first.shape)
+        in_channel = index < self.offsets[np.newaxis, 1:]
+        index = np.minimum(index, self.num_segments - 1)
+        # time outside every segment samples as 0
+        valid = in_channel & (self.starts[index] <= times[:, np.newaxis])
+        return index, valid, first
+
+    def scan(self, times):
+        """
+        The reference for locate, without the index: for float32 times, the
+        first segment of each channel ending at or after each time, as a
+        scan from the channel's first segment finds it, and whether the time
+        is inside it.
+        """
+        index = np.empty((len(times), self.num_outputs), dtype=np.int64)
+        for channel, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            index[:, channel] = start + np.searchsorted(self.ends[start:end], times, side="left")
+        in_channel = index < self.offsets[np.newaxis, 1:]
+        index = np.minimum(index, self.num_segments - 1)
+        valid = in_channel & (self.starts[index] <= times[:, np.newaxis])
+        return index, valid
+
+    def segments_scanned(self, times):
+        """
+        Segments BezierEnvelope::sampleAtTime looks at to sample every
+        channel at each of times: it goes through a channel's segments in
+        order, from the one the index gives, until one ends at or after the
+        time, or through all the rest.
+        """
+        times = np.asarray(times, dtype=np.float32)
+        if self.num_segments == 0 or len(times) == 0:
+            return np.zeros(len(times), dtype=np.int64)
+        index, valid, first = self.locate(times)
+        # it stops at the first segment ending at or after the time, whether or not it contains it
+        scanned = np.minimum(index - first + 1, self.offsets[np.newaxis, 1:] - first)
+        return scanned.sum(axis=1)
+
+    def sample(self, times, indexed=True):
+        """
+        Sample every channel at each of times (seconds), returning a uint16
+        array of shape (len(times), num_outputs). indexed=False finds the
+        segments with scan instead, for checking the index.
+        """
+        times = np.asarray(times, dtype=np.float32)
+        frames = np.zeros((len(times), self.num_outputs), dtype=np.uint16)
+        if self.num_segments == 0 or len(times) == 0:
+            return frames
+
+        index, valid = self.locate(times)[:2] if indexed else self.scan(times)
+        sample_times = np.broadcast_to(times[:, np.newaxis], index.shape)
+        start = self.starts[index]
+        end = self.ends[index]
+
+        t = (sample_times - start) / (end - start)
+        u = np.float32(1) - t
+        y = self.y[index]
+        linear = y[..., 0] * u + y[..., 3] * t
+        uu = u * u
+        tt = t * t
+        bezier = y[..., 0] * (uu * u)
+        bezier += y[..., 1] * np.float32(3) * uu * t
+        bezier += y[..., 2] * np.float32(3) * u * tt
+        bezier += y[..., 3] * (tt * t)
+        value = np.where(self.is_bezier[index], bezier, linear)
+
+        scaled = np.clip(value.astype(np.float64) * MAX_OUTPUT, 0, MAX_OUTPUT)
+        frames[valid] = scaled[valid].astype(np.uint16)
+        return frames
+
+    def render(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        return self.sample(self.times(sample_rate))
+
+
+def index_check_times(renderer, ticks_per_second=TICKS_PER_SECOND):
+    """
+    Times where an index is most likely to send sampling to the wrong
+    segment: every segment start and end and every bucket edge, each with
+    the float32 times either side of it and half a tick either side, along
+    with every frame at DEFAULT_SAMPLE_RATE.
+    """
+    edges = [renderer.starts, renderer.ends]
+    for bucket_ticks, first_segments in renderer.index:
+        if bucket_ticks:
+            edges.append(np.arange(len(first_segments) + 1, dtype=np.float32) * np.float32(bucket_ticks / ticks_per_second))
+    edges = np.unique(np.concatenate(edges).astype(np.float32))
+    half_tick = np.float32(0.5 / ticks_per_second)
+    times = np.concatenate([
+        edges, np.nextafter(edges, np.float32(-np.inf)), np.nextafter(edges, np.float32(np.inf)),
+        edges - half_tick, edges + half_tick, renderer.times().astype(np.float32),
+    ])
+    return np.unique(times)
+
+
+def index_mismatches(renderer):
+    # samples at index_check_times where indexed sampling differs from a plain scan, and how many were checked
+    times = index_check_times(renderer)
+    return int(np.count_nonzero(renderer.sample(times) != renderer.sample(times, indexed=False))), times.size * renderer.num_outputs
+
+
+def render_patterns(patterns, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    Render each {"name", "data"} pattern from first to last event at
+    sample_rate, returning name -> uint16 frames of shape (samples, outputs).
+    """
+    return {pattern["name"]: PatternRenderer(pattern).render(sample_rate) for pattern in patterns}
+
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        logging.error("Usage: python renderer.py <patterns.json|set.als> [sample_rate]")
+        exit()
+
+    filepath = argv[1]
+    sample_rate = float(argv[2]) if len(argv) > 2 else DEFAULT_SAMPLE_RATE
+    if filepath.endswith(".als"):
+        from als import compile_patterns
+        patterns = compile_patterns(filepath)
+    else:
+        patterns = json.load(open(filepath))
+
+    start = time.perf_counter()
+    rendered = render_patterns(patterns, sample_rate)
+    elapsed = time.perf_counter() - start
+    for name, frames in rendered.items():
+        print(f"{name}: {frames.shape[0]} frames x {frames.shape[1]} outputs, peak {frames.max(initial=0)}")
+    total_frames = sum(frames.shape[0] for frames in rendered.values())
+    print(f"Rendered {len(rendered)} patterns ({total_frames} frames) at {sample_rate}Hz in {elapsed * 1000:.1f}ms")
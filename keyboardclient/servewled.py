@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sys import argv
+
+import websockets
+
+# Stands in for a WLED controller: presets.json over HTTP, with keep-alive and
+# ETags like the real one, and {"ps": id} messages over a websocket.
+
+# --port=<port> for the websocket, --http-port=<port> for presets.json
+port = next((int(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--port=")), 8080)
+http_port = next((int(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--http-port=")), port + 1)
+# --presets=<path> serves that file, read again on every request so it can be edited while running
+presets_path = next((arg.split("=", 1)[1] for arg in argv if arg.startswith("--presets=")), None)
+# --no-etag leaves out the ETag header, like older firmware
+send_etag = "--no-etag" not in argv
+# --http-delay=<seconds> makes every fetch slow, like a busy controller
+http_delay = next((float(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--http-delay=")), 0)
+# --quiet skips printing every request and message
+quiet = "--quiet" in argv
+
+DEFAULT_PRESETS = {"0": {}, "1": {"n": "red"}, "2": {"n": "blue"}, "3": {"n": "strobe"}}
+stats = {"connections": 0, "requests": 0, "not_modified": 0, "messages": 0}
+
+
+def read_presets():
+    if presets_path is None:
+        return json.dumps(DEFAULT_PRESETS).encode()
+    with open(presets_path, "rb") as f:
+        return f.read()
+
+
+class PresetsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def setup(self):
+        super().setup()
+        stats["connections"] += 1
+        if not quiet:
+            print(f"HTTP connection {stats['connections']} from {self.client_address}")
+
+    def do_GET(self):
+        stats["requests"] += 1
+        time.sleep(http_delay)
+        if self.path != "/presets.json":
+            self.send_error(404)
+            return
+        body = read_presets()
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        if send_etag and self.headers.get("If-None-Match") == etag:
+            stats["not_modified"] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if send_etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        if not quiet:
+            print(f"GET {self.path} -> {stats['requests']} requests over {stats['connections']} connections, {stats['not_modified']} not modified")
+
+    def log_message(self, format, *args):
+        pass
+
+
+async def handler(websocket, path):
+    async for message in websocket:
+        stats["messages"] += 1
+        if not quiet:
+            print(f"Received message: {message}")
+
+
+async def main():
+    http_server = ThreadingHTTPServer(("localhost", http_port), PresetsHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    server = await websockets.serve(handler, "localhost", port)
+    print(f"WLED stand-in serving http://localhost:{http_port}/presets.json and ws://localhost:{port}/ws")
+    await server.wait_closed()
+
+if __name__ == "__main__":
+    asyncio.run(main())
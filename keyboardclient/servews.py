@@ -1,13 +1,110 @@
 import asyncio
+import json
+import random
+import time
+from sys import argv
+
 import websockets
+from fader_client import FaderClient
+from pattern_codec import FORMAT_VERSION, decode_pattern
+
+# --json-only behaves like a controller without binary pattern support
+json_only = "--json-only" in argv
+# --pattern-format=<version> reports an older binary pattern format, like firmware from before it
+pattern_format = next((int(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--pattern-format=")), FORMAT_VERSION)
+# --parse-delay=<seconds> stands in for the time the controller takes to parse a pattern
+parse_delay = next((float(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--parse-delay=")), 0)
+# --reject-every=<n> rejects every nth pattern, to exercise resending
+reject_every = next((int(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--reject-every=")), 0)
+# --latency=<seconds> delays acknowledgements like a slow wireless link would
+latency = next((float(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--latency=")), 0)
+# --record=<path> appends the arrival time (time.monotonic_ns) and type of every
+# JSON command as a line of JSON, for bench_latency.py
+record_path = next((arg.split("=", 1)[1] for arg in argv if arg.startswith("--record=")), None)
+# --quiet skips printing every message
+quiet = "--quiet" in argv
+# --port=<port> and --id=<id>, for standing in for several controllers at once
+port = next((int(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--port=")), 7032)
+controller_id = next((arg.split("=", 1)[1] for arg in argv if arg.startswith("--id=")), "00:00:00:00:00:00")
+# --clock-skew=<ppm> runs the stand-in's clock fast (or slow, if negative) like a
+# real controller's crystal, for testing clock sync
+clock_skew = next((float(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--clock-skew=")), 0) / 1e6
+# --jitter=<seconds> delays handling each message by up to this long, like a busy wireless link
+jitter = next((float(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--jitter=")), 0)
+clock_origin = time.monotonic_ns()  # the stand-in's clock counts from its own start, like esp_timer_get_time
+patterns_received = 0
+# name -> content hash, kept across connections like the controller's memory
+held_patterns = {}
+
+def controller_time(t_ns):
+    # esp_timer_get_time at local time t_ns
+    return round((t_ns - clock_origin) / 1000 * (1 + clock_skew))
+
+def local_time(controller_us):
+    return clock_origin + round(controller_us / (1 + clock_skew) * 1000)
+
+async def send_later(websocket, message):
+    await asyncio.sleep(latency)
+    await websocket.send(message)
+
+async def ack_pattern(websocket, name):
+    global patterns_received
+    patterns_received += 1
+    await asyncio.sleep(parse_delay)
+    ok = not reject_every or patterns_received % reject_every != 0
+    ack = json.dumps({"type": FaderClient.COMMAND_ACK, "data": {"name": name, "ok": ok, "free_heap": 200000}})
+    asyncio.create_task(send_later(websocket, ack))
 
 async def handler(websocket, path):
-    async for message in websocket:
-        print(f"Received message: {message}")
+    record = open(record_path, "a") if record_path else None
+    try:
+        async for message in websocket:
+            if jitter:
+                await asyncio.sleep(random.uniform(0, jitter))
+            received = time.monotonic_ns()
+            if isinstance(message, bytes):
+                pattern = decode_pattern(message[1:])
+                if not quiet:
+                    print(f"Received binary pattern {pattern['name']} (version {message[1]}), {len(message)} bytes")
+                held_patterns[pattern["name"]] = pattern["hash"]
+                await ack_pattern(websocket, pattern["name"])
+                continue
+            if not quiet:
+                print(f"Received message: {message[:200]}")
+            command = json.loads(message)
+            if record:
+                entry = {"t_ns": received, "type": command.get("type"), "bytes": len(message)}
+                if command.get("type") == FaderClient.COMMAND_START_PATTERN:
+                    # when the pattern would start, in local time
+                    at = command["data"].get("at")
+                    entry["start_ns"] = local_time(at) if at is not None else received
+                record.write(json.dumps(entry) + "\n")
+                record.flush()
+            if command.get("type") == FaderClient.COMMAND_GET_INFO:
+                info = {"pattern_acks": True, "pattern_sync": True, "id": controller_id, "clock_sync": True}
+                if not json_only:
+                    info["pattern_format"] = pattern_format
+                await websocket.send(json.dumps({"type": FaderClient.COMMAND_GET_INFO, "data": info}))
+            elif command.get("type") == FaderClient.COMMAND_PING:
+                reply = {"seq": command["data"]["seq"], "time": controller_time(received)}
+                await websocket.send(json.dumps({"type": FaderClient.COMMAND_PING, "data": reply}))
+            elif command.get("type") == FaderClient.COMMAND_ADD_PATTERN:
+                held_patterns[command["data"]["name"]] = command["data"].get("hash", "")
+                await ack_pattern(websocket, command["data"]["name"])
+            elif command.get("type") == FaderClient.COMMAND_SET_PATTERNS:
+                held_patterns.clear()
+            elif command.get("type") == FaderClient.COMMAND_REMOVE_PATTERNS:
+                for name in command["data"]["names"]:
+                    held_patterns.pop(name, None)
+            elif command.get("type") == FaderClient.COMMAND_GET_PATTERNS:
+                await websocket.send(json.dumps({"type": FaderClient.COMMAND_GET_PATTERNS, "data": {"patterns": held_patterns}}))
+    finally:
+        if record:
+            record.close()
 
 async def main():
-    server = await websockets.serve(handler, "localhost", 7032)
-    print("WebSocket server started on ws://localhost:7032/ws")
+    server = await websockets.serve(handler, "localhost", port)
+    print(f"WebSocket server started on ws://localhost:{port}/ws")
     await server.wait_closed()
 
 if __name__ == "__main__":
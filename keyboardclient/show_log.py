@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from fader_client import FaderClient, FaderCommand
+
+MAGIC = b"EWSHOW1\n"
+# time.monotonic_ns, target, payload length
+RECORD_HEADER = struct.Struct("<qBH")
+SESSION = 0  # target of the record starting each run of the client, its payload {"wall_time"}
+TARGETS = ["ewctrl", "wled"]  # target codes are these indices + 1
+TARGET_CODES = {target: index + 1 for index, target in enumerate(TARGETS)}
+FLUSH_INTERVAL = 1  # seconds of commands a crash can lose
+MAX_BUFFER = 64 * 1024
+# replay sleeps until this long before each command is due, then spins, as
+# asyncio.sleep only wakes to within a millisecond or so
+SPIN_MARGIN = 0.002
+
+
+class ShowRecorder:
+    """
+    Appends every command KeyboardCommander dispatches to a file, with the
+    time.monotonic_ns it was dispatched at. Each record is a RECORD_HEADER
+    and the command as FaderClient sends it. Records are buffered and
+    written every FLUSH_INTERVAL, so recording costs a key event no I/O.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if not new:
+            self.drop_torn_record(filename)
+        self.file = open(filename, "ab")
+        self.buffer = bytearray(MAGIC if new else b"")
+        self.flush_handle = None
+        self.append(SESSION, json.dumps({"wall_time": time.time()}).encode())
+
+    @staticmethod
+    def drop_torn_record(filename):
+        # a crash part way through a write leaves a record cut short, which
+        # the next session's records would otherwise be read as the rest of
+        with open(filename, "r+b") as f:
+            data = f.read()
+            if not data.startswith(MAGIC):
+                raise ValueError(f"{filename} is not a show log")
+            end = len(MAGIC)
+            for end, _, _, _ in records(data):
+                pass
+            if end < len(data):
+                logging.warning(f"Dropping {len(data) - end} bytes of a record cut short at the end of {filename}")
+                f.truncate(end)
+
+    def append(self, target_code, payload):
+        self.buffer += RECORD_HEADER.pack(time.monotonic_ns(), target_code, len(payload))
+        self.buffer += payload
+        if len(self.buffer) > MAX_BUFFER:
+            self.flush()
+        elif self.flush_handle is None:
+            try:
+                self.flush_handle = asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self.flush)
+            except RuntimeError:
+                self.flush()  # no event loop to flush later from
+
+    def record(self, target, command):
+        if isinstance(command, FaderCommand):
+            payload = command.message
+        elif isinstance(command, tuple):
+            payload = FaderCommand.serialize(command)
+        else:
+            payload = json.dumps(command)
+        self.append(TARGET_CODES[target], payload.encode())
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def records(data):
+    """
+    Each whole record in data after MAGIC as (the offset it ends at,
+    time.monotonic_ns, target code, payload bytes), stopping at one cut short.
+    """
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        time_ns, target_code, length = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > len(data):
+            return
+        offset = start + length
+        yield offset, time_ns, target_code, data[start:offset]
+
+
+def read_sessions(filename):
+    """
+    The runs recorded in filename, each a dict with wall_time and commands,
+    a list of (time.monotonic_ns, target, command). Reading stops at a
+    record cut short or unreadable, keeping the runs before it.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{filename} is not a show log")
+    sessions = []
+    end = len(MAGIC)
+    for offset, time_ns, target_code, payload in records(data):
+        try:
+            if target_code > len(TARGETS):
+                raise ValueError(f"unknown target {target_code}")
+            payload = json.loads(payload)
+        except ValueError as e:
+            logging.warning(f"{filename} has an unreadable record ending at byte {offset}, ignoring the rest: {e}")
+            return sessions
+        end = offset
+        if target_code == SESSION:
+            sessions.append({"wall_time": payload["wall_time"], "commands": []})
+        elif sessions:
+            if isinstance(payload, dict) and "type" in payload:
+                payload = (payload["type"], payload["data"])
+            sessions[-1]["commands"].append((time_ns, TARGETS[target_code - 1], payload))
+    if end < len(data):
+        logging.warning(f"{filename} ends part way through a record")
+    return sessions
+
+
+async def wait_until(deadline):
+    # sleep most of the way, then spin for the last bit so the wakeup isn't late
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_MARGIN:
+        await asyncio.sleep(remaining - SPIN_MARGIN)
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def replay(commands, send, speed=1.0):
+    """
+    Call send with each (time.monotonic_ns, command) at its recorded offset
+    from the first, divided by speed. Each deadline is worked out from the
+    start of the replay rather than from the previous command, so lateness
+    doesn't add up. Returns how late each send started, in seconds.
+    """
+    if not commands:
+        return []
+    first_ns = commands[0][0]
+    start = time.perf_counter()
+    lateness = []
+    for time_ns, command in commands:
+        deadline = start + (time_ns - first_ns) / 1e9 / speed
+        await wait_until(deadline)
+        lateness.append(time.perf_counter() - deadline)
+        await send(command)
+    return lateness
+
+
+async def replay_to_controller(commands, host, port, patterns, speed):
+    client = FaderClient(host, port, None, patterns)
+    await client.connect_to_server()
+    if not client.is_connected():
+        raise RuntimeError(f"Could not connect to {host}:{port}")
+    replies = asyncio.create_task(client.read_replies())
+    try:
+        return await replay(commands, client.send_command, speed)
+    finally:
+        replies.cancel()
+        await client.websocket.close()
+
+
+def lateness_summary(lateness):
+    ms = np.array(lateness) * 1000
+    return {
+        "commands": len(ms),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "over_1ms": int((ms > 1).sum()),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Inspect and replay show logs written by ShowRecorder")
+    parser.add_argument("log")
+    parser.add_argument("--session", type=int, default=-1, help="which run of the client, from 0, or negative from the last")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the runs in the log")
+    replay_parser = subparsers.add_parser("replay", help="send a run's commands to a controller with their recorded timing")
+    replay_parser.add_argument("--host", default="127.0.0.1")
+    replay_parser.add_argument("--port", type=int, default=7032)
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="2 replays twice as fast")
+    replay_parser.add_argument("--als", default="data/ew4lx_final2.als", help="patterns to bring the controller up to date with first")
+    replay_parser.add_argument("--output", help="JSON file for each command's lateness")
+    frames_parser = subparsers.add_parser("frames", help="compute the frames a controller would have sent during a run")
+    frames_parser.add_argument("output", help=".npy file for the frames")
+    frames_parser.add_argument("--als", default="data/ew4lx_final2.als")
+    args = parser.parse_args()
+
+    sessions = read_sessions(args.log)
+    if args.command == "list":
+        for index, session in enumerate(sessions):
+            commands = session["commands"]
+            length = (commands[-1][0] - commands[0][0]) / 1e9 if commands else 0
+            started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(session["wall_time"]))
+            print(f"{index}: {started}, {len(commands)} commands over {length:.1f}s")
+        exit()
+
+    session = sessions[args.session]
+    commands = [(time_ns, command) for time_ns, target, command in session["commands"] if target == "ewctrl"]
+    from pattern_cache import PatternCache
+    patterns = PatternCache().load(args.als)
+
+    if args.command == "replay":
+        lateness = asyncio.run(replay_to_controller(commands, args.host, args.port, patterns, args.speed))
+        summary = lateness_summary(lateness) if lateness else {"commands": 0}
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"speed": args.speed, "summary": summary, "lateness_s": lateness}, f)
+        print(json.dumps(summary))
+    elif args.command == "frames":
+        from playback import FaderPlayback
+        first_ns = commands[0][0] if commands else 0
+        timed = [((time_ns - first_ns) // 1000, command) for time_ns, command in commands]
+        end_time = (timed[-1][0] if timed else 0) + 1000000
+        times, frames = FaderPlayback(patterns).replay(timed, end_time)
+        np.save(args.output, frames)
+        print(f"{len(frames)} frames written to {args.output}")
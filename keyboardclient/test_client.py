@@ -0,0 +1,175 @@
+"""
+Checks for the pattern codec, the playback model and FaderClient, on fixed
+patterns and a fake websocket, so they run without data/ or a controller:
+
+    python -m unittest test_client
+"""
+import asyncio
+import json
+import logging
+import unittest
+
+from command_queue import CommandQueue
+from fader_client import FaderClient
+from pattern_codec import decode_pattern, encode_pattern, same_index, same_segments
+from pattern_cost import pattern_cost
+from playback import check_quantize
+from renderer import MIN_INDEXED_SEGMENTS, PatternRenderer, index_mismatches
+
+logging.disable(logging.WARNING)
+
+
+def steps(count, length=0.025):
+    # a jump at every step, two events at the same time
+    events = []
+    for i in range(count):
+        events += [[round(i * length, 3), i % 2], [round(i * length, 3), 1 - i % 2]]
+    return events + [[round(count * length, 3), 0]]
+
+
+PATTERNS = [
+    {"name": "ramp", "data": [[[0, 0], [1, 1]], [[0, 1, 0.3, 0.1, 0.7, 0.9], [0.5, 0], [1, 1]]]},
+    # enough segments in the first channel for an index, and channels with none
+    {"name": "steps", "data": [steps(4 * MIN_INDEXED_SEGMENTS), [], [[0.25, 0.5]]]},
+    {"name": "curves", "data": [[[round(i * 0.1, 3), i % 3 / 2, 0.25, 0.5, 0.75, 0.5] for i in range(20)] + [[2, 1]]]},
+]
+
+
+class PatternCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for pattern in PATTERNS:
+            decoded = decode_pattern(encode_pattern(pattern, content_hash="abc"))
+            self.assertEqual(decoded["name"], pattern["name"])
+            self.assertEqual(decoded["hash"], "abc")
+            self.assertEqual(len(decoded["data"]), len(pattern["data"]))
+            for events, points in zip(pattern["data"], decoded["data"]):
+                self.assertTrue(same_segments(events, points), pattern["name"])
+            self.assertTrue(same_index(PatternRenderer(pattern), decoded["index"]), pattern["name"])
+
+    def test_indexed(self):
+        index = decode_pattern(encode_pattern(PATTERNS[1]))["index"]
+        self.assertTrue(index[0][0])
+        self.assertFalse(any(bucket_ticks for bucket_ticks, _ in index[1:]))
+
+    def test_unindexed(self):
+        for pattern in PATTERNS:
+            index = decode_pattern(encode_pattern(pattern, min_indexed_segments=None))["index"]
+            self.assertFalse(any(bucket_ticks for bucket_ticks, _ in index), pattern["name"])
+
+    def test_indexed_sampling(self):
+        # every channel with segments indexed, against a plain scan
+        for pattern in PATTERNS:
+            differing, checked = index_mismatches(PatternRenderer(pattern, min_indexed_segments=1))
+            self.assertEqual(differing, 0, pattern["name"])
+            self.assertGreater(checked, 0)
+
+    def test_json_only(self):
+        # a time between ticks can't be sent in binary
+        pattern = {"name": "between", "data": [[[0, 0], [0.0005, 1]]]}
+        with self.assertRaises(ValueError):
+            encode_pattern(pattern)
+        self.assertIsNone(pattern_cost(pattern)["upload_bytes"])
+
+
+class PlaybackTest(unittest.TestCase):
+    def test_quantize(self):
+        self.assertEqual(check_quantize(), [])
+
+
+class FakeWebSocket:
+    """
+    Records what is sent, fails the send numbered fail_at, and answers
+    each sent message with whatever replies(message) returns.
+    """
+
+    def __init__(self, replies=None, fail_at=None):
+        self.open = True
+        self.sent = []
+        self.fail_at = fail_at
+        self.replies = replies or (lambda message: [])
+        self.incoming = asyncio.Queue()
+
+    async def send(self, message):
+        if self.fail_at == len(self.sent):
+            self.fail_at = None
+            raise ConnectionError("connection dropped")
+        self.sent.append(message)
+        if isinstance(message, str):
+            for reply in self.replies(json.loads(message)):
+                self.incoming.put_nowait(reply)
+
+    async def recv(self):
+        return await self.incoming.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    def commands(self, command_type):
+        return [
+            json.loads(message)["data"] for message in self.sent
+            if isinstance(message, str) and json.loads(message)["type"] == command_type
+        ]
+
+
+class FaderClientTest(unittest.IsolatedAsyncioTestCase):
+    def client(self, websocket):
+        client = FaderClient("127.0.0.1", 0, CommandQueue(), patterns=PATTERNS)
+        client.binary_patterns, client.pattern_format = True, 3
+        client.UNACKED_PATTERN_DELAY = 0
+        client.websocket = websocket
+        return client
+
+    async def test_sync_resumes(self):
+        # nothing to send, but a full upload cut short may have left it paused
+        manifest = self.client(None).manifest
+
+        def replies(command):
+            if command["type"] == FaderClient.COMMAND_GET_PATTERNS:
+                return [json.dumps({"type": FaderClient.COMMAND_GET_PATTERNS, "data": {"patterns": manifest}})]
+            return []
+
+        client = self.client(FakeWebSocket(replies))
+        client.pattern_sync = True
+        await client.send_patterns()
+        self.assertEqual(client.websocket.commands(FaderClient.COMMAND_SET_PAUSED), [{"paused": False}])
+        self.assertFalse(client.websocket.commands(FaderClient.COMMAND_SET_PATTERNS))
+
+    async def test_failed_upload_resumes(self):
+        client = self.client(FakeWebSocket(fail_at=3))
+        with self.assertRaises(ConnectionError):
+            await client.send_patterns()
+        self.assertEqual(client.websocket.commands(FaderClient.COMMAND_SET_PAUSED), [{"paused": True}, {"paused": False}])
+
+    async def test_ping_after_garbage(self):
+        def replies(command):
+            if command["type"] != FaderClient.COMMAND_PING:
+                return []
+            return [
+                b"\x00", "not json", "[]", json.dumps({"type": FaderClient.COMMAND_PING, "data": {}}),
+                json.dumps({"type": FaderClient.COMMAND_PING, "data": {"seq": command["data"]["seq"], "time": 1234}}),
+            ]
+
+        client = self.client(FakeWebSocket(replies))
+        replies_task = asyncio.create_task(client.read_replies())
+        try:
+            exchange = await client.ping()
+            self.assertFalse(replies_task.done())
+        finally:
+            replies_task.cancel()
+        self.assertIsNotNone(exchange)
+        self.assertEqual(exchange[1], 1234)
+
+    async def test_requeue_on_failed_send(self):
+        client = self.client(FakeWebSocket(fail_at=0))
+        start = (FaderClient.COMMAND_START_PATTERN, {"name": "ramp"})
+        client.command_queue.put_nowait(start)
+        with self.assertRaises(ConnectionError):
+            await client.read_commands()
+        self.assertEqual(list(client.command_queue.commands), [start])
+
+
+if __name__ == "__main__":
+    unittest.main()
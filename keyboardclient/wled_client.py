@@ -1,48 +1,129 @@
 import asyncio
+import hashlib
 import json
 import logging
-import threading
-import time
+import os
 
 import requests
 import websockets
 from common import Commandable, KeyMapEntry
 
+# preset name -> id for each WLED host, so a restart can send presets at once
+PRESETS_FILE = "wled_presets.json"
+
 
 class WLEDClient(Commandable):
+    """
+    Sends presets by name to a WLED controller over its websocket. Names
+    are resolved from the presets last seen on the controller, kept in
+    presets_file, while presets.json is fetched again in the background:
+    on every connection, every REFRESH_INTERVAL while connected and when a
+    name isn't found. Sending never waits for the fetch.
+    """
     RETRY_DELAY = 2  # Time in seconds to wait before retrying the fetch
+    REFRESH_INTERVAL = 30
+    FETCH_TIMEOUT = 2
 
-    def __init__(self, host, port, command_queue):
+    def __init__(self, host, port, command_queue, presets_file=PRESETS_FILE, http_port=None):
         self.host = host
         self.port = port
+        # WLED serves presets.json and the websocket on the same port
+        self.http_port = http_port or port
         self.command_queue = command_queue
+        self.presets_file = presets_file
         self.presets = {}
+        self.etag = None
+        self.digest = None
         self.websocket = None
-        self.connection_thread = threading.Thread(target=self.manage_connection, daemon=True)
-        self.connection_thread.start()
+        # kept alive between fetches
+        self.session = requests.Session()
+        self.refresh_requested = None  # an asyncio.Event while connected
+        self.load_presets()
+
+    @property
+    def presets_key(self):
+        return f"{self.host}:{self.http_port}"
+
+    def read_presets_file(self):
+        try:
+            with open(self.presets_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable {self.presets_file}: {e}")
+            return {}
+
+    def load_presets(self):
+        entry = self.read_presets_file().get(self.presets_key)
+        if entry:
+            self.presets = entry["presets"]
+            self.etag = entry.get("etag")
+            self.digest = entry.get("digest")
+            logging.info(f"Loaded {len(self.presets)} presets for {self.host} from {self.presets_file}")
+
+    def save_presets(self):
+        saved = self.read_presets_file()
+        saved[self.presets_key] = {"presets": self.presets, "etag": self.etag, "digest": self.digest}
+        tmp_path = f"{self.presets_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, self.presets_file)
 
     def fetch_presets(self):
-        while True:
-            try:
-                url = f"http://{self.host}/presets.json"
-                logging.info(f"Fetching presets from {url}")
-                response = requests.get(url)
-                if response.status_code == 200:
-                    data = response.json()
-                    self.presets = {v.get('n', f'Preset {k}'): k for k, v in data.items()}
-                    logging.info(f"Fetched presets: {self.presets}")
-                    break  # Exit the loop if fetching succeeds
-                else:
-                    logging.error(f"Failed to fetch presets: HTTP {response.status_code}")
-            except Exception as e:
-                logging.error(f"Error fetching presets: {e}")
-            logging.info(f"Retrying in {self.RETRY_DELAY} seconds...")
-            time.sleep(self.RETRY_DELAY)
-
-    async def send_command(self, command: tuple):
-        key_state, command = command
-        if key_state != key_state.key_down:
-            return
+        """
+        Fetch presets.json, sending the last ETag so an unchanged file costs
+        a 304. Returns the new {"presets", "etag", "digest"}, or None when
+        nothing changed. Blocks, so is run in a worker thread.
+        """
+        url = f"http://{self.host}:{self.http_port}/presets.json"
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = self.session.get(url, headers=headers, timeout=self.FETCH_TIMEOUT)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        # without an ETag from the controller, the same content is still spotted
+        digest = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        etag = response.headers.get("ETag")
+        if digest == self.digest and etag == self.etag:
+            return None
+        data = response.json()
+        presets = {v.get('n', f'Preset {k}'): k for k, v in data.items()}
+        return {"presets": presets, "etag": etag, "digest": digest}
+
+    async def refresh_presets(self):
+        # one of the connection tasks, so it stops when the connection drops
+        self.refresh_requested = asyncio.Event()
+        try:
+            while True:
+                try:
+                    fetched = await asyncio.to_thread(self.fetch_presets)
+                    if fetched is not None:
+                        changed = fetched["presets"] != self.presets
+                        self.presets, self.etag, self.digest = fetched["presets"], fetched["etag"], fetched["digest"]
+                        self.save_presets()
+                        if changed:
+                            logging.info(f"Fetched presets: {self.presets}")
+                    delay = self.REFRESH_INTERVAL
+                except (requests.RequestException, ValueError) as e:
+                    logging.error(f"Error fetching presets: {e}")
+                    delay = self.RETRY_DELAY
+                self.refresh_requested.clear()
+                try:
+                    await asyncio.wait_for(self.refresh_requested.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.refresh_requested = None
+
+    def connection_tasks(self):
+        return super().connection_tasks() + [self.refresh_presets()]
+
+    def close(self):
+        self.session.close()
+
+    async def send_command(self, command: str):
+        # a preset name, queued on key down (see parse_keymap)
         if command in self.presets:
             preset_id = self.presets[command]
             try:
@@ -55,7 +136,10 @@ class WLEDClient(Commandable):
                 logging.error(f"Error sending WebSocket command: {e}")
                 self.websocket = None
         else:
-            logging.error(f"Preset {command} not found")
+            # it may have been added on the controller since the last fetch
+            logging.error(f"Preset {command} not found, fetching presets again")
+            if self.refresh_requested is not None:
+                self.refresh_requested.set()
 
     async def connect_to_server(self):
         ws_url = f"ws://{self.host}:{self.port}/ws"
@@ -63,21 +147,20 @@ class WLEDClient(Commandable):
         try:
             self.websocket = await websockets.connect(ws_url)
             logging.info(f"Connected to WebSocket server at {self.host}:{self.port}")
-            while True:
-                command = self.command_queue.get()  # Use blocking get() from queue
-                await self.send_command(command)
         except Exception as e:
             logging.error(f"Error connecting to WebSocket server: {e}")
             self.websocket = None
 
-    def manage_connection(self):
-        self.fetch_presets()  # Fetch presets before managing the connection
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        while True:
-            if not self.websocket or not self.websocket.open:
-                loop.run_until_complete(self.connect_to_server())
-            time.sleep(1)  # Retry connection after a short delay
+    async def run(self):
+        """
+        Send queued commands until the connection drops, with the presets
+        refreshed alongside. Returns whether it connected.
+        """
+        await self.connect_to_server()
+        if not self.is_connected():
+            return False
+        await self.serve_connection()
+        return True
 
     def is_connected(self) -> bool:
         return self.websocket is not None and self.websocket.open
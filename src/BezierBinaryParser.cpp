@@ -0,0 +1,137 @@
+#include "BezierBinaryParser.h"
+
+static const char* TAG = "BezierBinaryParser";
+
+static bool readVarint(const uint8_t* data, size_t len, size_t& offset, uint32_t& value) {
+    value = 0;
+    for (uint8_t shift = 0; shift < 32; shift += 7) {
+        if (offset >= len) {
+            return false;
+        }
+        uint8_t byte = data[offset++];
+        value |= (uint32_t)(byte & 0x7F) << shift;
+        if (!(byte & 0x80)) {
+            return true;
+        }
+    }
+    return false;
+}
+
+std::pair<std::string, BezierPattern> parseBinaryToBezierPattern(const uint8_t* data, size_t len, std::string* contentHash) {
+    const std::pair<std::string, BezierPattern> invalid = {"", BezierPattern(std::vector<BezierEnvelope>())};
+
+    if (len < 5) {
+        ESP_LOGE(TAG, "Binary pattern too short (%d bytes)", len);
+        return invalid;
+    }
+    uint8_t version = data[0];
+    if (version < 1 || version > BINARY_PATTERN_FORMAT_VERSION) {
+        ESP_LOGE(TAG, "Unsupported binary pattern version %d", data[0]);
+        return invalid;
+    }
+    uint16_t ticksPerSecond = data[1] | (data[2] << 8);
+    uint8_t nameLength = data[3];
+    size_t offset = 4;
+    if (ticksPerSecond == 0 || offset + nameLength + 1 > len) {
+        ESP_LOGE(TAG, "Invalid binary pattern header");
+        return invalid;
+    }
+    std::string patternName(reinterpret_cast<const char*>(data + offset), nameLength);
+    offset += nameLength;
+    if (version >= 2) {
+        uint8_t hashLength = data[offset++];
+        if (offset + hashLength + 1 > len) {
+            ESP_LOGE(TAG, "Invalid content hash for pattern %s", patternName.c_str());
+            return invalid;
+        }
+        if (contentHash != nullptr) {
+            contentHash->assign(reinterpret_cast<const char*>(data + offset), hashLength);
+        }
+        offset += hashLength;
+    }
+    uint8_t channelCount = data[offset++];
+
+    std::vector<BezierEnvelope> envelopes;
+    envelopes.reserve(channelCount);
+    std::vector<std::pair<uint8_t, SegmentIndex>> segmentIndices;
+    for (uint8_t channel = 0; channel < channelCount; channel++) {
+        uint32_t pointCount;
+        // every point takes at least two bytes
+        if (!readVarint(data, len, offset, pointCount) || pointCount > (len - offset) / 2) {
+            ESP_LOGE(TAG, "Invalid point count for channel %d of pattern %s", channel, patternName.c_str());
+            return invalid;
+        }
+
+        std::vector<QuantizedEvent> events;
+        events.reserve(pointCount);
+        uint32_t ticks = 0;
+        for (uint32_t i = 0; i < pointCount; i++) {
+            uint32_t packed;
+            if (!readVarint(data, len, offset, packed)) {
+                ESP_LOGE(TAG, "Truncated time in pattern %s", patternName.c_str());
+                return invalid;
+            }
+            bool hasCurve = packed & 1;
+            size_t size = hasCurve ? 3 : 1;
+            if (offset + size > len) {
+                ESP_LOGE(TAG, "Truncated point in pattern %s", patternName.c_str());
+                return invalid;
+            }
+            ticks += packed >> 1;
+
+            QuantizedEvent event;
+            // same float the JSON parser gets from the decimal time
+            event.Time = ticks / (double)ticksPerSecond;
+            event.Value = data[offset];
+            event.CurveControl1Y = hasCurve ? data[offset + 1] : 0;
+            event.CurveControl2Y = hasCurve ? data[offset + 2] : 0;
+            event.HasCurveControls = hasCurve;
+            offset += size;
+            events.push_back(event);
+        }
+        BezierEnvelope envelope(events);
+
+        if (version >= 3) {
+            uint32_t bucketTicks;
+            if (!readVarint(data, len, offset, bucketTicks)) {
+                ESP_LOGE(TAG, "Truncated segment index in pattern %s", patternName.c_str());
+                return invalid;
+            }
+            if (bucketTicks > 0) {
+                uint32_t bucketCount;
+                // every bucket takes at least a byte
+                if (!readVarint(data, len, offset, bucketCount) || bucketCount > len - offset) {
+                    ESP_LOGE(TAG, "Invalid segment index for channel %d of pattern %s", channel, patternName.c_str());
+                    return invalid;
+                }
+                SegmentIndex index;
+                index.bucketsPerSecond = float(ticksPerSecond) / float(bucketTicks);
+                index.firstSegments.reserve(bucketCount);
+                uint32_t first = 0;
+                for (uint32_t i = 0; i < bucketCount; i++) {
+                    uint32_t delta;
+                    if (!readVarint(data, len, offset, delta) || first + delta > UINT16_MAX) {
+                        ESP_LOGE(TAG, "Invalid segment index in pattern %s", patternName.c_str());
+                        return invalid;
+                    }
+                    first += delta;
+                    index.firstSegments.push_back(first);
+                }
+                if (!envelope.isValidIndex(index)) {
+                    ESP_LOGE(TAG, "Segment index doesn't match the segments of channel %d of pattern %s", channel, patternName.c_str());
+                    return invalid;
+                }
+                segmentIndices.push_back({channel, index});
+            }
+        }
+        envelopes.push_back(envelope);
+    }
+
+    if (offset != len) {
+        ESP_LOGE(TAG, "%d trailing bytes after pattern %s", len - offset, patternName.c_str());
+        return invalid;
+    }
+    ESP_LOGI(TAG, "Initialized pattern %s", patternName.c_str());
+
+    return {patternName, BezierPattern(envelopes, segmentIndices)};
+}
@@ -1,4 +1,5 @@
 #include "BezierEnvelope.h"
+#include <algorithm>
 
 static const char *TAG = "BezierEnvelope";
 
@@ -51,14 +52,67 @@ void BezierEnvelope::loadEvents(const std::vector<FloatEvent>& events) {
     // return bezierSegments;
 }
 
-float BezierEnvelope::sampleAtTime(float time) const {
+BezierEnvelope::BezierEnvelope(const std::vector<QuantizedEvent>& events) {
+    loadEvents(events);
+    duration = events.empty() ? 0.0 : events.back().Time;
+}
+
+void BezierEnvelope::loadEvents(const std::vector<QuantizedEvent>& events) {
+    if(events.size() < 2) {
+        return;
+    }
+
+    for (size_t i = 0; i < events.size() - 1; ++i) {
+        const QuantizedEvent& startEvent = events[i];
+        const QuantizedEvent& endEvent = events[i + 1];
+
+        if(startEvent.Time == endEvent.Time) {
+            continue;
+        }
+
+        // control points arrive already quantized, only their y is used by valueAt
+        CurveSegment curveSegment = startEvent.HasCurveControls ?
+            CurveSegment({
+                Vec2(startEvent.Time, startEvent.Value),
+                Vec2(startEvent.Time, startEvent.CurveControl1Y),
+                Vec2(endEvent.Time, startEvent.CurveControl2Y),
+                Vec2(endEvent.Time, endEvent.Value)
+            }) :
+            CurveSegment(Vec2(startEvent.Time, startEvent.Value), Vec2(endEvent.Time, endEvent.Value));
+        bezierSegments.push_back({startEvent.Time, endEvent.Time, curveSegment});
+    }
+}
+
+bool BezierEnvelope::isValidIndex(const SegmentIndex& index) const {
+    if (index.firstSegments.empty() || !(index.bucketsPerSecond > 0)) {
+        return false;
+    }
+    for (size_t i = 0; i < index.firstSegments.size(); i++) {
+        if (index.firstSegments[i] > bezierSegments.size() || (i > 0 && index.firstSegments[i] < index.firstSegments[i - 1])) {
+            return false;
+        }
+    }
+    return true;
+}
+
+float BezierEnvelope::sampleAtTime(float time, const SegmentIndex* index) const {
     if(bezierSegments.empty()) {
         return 0;
     }
-    for (const auto& segment : bezierSegments) {
-        if (segment.StartTime <= time && time <= segment.EndTime) {
-            float t = (time - segment.StartTime) / (segment.EndTime - segment.StartTime);
-            return segment.curve.valueAt(t);
+    size_t first = 0;
+    if (index != nullptr && time > 0) {
+        size_t bucket = static_cast<uint32_t>(time * index->bucketsPerSecond);
+        first = index->firstSegments[std::min(bucket, index->firstSegments.size() - 1)];
+    }
+    // segments are in time order, so the first ending at or after the time is the only one that can contain it
+    for (size_t i = first; i < bezierSegments.size(); i++) {
+        const auto& segment = bezierSegments[i];
+        if (time <= segment.EndTime) {
+            if (segment.StartTime <= time) {
+                float t = (time - segment.StartTime) / (segment.EndTime - segment.StartTime);
+                return segment.curve.valueAt(t);
+            }
+            break;
         }
     }
 
@@ -13,7 +13,8 @@ void BezierPattern::printSamples() {
     }
 }
 
-BezierPattern::BezierPattern(const std::vector<BezierEnvelope>& envelopes) : envelopes(envelopes) {
+BezierPattern::BezierPattern(const std::vector<BezierEnvelope>& envelopes, const std::vector<std::pair<uint8_t, SegmentIndex>>& segmentIndices)
+    : envelopes(envelopes), segmentIndices(segmentIndices) {
     duration = 0.0;
 
     for (const auto& envelope : envelopes) {
@@ -28,8 +29,14 @@ std::vector<uint16_t> BezierPattern::getFrameAtTime(double time) const {
     std::vector<uint16_t> frame;
     frame.reserve(envelopes.size());
     // ESP_LOGI(TAG, "GFAT: Time %.2f", time);
-    for (const auto& envelope : envelopes) {
-        float sample = envelope.sampleAtTime(time);
+    auto nextIndex = segmentIndices.begin();
+    for (size_t channel = 0; channel < envelopes.size(); channel++) {
+        const SegmentIndex* index = nullptr;
+        if (nextIndex != segmentIndices.end() && nextIndex->first == channel) {
+            index = &nextIndex->second;
+            ++nextIndex;
+        }
+        float sample = envelopes[channel].sampleAtTime(time, index);
         // if(sample != 0) {
         //     ESP_LOGI(TAG, "Sample at time %.2f: %.2f", time, sample);
         // }
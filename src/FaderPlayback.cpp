@@ -4,6 +4,17 @@ static const char *TAG = "FaderPlayback";
 
 #define OUTPUTS_PER_DRIVER 8
 
+// holds a FaderPlayback's patternsMutex for the scope it's declared in
+class PatternsLock
+{
+public:
+    explicit PatternsLock(SemaphoreHandle_t mutex) : mutex(mutex) { xSemaphoreTakeRecursive(mutex, portMAX_DELAY); }
+    ~PatternsLock() { xSemaphoreGiveRecursive(mutex); }
+
+private:
+    SemaphoreHandle_t mutex;
+};
+
 std::vector<uint8_t> FaderPlayback::scanI2C()
 {
     ESP_LOGD(TAG, "Scanning I2C");
@@ -68,7 +79,14 @@ std::vector<uint16_t> FaderPlayback::makeFrame(int64_t time)
             patternsToRemove.push_back(patternPlayback.name);
             continue;
         }
-        const auto pattern = maybePattern->second;
+        if (time < patternPlayback.startTime)
+        {
+            continue; // scheduled to start later
+        }
+        // not a copy, which would allocate every envelope every frame. The
+        // reference stays valid as sendFrame holds patternsMutex, which every
+        // call that replaces or erases a pattern takes too.
+        const auto &pattern = maybePattern->second;
         deltaTime = ((time - patternPlayback.startTime) / 1000000.0) * speed;
 
         if (!patternPlayback.loop && deltaTime > pattern.duration)
@@ -124,7 +142,13 @@ void FaderPlayback::sendFrame()
         measStartTime = now;
     }
 
+    // a pattern being added or removed skips this frame rather than holding up the timer task
+    if (xSemaphoreTakeRecursive(patternsMutex, 0) != pdTRUE)
+    {
+        return;
+    }
     const auto newFrame = activePatterns.empty() ? defaultFrame : makeFrame(now);
+    xSemaphoreGiveRecursive(patternsMutex);
     if (newFrame == currentFrame)
     {
         return;
@@ -180,9 +204,13 @@ void FaderPlayback::testSequence()
     setPaused(false);
 }
 
-void FaderPlayback::startPattern(std::string patternName, bool loop)
+// startTime is in esp_timer_get_time's clock, -1 to start now. Clients that
+// know the offset to this clock use it to start patterns on several boards
+// together, whenever the command arrives.
+void FaderPlayback::startPattern(std::string patternName, bool loop, int64_t startTime)
 {
     ESP_LOGI(TAG, "Start pattern %s on core %d", patternName.c_str(), xPortGetCoreID());
+    PatternsLock lock(patternsMutex);
     if (activePatterns.size() > MAX_CONCURRENT_PATTERNS)
     {
         ESP_LOGE(TAG, "Max concurrent patterns reached, not adding %s", patternName.c_str());
@@ -200,17 +228,23 @@ void FaderPlayback::startPattern(std::string patternName, bool loop)
         return;
     }
     auto now = esp_timer_get_time();
+    const bool scheduled = startTime >= 0;
+    if (scheduled)
+    {
+        now = std::min(startTime, now + MAX_START_DELAY);
+    }
     auto alreadyActive = std::find_if(activePatterns.begin(), activePatterns.end(), [patternName](const PatternPlayback &pattern)
                                       { return pattern.name == patternName; });
     if (alreadyActive == activePatterns.end())
     {
 
         // find other patterns started less than quantizeTime ago, update startTime to the earliest
-        if (quantizeTime > 0)
+        if (quantizeTime > 0 && !scheduled)
         {
             for (const auto &pattern : activePatterns)
             {
-                if (now - pattern.startTime < quantizeTime)
+                // scheduled starts still to come are not ones to snap to
+                if (pattern.startTime <= now && now - pattern.startTime < quantizeTime)
                 {
                     now = pattern.startTime;
                 }
@@ -231,6 +265,7 @@ void FaderPlayback::startPattern(std::string patternName, bool loop)
 
 void FaderPlayback::stopPattern(std::string patternName)
 {
+    PatternsLock lock(patternsMutex);
     // remove from activepatterns
     activePatterns.erase(std::remove_if(activePatterns.begin(), activePatterns.end(), [patternName](const PatternPlayback &pattern)
                                         { return pattern.name == patternName; }),
@@ -247,13 +282,18 @@ void FaderPlayback::setGain(uint16_t gain)
 
 void FaderPlayback::setPatterns(std::map<std::string, BezierPattern> patterns)
 {
-    this->patterns = patterns;
-    ESP_LOGI(TAG, "Set patterns, count %d", patterns.size());
+    PatternsLock lock(patternsMutex);
+    this->patterns = std::move(patterns);
+    patternHashes.clear();
+    ESP_LOGI(TAG, "Set patterns, count %d", this->patterns.size());
 }
 
-void FaderPlayback::addPattern(std::string patternName, BezierPattern pattern)
+void FaderPlayback::addPattern(std::string patternName, BezierPattern pattern, std::string contentHash)
 {
-    patterns.insert({patternName, pattern});
+    // replaces any pattern with the same name, which keeps playing with the new data
+    PatternsLock lock(patternsMutex);
+    patterns.insert_or_assign(patternName, std::move(pattern));
+    patternHashes[patternName] = contentHash;
     uint32_t heapSize = ESP.getHeapSize();
     uint32_t usedHeap = heapSize - ESP.getFreeHeap();
     float heapUsage = float(usedHeap) / heapSize;
@@ -262,9 +302,28 @@ void FaderPlayback::addPattern(std::string patternName, BezierPattern pattern)
     // pattern.printSamples();
 }
 
+void FaderPlayback::removePattern(std::string patternName)
+{
+    // playing copies are stopped by the next frame, see makeFrame
+    PatternsLock lock(patternsMutex);
+    patterns.erase(patternName);
+    patternHashes.erase(patternName);
+    ESP_LOGI(TAG, "Removed pattern %s, now have %d total", patternName.c_str(), patterns.size());
+}
+
+std::map<std::string, std::string> FaderPlayback::getPatternHashes()
+{
+    PatternsLock lock(patternsMutex);
+    return patternHashes;
+}
+
 void FaderPlayback::setMultiplier(std::vector<uint16_t> multiplier)
 {
-    this->currentMultiplier = multiplier;
+    // controllers driving part of a rig get one value per output they have,
+    // and makeFrame reads one for every output
+    multiplier.resize(availableOutputs, 4095);
+    PatternsLock lock(patternsMutex);
+    this->currentMultiplier = std::move(multiplier);
     ESP_LOGI(TAG, "Set multiplier");
 }
 
@@ -287,6 +346,7 @@ void FaderPlayback::setPaused(bool paused)
 
 void FaderPlayback::stopAll()
 {
+    PatternsLock lock(patternsMutex);
     activePatterns.clear();
     ESP_LOGI(TAG, "Stopped all patterns");
 }
\ No newline at end of file
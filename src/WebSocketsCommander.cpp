@@ -4,8 +4,8 @@ static const char *TAG = "WebSocketsCommander";
 
 WebSocketsCommander *WebSocketsCommander::instance = nullptr;
 
-WebSocketsCommander::WebSocketsCommander(const char *ssid, const char *password, bool (*onEvent)(JsonDocument &json), BaseType_t core)
-    : ssid(ssid), password(password), onEvent(onEvent), core(core), server(7032), ws("/ws")
+WebSocketsCommander::WebSocketsCommander(const char *ssid, const char *password, bool (*onEvent)(JsonDocument &json, JsonDocument &reply), bool (*onBinary)(const uint8_t *data, size_t len, JsonDocument &reply), BaseType_t core)
+    : ssid(ssid), password(password), onEvent(onEvent), onBinary(onBinary), core(core), server(7032), ws("/ws")
 {
     instance = this;
 }
@@ -90,7 +90,24 @@ void WebSocketsCommander::WiFiEvent(WiFiEvent_t event)
 //     esp_task_wdt_delete(NULL);
 // }
 
-uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t *data, size_t len)
+void WebSocketsCommander::sendReply(AsyncWebSocketClient *client, JsonDocument &reply)
+{
+    String replyMessage;
+    serializeJson(reply, replyMessage);
+    client->text(replyMessage);
+}
+
+// Messages that could not be read are rejected, so a client waiting for
+// acknowledgements can resend instead of timing out
+void WebSocketsCommander::sendNack(AsyncWebSocketClient *client)
+{
+    JsonDocument nack;
+    nack["type"] = ACK_MESSAGE_TYPE;
+    nack["data"]["ok"] = false;
+    sendReply(client, nack);
+}
+
+uint8_t WebSocketsCommander::handleWebSocketMessage(AsyncWebSocketClient *client, AwsFrameInfo *info, uint8_t *data, size_t len)
 {
     if (info->index == 0)
     {
@@ -107,6 +124,10 @@ uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t
     if (messageBuffer == nullptr || info->index + len > messageBufferLength)
     {
         ESP_LOGE(TAG, "Message buffer is null or message too long");
+        if (info->final && info->index + len >= info->len)
+        {
+            sendNack(client);
+        }
         return 1;
     }
 
@@ -114,6 +135,24 @@ uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t
 
     if ((info->index + len) == info->len && info->final)
     {
+        JsonDocument reply;
+        if (info->opcode == WS_BINARY)
+        {
+            ESP_LOGI(TAG, "Received complete binary message of %d bytes", info->len);
+            auto shouldAck = onBinary != nullptr && info->len > 0 && onBinary((const uint8_t *)messageBuffer, info->len, reply);
+            delete[] messageBuffer;
+            messageBuffer = nullptr;
+            if (!reply.isNull())
+            {
+                sendReply(client, reply);
+            }
+            else if (!shouldAck)
+            {
+                sendNack(client);
+            }
+            return shouldAck ? 0 : 1;
+        }
+
         ESP_LOGI(TAG, "Received complete message: %s", messageBuffer);
         // check if message is empty
         if (strlen(messageBuffer) == 0)
@@ -121,6 +160,7 @@ uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t
             ESP_LOGE(TAG, "Message is empty");
             delete[] messageBuffer;
             messageBuffer = nullptr;
+            sendNack(client);
             return 1;
         }
         JsonDocument jsonDoc;
@@ -130,6 +170,7 @@ uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t
             ESP_LOGE(TAG, "deserializeJson() failed: %s", error.c_str());
             delete[] messageBuffer;
             messageBuffer = nullptr;
+            sendNack(client);
             return 1;
         }
 
@@ -138,11 +179,16 @@ uint8_t WebSocketsCommander::handleWebSocketMessage(AwsFrameInfo *info, uint8_t
             ESP_LOGE(TAG, "Invalid JSON format");
             delete[] messageBuffer;
             messageBuffer = nullptr;
+            sendNack(client);
             return 1;
         }
 
         ESP_LOGI(TAG, "Finished deserialising, calling onEvent");
-        auto shouldAck = onEvent(jsonDoc);
+        auto shouldAck = onEvent(jsonDoc, reply);
+        if (!reply.isNull())
+        {
+            sendReply(client, reply);
+        }
         // ESP_LOGE(TAG, "DELETING MESSAGE BUFFER");
         delete[] messageBuffer;
         messageBuffer = nullptr;
@@ -163,11 +209,8 @@ void WebSocketsCommander::onWebSocketEvent(AsyncWebSocket *server, AsyncWebSocke
         break;
     case WS_EVT_DATA:
     {
-        auto result = handleWebSocketMessage((AwsFrameInfo *)arg, data, len);
-        // if(result == 0) {
-        //     ESP_LOGE(TAG, "Sending ACK");
-        //     client->text("ACK");
-        // }
+        // commands that want acknowledging reply from their handler
+        handleWebSocketMessage(client, (AwsFrameInfo *)arg, data, len);
         break;
     }
     case WS_EVT_PONG:
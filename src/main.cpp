@@ -2,25 +2,45 @@
 #include <FaderPlayback.h>
 #include <WebSocketsCommander.h>
 #include <BezierJsonParser.h>
+#include <BezierBinaryParser.h>
+// generated by include/generate_patterns.py baked, a show to start with
+#if __has_include(<BakedPatterns.h>)
+#include <BakedPatterns.h>
+#endif
 
 static const char *TAG = "Main";
 
 FaderPlayback faderPlayback(0, {}, std::vector<uint16_t>(OUTPUTS_COUNT, 0));
 
-void receivePattern(const JsonObject &doc) {
+// Acknowledge an uploaded pattern so the client can send the next one. The
+// free heap lets the client back off while patterns are using up memory.
+void ackPattern(JsonDocument& reply, const std::string& patternName, bool ok) {
+  reply["type"] = FaderPlayback::COMMAND_ACK;
+  reply["data"]["name"] = patternName;
+  reply["data"]["ok"] = ok;
+  reply["data"]["free_heap"] = ESP.getFreeHeap();
+}
+
+bool receivePattern(const JsonObject &doc, JsonDocument& reply) {
   ESP_LOGI(TAG, "Received pattern");
   auto [patternName, pattern] = parseJsonToBezierPattern(doc);
-  faderPlayback.addPattern(patternName, pattern);
+  if (patternName.empty()) {
+    ackPattern(reply, doc["name"] | "", false);
+    return false;
+  }
+  faderPlayback.addPattern(patternName, pattern, doc["hash"] | "");
+  ackPattern(reply, patternName, true);
+  return true;
 }
 
-bool handleWifiCommand(JsonDocument& doc)
+bool handleWifiCommand(JsonDocument& doc, JsonDocument& reply)
 {
   // ESP_LOGI(TAG, "Handling WifiCommander command");
   uint8_t type = doc["type"];
   switch(type) {
     case FaderPlayback::COMMAND_START_PATTERN:
       faderPlayback.setPaused(false);
-      faderPlayback.startPattern(doc["data"]["name"], doc["data"]["loop"]);
+      faderPlayback.startPattern(doc["data"]["name"], doc["data"]["loop"], doc["data"]["at"] | int64_t(-1));
       break;
     case FaderPlayback::COMMAND_STOP_PATTERN:
       faderPlayback.stopPattern(doc["data"]["name"]);
@@ -50,10 +70,9 @@ bool handleWifiCommand(JsonDocument& doc)
     case FaderPlayback::COMMAND_ADD_PATTERN:
     {
       JsonObject data = doc["data"];
-      receivePattern(data);
+      bool ok = receivePattern(data, reply);
       doc.clear();
-      return true;
-      break;
+      return ok;
     }
     case FaderPlayback::COMMAND_CLEAR_PATTERNS:
     {
@@ -75,6 +94,36 @@ bool handleWifiCommand(JsonDocument& doc)
     case FaderPlayback::COMMAND_SET_PAUSED:
       faderPlayback.setPaused(doc["data"]["paused"]);
       break;
+    case FaderPlayback::COMMAND_GET_INFO:
+      reply["type"] = FaderPlayback::COMMAND_GET_INFO;
+      reply["data"]["pattern_format"] = BINARY_PATTERN_FORMAT_VERSION;
+      reply["data"]["pattern_acks"] = true;
+      reply["data"]["pattern_sync"] = true;
+      // tells controllers apart when a client drives several
+      reply["data"]["id"] = WiFi.macAddress();
+      reply["data"]["clock_sync"] = true;
+      break;
+    case FaderPlayback::COMMAND_PING:
+      // the time this arrived, for the client to work out the offset to our clock
+      reply["type"] = FaderPlayback::COMMAND_PING;
+      reply["data"]["seq"] = doc["data"]["seq"];
+      reply["data"]["time"] = esp_timer_get_time();
+      break;
+    case FaderPlayback::COMMAND_GET_PATTERNS:
+    {
+      // the manifest of held patterns, so a client only sends what changed
+      reply["type"] = FaderPlayback::COMMAND_GET_PATTERNS;
+      JsonObject manifest = reply["data"]["patterns"].to<JsonObject>();
+      for (const auto &[patternName, contentHash] : faderPlayback.getPatternHashes()) {
+        manifest[patternName] = contentHash;
+      }
+      break;
+    }
+    case FaderPlayback::COMMAND_REMOVE_PATTERNS:
+      for (JsonVariant name : doc["data"]["names"].as<JsonArray>()) {
+        faderPlayback.removePattern(name.as<std::string>());
+      }
+      break;
     default:
       ESP_LOGW(TAG, "Unknown event type");
       break;
@@ -84,14 +133,55 @@ bool handleWifiCommand(JsonDocument& doc)
   return false;
 }
 
+// Binary messages are a command type byte followed by the command's payload
+bool handleBinaryCommand(const uint8_t* data, size_t len, JsonDocument& reply)
+{
+  uint8_t type = data[0];
+  switch(type) {
+    case FaderPlayback::COMMAND_ADD_PATTERN:
+    {
+      ESP_LOGI(TAG, "Received binary pattern");
+      std::string contentHash;
+      auto [patternName, pattern] = parseBinaryToBezierPattern(data + 1, len - 1, &contentHash);
+      if (patternName.empty()) {
+        ackPattern(reply, patternName, false);
+        return false;
+      }
+      faderPlayback.addPattern(patternName, pattern, contentHash);
+      ackPattern(reply, patternName, true);
+      return true;
+    }
+    default:
+      ESP_LOGW(TAG, "Unknown binary event type %d", type);
+      return false;
+  }
+}
+
 
-WebSocketsCommander wifiCommander("COMMANDER", "fadercommand", handleWifiCommand, 0);
+WebSocketsCommander wifiCommander("COMMANDER", "fadercommand", handleWifiCommand, handleBinaryCommand, 0);
 // WiFiCommander wifiCommander("Queens", "trlguest021275", handleWifiCommand);
 // WebSocketsCommander wifiCommander("Queens", "trlguest021275", handleWifiCommand, 0);
 // WebSocketsCommander wifiCommander("190bpm hardcore steppas", "fungible", handleWifiCommand, 0);
 // WebSocketsCommander wifiCommander("TP-LINK_2C5EE8", "85394919", handleWifiCommand, 0);
 // WiFiCommander wifiCommander("190bpm hardcore steppas", "fungible", handleWifiCommand);
 
+// Add the patterns baked into flash, with their content hashes, so the client
+// finds them already here and only uploads what has changed since.
+void loadBakedPatterns() {
+#ifdef BAKED_PATTERNS_NUM
+  for (size_t i = 0; i < BAKED_PATTERNS_NUM; i++) {
+    std::string contentHash;
+    auto [patternName, pattern] = parseBinaryToBezierPattern(BAKED_PATTERNS[i], BAKED_PATTERN_SIZES[i], &contentHash);
+    if (patternName.empty()) {
+      ESP_LOGE(TAG, "Could not parse baked pattern %d", i);
+      continue;
+    }
+    faderPlayback.addPattern(patternName, pattern, contentHash);
+  }
+  ESP_LOGI(TAG, "Loaded %d baked patterns", BAKED_PATTERNS_NUM);
+#endif
+}
+
 void sendFrameCallback(void *arg) {
   faderPlayback.sendFrame();
 }
@@ -101,6 +191,7 @@ void setup()
   ESP_LOGI(TAG, "Setting up");
 
   faderPlayback.setup();
+  loadBakedPatterns();
   faderPlayback.startPattern("test");
   faderPlayback.setGain(4095);
 